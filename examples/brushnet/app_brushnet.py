@@ -99,6 +99,9 @@ def process(input_image,
     init_image = Image.fromarray(masked_image.astype(np.uint8)).convert("RGB")
     mask_image = Image.fromarray(original_mask.astype(np.uint8)).convert("RGB")
 
+    if blended and control_strength<1.0:
+        raise gr.Error('Using blurred blending with control strength less than 1.0 is not allowed')
+
     generator = torch.Generator("cuda").manual_seed(random.randint(0,2147483647) if randomize_seed else seed)
 
     image = pipe(
@@ -110,25 +113,9 @@ def process(input_image,
         generator=generator,
         brushnet_conditioning_scale=float(control_strength),
         negative_prompt=[negative_prompt]*2,
+        blended=blended,
     ).images
 
-    if blended:
-        if control_strength<1.0:
-            raise gr.Error('Using blurred blending with control strength less than 1.0 is not allowed')
-        blended_image=[]
-        # blur, you can adjust the parameters for better performance
-        mask_blurred = cv2.GaussianBlur(mask*255, (21, 21), 0)/255
-        mask_blurred = mask_blurred[:,:,np.newaxis]
-        mask = 1-(1-mask) * (1-mask_blurred)
-        for image_i in image:
-            image_np=np.array(image_i)
-            image_pasted=original_image * (1-mask) + image_np*mask
-
-            image_pasted=image_pasted.astype(image_np.dtype)
-            blended_image.append(Image.fromarray(image_pasted))
-        
-        image=blended_image
-
     return image
 
 block = gr.Blocks(
@@ -0,0 +1,277 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Checkpoints of the trainable BrushNet, written in the background while training continues.
+
+A checkpoint holds the BrushNet in the `save_pretrained` layout under `brushnet/`, the tensors of the optimizer state
+in `optimizer.safetensors`, and the rest of the training state (optimizer hyperparameters, learning rate scheduler,
+gradient scaler and the random states of every process) in `training_state.bin`. It is written to a hidden directory
+next to its destination, and only renamed into place once every file and the `checkpoint.json` manifest listing them
+are on disk.
+"""
+
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import threading
+
+import numpy as np
+import safetensors.torch
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "checkpoint.json"
+WEIGHTS_NAME = os.path.join("brushnet", "diffusion_pytorch_model.safetensors")
+OPTIMIZER_NAME = "optimizer.safetensors"
+TRAINING_STATE_NAME = "training_state.bin"
+
+
+def is_async_checkpoint(path):
+    """
+    Returns whether `path` was written by `AsyncCheckpointWriter`, rather than `accelerator.save_state`.
+    """
+    return os.path.isfile(os.path.join(path, MANIFEST_NAME))
+
+
+def verify_checkpoint(path):
+    """
+    Returns whether every file listed in the manifest of the checkpoint at `path` exists with its recorded size.
+    """
+    try:
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return all(
+        os.path.isfile(os.path.join(path, name)) and os.path.getsize(os.path.join(path, name)) == size
+        for name, size in manifest["files"].items()
+    )
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _split_optimizer_state(state_dict):
+    # the tensors of the per-parameter state go to safetensors, the rest stays a small picklable skeleton
+    tensors = {}
+    state = {}
+    for param_id, param_state in state_dict["state"].items():
+        state[param_id] = {}
+        for name, value in param_state.items():
+            if torch.is_tensor(value):
+                tensors[f"{param_id}.{name}"] = value
+                value = None
+            state[param_id][name] = value
+    return tensors, {"state": state, "param_groups": state_dict["param_groups"]}
+
+
+def collect_random_states(generators=None):
+    """
+    The random states of this process, and those of the `torch.Generator`s in the `generators` dict, for the
+    `random_states` of `AsyncCheckpointWriter.save`. `None` generators are skipped.
+    """
+    # the numpy keys are stored as a tensor, so the training state loads with `weights_only=True`
+    name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    states = {
+        "random": random.getstate(),
+        "numpy": (name, torch.from_numpy(keys.astype(np.int64)), position, has_gauss, cached_gaussian),
+        "torch": torch.get_rng_state(),
+        "generators": {
+            generator_name: generator.get_state()
+            for generator_name, generator in (generators or {}).items()
+            if generator is not None
+        },
+    }
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+class AsyncCheckpointWriter:
+    r"""
+    Saves the trainable BrushNet and its optimizer state from a background thread.
+
+    `save` only blocks the training loop for copying the tensors to CPU buffers, pinned when they are on the GPU and
+    reused from one checkpoint to the next. One checkpoint is written at a time: a `save` that comes while the previous
+    checkpoint is still being written waits for it first.
+
+    Args:
+        output_dir (`str`):
+            The directory the checkpoints are written to.
+        total_limit (`int`, *optional*):
+            The number of `checkpoint-{step}` directories to keep. The oldest are removed once a new checkpoint is
+            complete, so there are never fewer complete checkpoints than before.
+    """
+
+    def __init__(self, output_dir, total_limit=None):
+        self.output_dir = output_dir
+        self.total_limit = total_limit
+        self._buffers = {}
+        self._thread = None
+        self._error = None
+
+    def _snapshot(self, prefix, tensors):
+        snapshot = {}
+        for name, tensor in tensors.items():
+            buffer = self._buffers.get((prefix, name))
+            if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+                buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=tensor.is_cuda)
+                self._buffers[(prefix, name)] = buffer
+            buffer.copy_(tensor.detach(), non_blocking=True)
+            snapshot[name] = buffer
+        return snapshot
+
+    def save(self, name, model, optimizer, lr_scheduler=None, scaler=None, json_files=None, random_states=None):
+        """
+        Snapshots the state of `model` (the unwrapped BrushNet), `optimizer`, `lr_scheduler` and `scaler`, and starts
+        writing it to `output_dir/name`. `json_files` maps extra file names of the checkpoint to their JSON content.
+        `random_states` lists the `collect_random_states` of every process, by process index, and defaults to the
+        random states of the calling process only.
+        """
+        self.wait()
+        weights = self._snapshot("model", model.state_dict())
+        optimizer_tensors, optimizer_state = _split_optimizer_state(optimizer.state_dict())
+        optimizer_tensors = self._snapshot("optimizer", optimizer_tensors)
+        if torch.cuda.is_available():
+            # the copies are asynchronous, the next optimizer step must not overwrite the weights before they land
+            torch.cuda.synchronize()
+        training_state = {
+            "optimizer": optimizer_state,
+            "lr_scheduler": lr_scheduler.state_dict() if lr_scheduler is not None else None,
+            "scaler": scaler.state_dict() if scaler is not None else None,
+            "random_states": random_states if random_states is not None else [collect_random_states()],
+        }
+        files = {file_name: json.dumps(content, indent=2) for file_name, content in (json_files or {}).items()}
+        files[os.path.join("brushnet", "config.json")] = model.to_json_string()
+        self._thread = threading.Thread(
+            target=self._write, args=(name, weights, optimizer_tensors, training_state, files)
+        )
+        self._thread.start()
+
+    def _write(self, name, weights, optimizer_tensors, training_state, text_files):
+        try:
+            path = os.path.join(self.output_dir, name)
+            tmp_path = os.path.join(self.output_dir, f".{name}.tmp")
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+            os.makedirs(os.path.join(tmp_path, "brushnet"))
+
+            safetensors.torch.save_file(weights, os.path.join(tmp_path, WEIGHTS_NAME), metadata={"format": "pt"})
+            safetensors.torch.save_file(optimizer_tensors, os.path.join(tmp_path, OPTIMIZER_NAME))
+            torch.save(training_state, os.path.join(tmp_path, TRAINING_STATE_NAME))
+            for file_name, content in text_files.items():
+                with open(os.path.join(tmp_path, file_name), "w") as f:
+                    f.write(content)
+
+            files = {}
+            for root, _, file_names in os.walk(tmp_path):
+                for file_name in file_names:
+                    file_path = os.path.join(root, file_name)
+                    _fsync(file_path)
+                    files[os.path.relpath(file_path, tmp_path)] = os.path.getsize(file_path)
+            # the manifest is written last, a checkpoint without it is never loaded
+            with open(os.path.join(tmp_path, MANIFEST_NAME), "w") as f:
+                json.dump({"files": files}, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+
+            old_path = os.path.join(self.output_dir, f".{name}.old")
+            if os.path.exists(path):
+                os.replace(path, old_path)
+            os.replace(tmp_path, path)
+            _fsync(self.output_dir)
+            if os.path.exists(old_path):
+                shutil.rmtree(old_path)
+            logger.info(f"Saved state to {path}")
+
+            self._remove_old_checkpoints()
+        except BaseException as e:
+            self._error = e
+
+    def _remove_old_checkpoints(self):
+        if self.total_limit is None:
+            return
+        checkpoints = [d for d in os.listdir(self.output_dir) if re.fullmatch(r"checkpoint-\d+", d)]
+        checkpoints = sorted(checkpoints, key=lambda x: int(x.split("-")[1]))
+        removing_checkpoints = checkpoints[: max(0, len(checkpoints) - self.total_limit)]
+        if len(removing_checkpoints) > 0:
+            logger.info(f"removing checkpoints: {', '.join(removing_checkpoints)}")
+        for removing_checkpoint in removing_checkpoints:
+            shutil.rmtree(os.path.join(self.output_dir, removing_checkpoint))
+
+    def is_busy(self):
+        """
+        Returns whether a checkpoint is still being written, in which case `save` would wait for it.
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    def wait(self):
+        """
+        Waits for the checkpoint being written, and raises the error it failed with, if any.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing the last checkpoint failed.") from error
+
+
+def load_async_checkpoint(path, model, optimizer, lr_scheduler=None, scaler=None, process_index=0, generators=None):
+    """
+    Loads a checkpoint written by `AsyncCheckpointWriter` into `model` (the unwrapped BrushNet), `optimizer`,
+    `lr_scheduler` and `scaler`, and restores the random states that process `process_index` saved, including those
+    of the `torch.Generator`s in the `generators` dict. Returns whether the checkpoint had random states for this
+    process; a checkpoint saved by fewer processes leaves the random states as they are.
+    """
+    if not verify_checkpoint(path):
+        raise ValueError(f"The checkpoint {path} is incomplete.")
+    model.load_state_dict(safetensors.torch.load_file(os.path.join(path, WEIGHTS_NAME)))
+
+    training_state = torch.load(os.path.join(path, TRAINING_STATE_NAME), map_location="cpu", weights_only=True)
+    optimizer_state = training_state["optimizer"]
+    for name, tensor in safetensors.torch.load_file(os.path.join(path, OPTIMIZER_NAME)).items():
+        param_id, state_name = name.split(".", 1)
+        optimizer_state["state"][int(param_id)][state_name] = tensor
+    optimizer.load_state_dict(optimizer_state)
+    if lr_scheduler is not None and training_state["lr_scheduler"] is not None:
+        lr_scheduler.load_state_dict(training_state["lr_scheduler"])
+    if scaler is not None and training_state["scaler"] is not None:
+        scaler.load_state_dict(training_state["scaler"])
+
+    if process_index >= len(training_state["random_states"]):
+        logger.warning(f"The checkpoint {path} has no random states for process {process_index}.")
+        return False
+    random_states = training_state["random_states"][process_index]
+    random.setstate(random_states["random"])
+    name, keys, position, has_gauss, cached_gaussian = random_states["numpy"]
+    np.random.set_state((name, keys.numpy().astype(np.uint32), position, has_gauss, cached_gaussian))
+    torch.set_rng_state(random_states["torch"])
+    if "cuda" in random_states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(random_states["cuda"])
+    for generator_name, generator in (generators or {}).items():
+        if generator is not None and generator_name in random_states["generators"]:
+            generator.set_state(random_states["generators"][generator_name])
+    return True
@@ -0,0 +1,141 @@
+from diffusers import StableDiffusionBrushNetPipeline, BrushNetModel, UniPCMultistepScheduler
+import argparse
+import csv
+import os
+import time
+import torch
+import cv2
+import numpy as np
+from PIL import Image
+
+
+# Benchmarks BrushNet inference speed-ups against the plain pipeline: every variant is run with the same seed, its
+# per-step latency is recorded and the output is compared with the reference output inside the masked region.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--brushnet_ckpt_path',
+                    type=str,
+                    default="data/ckpt/segmentation_mask_brushnet_ckpt")
+parser.add_argument('--base_model_path',
+                    type=str,
+                    default="runwayml/stable-diffusion-v1-5")
+parser.add_argument('--image_path',
+                    type=str,
+                    default="examples/brushnet/src/test_image.jpg")
+parser.add_argument('--mask_path',
+                    type=str,
+                    default="examples/brushnet/src/test_mask.jpg")
+parser.add_argument('--caption',
+                    type=str,
+                    default="A cake on the table.")
+parser.add_argument('--num_inference_steps', type=int, default=50)
+parser.add_argument('--seed', type=int, default=1234)
+parser.add_argument('--num_runs', type=int, default=3)
+parser.add_argument('--brushnet_cache_interval', type=int, nargs='*', default=[2, 3, 5])
+parser.add_argument('--brushnet_cache_start', type=float, default=0.0)
+parser.add_argument('--brushnet_cache_extrapolate', action='store_true')
+parser.add_argument('--unet_cache_interval', type=int, nargs='*', default=[2, 3])
+parser.add_argument('--unet_cache_depth', type=int, default=1)
+parser.add_argument('--brushnet_window_padding', type=int, nargs='*', default=[4, 8])
+parser.add_argument('--output_csv',
+                    type=str,
+                    default="runs/benchmark_brushnet.csv")
+
+args = parser.parse_args()
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def synchronize():
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+
+def run_variant(pipe, **kwargs):
+    # step i is timed from the end of step i-1, so the first step (which also covers the input preprocessing) is
+    # left out of the per-step latencies
+    step_ends = []
+
+    def record_step_end(pipe, step, timestep, callback_kwargs):
+        synchronize()
+        step_ends.append(time.perf_counter())
+        return callback_kwargs
+
+    images = []
+    step_times = []
+    for _ in range(args.num_runs):
+        step_ends.clear()
+        image = pipe(
+            args.caption,
+            init_image,
+            mask_image,
+            num_inference_steps=args.num_inference_steps,
+            generator=torch.Generator(device).manual_seed(args.seed),
+            output_type="np",
+            callback_on_step_end=record_step_end,
+            **kwargs,
+        ).images[0]
+        images.append(image)
+        step_times.append(np.diff(step_ends))
+    return images[-1], np.mean(step_times, axis=0)
+
+
+def masked_psnr(image, reference):
+    mse = ((image - reference) ** 2)[mask_np[:, :, 0] > 0].mean()
+    return float("inf") if mse == 0 else 10 * np.log10(1.0 / mse)
+
+
+brushnet = BrushNetModel.from_pretrained(args.brushnet_ckpt_path, torch_dtype=torch.float16)
+pipe = StableDiffusionBrushNetPipeline.from_pretrained(
+    args.base_model_path, brushnet=brushnet, torch_dtype=torch.float16, low_cpu_mem_usage=False
+).to(device)
+pipe.scheduler = UniPCMultistepScheduler.from_config(pipe.scheduler.config)
+pipe.set_progress_bar_config(disable=True)
+
+init_image = cv2.imread(args.image_path)[:,:,::-1]
+mask_np = 1.*(cv2.imread(args.mask_path).sum(-1)>255)[:,:,np.newaxis]
+init_image = init_image * (1-mask_np)
+
+init_image = Image.fromarray(init_image.astype(np.uint8)).convert("RGB")
+mask_image = Image.fromarray(mask_np.astype(np.uint8).repeat(3,-1)*255).convert("RGB")
+
+variants = {"reference": {}}
+for interval in args.brushnet_cache_interval:
+    variants[f"brushnet_cache_interval@{interval}"] = {
+        "brushnet_cache_interval": interval,
+        "brushnet_cache_start": args.brushnet_cache_start,
+        "brushnet_cache_extrapolate": args.brushnet_cache_extrapolate,
+    }
+for interval in args.unet_cache_interval:
+    variants[f"unet_cache_interval@{interval}"] = {
+        "unet_cache_interval": interval,
+        "unet_cache_depth": args.unet_cache_depth,
+    }
+for padding in args.brushnet_window_padding:
+    variants[f"brushnet_window_padding@{padding}"] = {"brushnet_window_padding": padding}
+
+# warm up kernels and allocator before anything is timed
+run_variant(pipe)
+
+rows = []
+for name, kwargs in variants.items():
+    print(f"benchmarking {name} ...")
+    image, step_times = run_variant(pipe, **kwargs)
+    if name == "reference":
+        reference_image, reference_step_time = image, step_times.mean()
+    rows.append({
+        "variant": name,
+        "step time (ms)": f"{step_times.mean() * 1000:.2f}",
+        "speedup": f"{reference_step_time / step_times.mean():.2f}",
+        "masked PSNR": f"{masked_psnr(image, reference_image):.2f}",
+        "masked max abs diff": f"{np.abs(image - reference_image)[mask_np[:, :, 0] > 0].max():.4f}",
+        "per-step times (ms)": " ".join(f"{t * 1000:.2f}" for t in step_times),
+    })
+    print({key: value for key, value in rows[-1].items() if key != "per-step times (ms)"})
+
+os.makedirs(os.path.dirname(args.output_csv) or ".", exist_ok=True)
+with open(args.output_csv, mode="w", newline="") as csvfile:
+    writer = csv.DictWriter(csvfile, fieldnames=list(rows[0].keys()))
+    writer.writeheader()
+    writer.writerows(rows)
+print(f"Logs written to: {args.output_csv}")
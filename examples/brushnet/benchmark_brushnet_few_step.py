@@ -0,0 +1,144 @@
+from diffusers import StableDiffusionBrushNetPipeline, BrushNetModel, UniPCMultistepScheduler, LCMScheduler, TCDScheduler
+import argparse
+import csv
+import os
+import time
+import torch
+import cv2
+import numpy as np
+from PIL import Image
+
+
+# Benchmarks few-step BrushNet inference against the 50-step UniPC default: the reference is run with the base UNet and
+# classifier free guidance, the few-step variants with an LCM-LoRA fused into the UNet and without classifier free
+# guidance. Every variant uses the same seed and is compared with the reference output inside the masked region.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--brushnet_ckpt_path',
+                    type=str,
+                    default="data/ckpt/segmentation_mask_brushnet_ckpt")
+parser.add_argument('--base_model_path',
+                    type=str,
+                    default="runwayml/stable-diffusion-v1-5")
+parser.add_argument('--lcm_lora_path',
+                    type=str,
+                    default="latent-consistency/lcm-lora-sdv1-5")
+parser.add_argument('--image_path',
+                    type=str,
+                    default="examples/brushnet/src/test_image.jpg")
+parser.add_argument('--mask_path',
+                    type=str,
+                    default="examples/brushnet/src/test_mask.jpg")
+parser.add_argument('--caption',
+                    type=str,
+                    default="A cake on the table.")
+parser.add_argument('--reference_steps', type=int, default=50)
+parser.add_argument('--reference_guidance_scale', type=float, default=7.5)
+parser.add_argument('--few_step_steps', type=int, nargs='*', default=[4, 8])
+parser.add_argument('--schedulers', type=str, nargs='*', default=["lcm", "tcd"], choices=["lcm", "tcd"])
+parser.add_argument('--tcd_eta', type=float, default=0.3)
+parser.add_argument('--brushnet_conditioning_scale', type=float, default=1.0)
+parser.add_argument('--seed', type=int, default=1234)
+parser.add_argument('--num_runs', type=int, default=3)
+parser.add_argument('--output_csv',
+                    type=str,
+                    default="runs/benchmark_brushnet_few_step.csv")
+
+args = parser.parse_args()
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def synchronize():
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+
+def run_variant(pipe, **kwargs):
+    images = []
+    latencies = []
+    for _ in range(args.num_runs):
+        synchronize()
+        start = time.perf_counter()
+        image = pipe(
+            args.caption,
+            init_image,
+            mask_image,
+            generator=torch.Generator(device).manual_seed(args.seed),
+            brushnet_conditioning_scale=args.brushnet_conditioning_scale,
+            output_type="np",
+            **kwargs,
+        ).images[0]
+        synchronize()
+        latencies.append(time.perf_counter() - start)
+        images.append(image)
+    return images[-1], np.mean(latencies)
+
+
+def masked_psnr(image, reference):
+    mse = ((image - reference) ** 2)[mask_np[:, :, 0] > 0].mean()
+    return float("inf") if mse == 0 else 10 * np.log10(1.0 / mse)
+
+
+brushnet = BrushNetModel.from_pretrained(args.brushnet_ckpt_path, torch_dtype=torch.float16)
+pipe = StableDiffusionBrushNetPipeline.from_pretrained(
+    args.base_model_path, brushnet=brushnet, torch_dtype=torch.float16, low_cpu_mem_usage=False
+).to(device)
+pipe.set_progress_bar_config(disable=True)
+
+init_image = cv2.imread(args.image_path)[:,:,::-1]
+mask_np = 1.*(cv2.imread(args.mask_path).sum(-1)>255)[:,:,np.newaxis]
+init_image = init_image * (1-mask_np)
+
+init_image = Image.fromarray(init_image.astype(np.uint8)).convert("RGB")
+mask_image = Image.fromarray(mask_np.astype(np.uint8).repeat(3,-1)*255).convert("RGB")
+
+reference_kwargs = {"num_inference_steps": args.reference_steps, "guidance_scale": args.reference_guidance_scale}
+schedulers = {
+    "lcm": (LCMScheduler, {}),
+    "tcd": (TCDScheduler, {"eta": args.tcd_eta}),
+}
+
+# warm up kernels and allocator before anything is timed
+pipe.scheduler = UniPCMultistepScheduler.from_config(pipe.scheduler.config)
+run_variant(pipe, **reference_kwargs)
+
+print("benchmarking reference ...")
+reference_image, reference_latency = run_variant(pipe, **reference_kwargs)
+rows = [{
+    "variant": f"unipc@{args.reference_steps}",
+    "latency (s)": f"{reference_latency:.3f}",
+    "speedup": "1.00",
+    "masked PSNR": f"{float('inf'):.2f}",
+    "masked max abs diff": f"{0:.4f}",
+}]
+print(rows[-1])
+
+# the LoRA only touches the base UNet, the BrushNet is used as is
+pipe.load_lora_weights(args.lcm_lora_path)
+pipe.fuse_lora()
+
+for scheduler_name in args.schedulers:
+    scheduler_class, scheduler_kwargs = schedulers[scheduler_name]
+    pipe.scheduler = scheduler_class.from_config(pipe.scheduler.config)
+    for num_inference_steps in args.few_step_steps:
+        name = f"{scheduler_name}@{num_inference_steps}"
+        print(f"benchmarking {name} ...")
+        image, latency = run_variant(
+            pipe, num_inference_steps=num_inference_steps, guidance_scale=1.0, **scheduler_kwargs
+        )
+        rows.append({
+            "variant": name,
+            "latency (s)": f"{latency:.3f}",
+            "speedup": f"{reference_latency / latency:.2f}",
+            "masked PSNR": f"{masked_psnr(image, reference_image):.2f}",
+            "masked max abs diff": f"{np.abs(image - reference_image)[mask_np[:, :, 0] > 0].max():.4f}",
+        })
+        print(rows[-1])
+
+os.makedirs(os.path.dirname(args.output_csv) or ".", exist_ok=True)
+with open(args.output_csv, mode="w", newline="") as csvfile:
+    writer = csv.DictWriter(csvfile, fieldnames=list(rows[0].keys()))
+    writer.writeheader()
+    writer.writerows(rows)
+print(f"Logs written to: {args.output_csv}")
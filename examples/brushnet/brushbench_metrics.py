@@ -0,0 +1,254 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batched BrushBench metrics, computed on one device.
+
+Every batch of images is decoded once and preprocessed once for all the image towers: the CLIP ViT-L/14 behind the CLIP
+similarity and the aesthetic predictor, the BLIP encoder of ImageReward and the ViT-H/14 of HPS v2.1 all take the same
+224x224 crop, normalized with the OpenAI CLIP statistics. The masked PSNR, MSE and LPIPS are computed over the batch
+with the semantics of the original per-image metrics.
+"""
+
+import os
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+from metric_assets import MetricAssets
+
+
+METRIC_NAMES = ["Image Reward", "HPS V2.1", "Aesthetic Score", "PSNR", "LPIPS", "MSE", "CLIP Similarity"]
+
+# the model and preprocessing behind every metric, change it when the metric changes so cached scores are not reused
+METRIC_VERSIONS = {
+    "Image Reward": "ImageReward-v1.0+clip224",
+    "HPS V2.1": "HPS_v2.1_compressed+clip224",
+    "Aesthetic Score": "sa_0_4_vit_l_14_linear+clip-vit-large-patch14+clip224",
+    "PSNR": "masked-psnr",
+    "LPIPS": "lpips-squeeze+masked",
+    "MSE": "masked-mse",
+    "CLIP Similarity": "clip-vit-large-patch14+clip224",
+}
+
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+def load_images(paths, size=(512, 512)):
+    """
+    Decodes the RGB images at `paths` resized to `size`, as a `uint8` tensor of shape `(batch_size, 3, height, width)`.
+    """
+    images = []
+    for path in paths:
+        image = cv2.imread(path, cv2.IMREAD_COLOR)[:, :, ::-1]
+        if image.shape[:2] != (size[1], size[0]):
+            image = cv2.resize(image, size, interpolation=cv2.INTER_CUBIC)
+        images.append(image)
+    return torch.from_numpy(np.stack(images)).permute(0, 3, 1, 2).contiguous()
+
+
+def clip_preprocess(images, size=224):
+    """
+    Resizes the short side of the `uint8` `images` to `size` with bicubic interpolation, center crops them and
+    normalizes them with the CLIP statistics, like the CLIP, ImageReward and HPS image transforms.
+    """
+    height, width = images.shape[-2:]
+    scale = size / min(height, width)
+    resized = (max(size, int(height * scale)), max(size, int(width * scale)))
+    images = F.interpolate(images.float(), size=resized, mode="bicubic", align_corners=False, antialias=True)
+    top, left = (resized[0] - size) // 2, (resized[1] - size) // 2
+    images = images[..., top : top + size, left : left + size].clamp(0, 255) / 255
+    mean = torch.tensor(CLIP_MEAN, device=images.device).view(1, 3, 1, 1)
+    std = torch.tensor(CLIP_STD, device=images.device).view(1, 3, 1, 1)
+    return (images - mean) / std
+
+
+def masked_mse(images, references, masks):
+    """
+    The squared error of `images` and `references` in `[0, 1]`, summed over the channels of the pixels where `masks`
+    is 1 and divided by the number of those pixels, per image.
+    """
+    squared_error = ((images - references) * masks) ** 2
+    return squared_error.sum(dim=(1, 2, 3)) / masks.sum(dim=(1, 2, 3))
+
+
+def masked_psnr(images, references, masks):
+    """
+    The PSNR of `masked_mse`, set to 1000 for (nearly) identical images.
+    """
+    mse = masked_mse(images, references, masks)
+    psnr = -10 * torch.log10(mse.clamp(min=1e-10))
+    return torch.where(mse < 1.0e-10, torch.full_like(psnr, 1000), psnr)
+
+
+class BatchedMetricsCalculator:
+    r"""
+    Scores batches of generated BrushBench images with all of `METRIC_NAMES`.
+
+    The metric models are loaded from a `MetricAssets` cache when they are first needed, so a batch whose scores are
+    all cached never loads them.
+
+    Args:
+        device (`torch.device` or `str`):
+            The device every metric model runs on.
+        ckpt_path (`str`, defaults to `"data/ckpt/metric_assets"`):
+            The cache directory of the metric model weights.
+        metrics (`List[str]`, *optional*):
+            The metrics to compute, defaults to all of `METRIC_NAMES`.
+        offline (`bool`, defaults to `False`):
+            Only load weights that are in the cache, never download them.
+    """
+
+    def __init__(self, device, ckpt_path="data/ckpt/metric_assets", metrics=None, offline=False):
+        self.device = torch.device(device)
+        self.metrics = list(metrics) if metrics is not None else list(METRIC_NAMES)
+        self.assets = MetricAssets(ckpt_path, offline=offline)
+        self._loaded = set()
+
+    def _load(self, metrics):
+        # the metric models are only imported and loaded when they are used
+        if ("CLIP Similarity" in metrics or "Aesthetic Score" in metrics) and "clip" not in self._loaded:
+            from transformers import CLIPModel, CLIPTokenizer
+
+            clip_path = os.path.dirname(self.assets.resolve("clip-vit-large-patch14")["config.json"])
+            self.clip_model = CLIPModel.from_pretrained(clip_path).to(self.device).eval()
+            self.clip_tokenizer = CLIPTokenizer.from_pretrained(clip_path)
+            self._loaded.add("clip")
+        if "Aesthetic Score" in metrics and "Aesthetic Score" not in self._loaded:
+            self.aesthetic_model = torch.nn.Linear(768, 1)
+            aesthetic_model_ckpt_path = self.assets.resolve("aesthetic-predictor")["sa_0_4_vit_l_14_linear.pth"]
+            self.aesthetic_model.load_state_dict(torch.load(aesthetic_model_ckpt_path, map_location="cpu"))
+            self.aesthetic_model.to(self.device).eval()
+            self._loaded.add("Aesthetic Score")
+        if "LPIPS" in metrics and "LPIPS" not in self._loaded:
+            from torchmetrics.image.lpip import LearnedPerceptualImagePatchSimilarity
+
+            # torchvision loads the SqueezeNet backbone from the checkpoints of the torch hub directory
+            squeezenet_path = self.assets.resolve("squeezenet1_1")["checkpoints/squeezenet1_1-b8a52dc0.pth"]
+            hub_dir = torch.hub.get_dir()
+            torch.hub.set_dir(os.path.dirname(os.path.dirname(squeezenet_path)))
+            try:
+                self.lpips_model = LearnedPerceptualImagePatchSimilarity(net_type="squeeze").to(self.device)
+            finally:
+                torch.hub.set_dir(hub_dir)
+            self._loaded.add("LPIPS")
+        if "Image Reward" in metrics and "Image Reward" not in self._loaded:
+            import ImageReward as RM
+
+            self.assets.resolve("bert-base-uncased")
+            imagereward_paths = self.assets.resolve("ImageReward-v1.0")
+            self.imagereward_model = RM.load(
+                imagereward_paths["ImageReward.pt"],
+                device=self.device,
+                med_config=imagereward_paths["med_config.json"],
+            )
+            self._loaded.add("Image Reward")
+        if "HPS V2.1" in metrics and "HPS V2.1" not in self._loaded:
+            from hpsv2.src.open_clip import create_model_and_transforms, get_tokenizer
+
+            # the HPS v2.1 checkpoint replaces all the weights, so the ViT-H-14 is created without pretrained weights
+            self.hps_model = create_model_and_transforms(
+                "ViT-H-14", pretrained=None, precision="amp", device=self.device, output_dict=True
+            )[0]
+            hps_path = self.assets.resolve("HPS_v2.1")["HPS_v2.1_compressed.pt"]
+            checkpoint = torch.load(hps_path, map_location=self.device)
+            self.hps_model.load_state_dict(checkpoint["state_dict"])
+            self.hps_model.eval()
+            self.hps_tokenizer = get_tokenizer("ViT-H-14")
+            self._loaded.add("HPS V2.1")
+
+    def _autocast(self):
+        return torch.autocast(self.device.type, enabled=self.device.type == "cuda")
+
+    @torch.no_grad()
+    def __call__(self, images, source_images, masks, prompts, metrics=None):
+        """
+        Scores a batch.
+
+        Args:
+            images (`torch.Tensor`):
+                The generated images, `uint8` of shape `(batch_size, 3, height, width)`.
+            source_images (`torch.Tensor`):
+                The source images, `uint8` of the same shape.
+            masks (`torch.Tensor`):
+                The region the PSNR, MSE and LPIPS are computed on, 1 outside the inpainting mask, of shape
+                `(batch_size, 1, height, width)`.
+            prompts (`List[str]`):
+                The caption of every image.
+            metrics (`List[str]`, *optional*):
+                Only compute these of the loaded metrics, defaults to all of them.
+
+        Returns:
+            `Dict[str, np.ndarray]`: The scores of every image for every metric.
+        """
+        metrics = self.metrics if metrics is None else [name for name in self.metrics if name in metrics]
+        self._load(metrics)
+        images = images.to(self.device)
+        results = {}
+
+        pixel_values = clip_preprocess(images)
+        if "CLIP Similarity" in metrics or "Aesthetic Score" in metrics:
+            # one image forward for both metrics
+            image_features = self.clip_model.get_image_features(pixel_values=pixel_values)
+            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        if "CLIP Similarity" in metrics:
+            text_inputs = self.clip_tokenizer(prompts, padding=True, truncation=True, return_tensors="pt")
+            text_features = self.clip_model.get_text_features(**text_inputs.to(self.device))
+            text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+            results["CLIP Similarity"] = (100 * (image_features * text_features).sum(dim=-1)).clamp(min=0)
+        if "Aesthetic Score" in metrics:
+            results["Aesthetic Score"] = self.aesthetic_model(image_features)[:, 0]
+
+        if "Image Reward" in metrics:
+            model = self.imagereward_model
+            text_inputs = model.blip.tokenizer(
+                prompts, padding="max_length", truncation=True, max_length=35, return_tensors="pt"
+            ).to(self.device)
+            image_embeds = model.blip.visual_encoder(pixel_values)
+            image_atts = torch.ones(image_embeds.shape[:-1], dtype=torch.long, device=self.device)
+            text_output = model.blip.text_encoder(
+                text_inputs.input_ids,
+                attention_mask=text_inputs.attention_mask,
+                encoder_hidden_states=image_embeds,
+                encoder_attention_mask=image_atts,
+                return_dict=True,
+            )
+            rewards = model.mlp(text_output.last_hidden_state[:, 0, :].float())
+            results["Image Reward"] = ((rewards - model.mean) / model.std)[:, 0]
+
+        if "HPS V2.1" in metrics:
+            with self._autocast():
+                image_features = self.hps_model.encode_image(pixel_values, normalize=True)
+                text_features = self.hps_model.encode_text(self.hps_tokenizer(prompts).to(self.device), normalize=True)
+            results["HPS V2.1"] = (image_features * text_features).sum(dim=-1).float()
+
+        if {"PSNR", "MSE", "LPIPS"} & set(metrics):
+            images = images.float() / 255
+            source_images = source_images.to(self.device).float() / 255
+            masks = masks.to(self.device, dtype=images.dtype)
+            if "PSNR" in metrics:
+                results["PSNR"] = masked_psnr(source_images, images, masks)
+            if "MSE" in metrics:
+                results["MSE"] = masked_mse(source_images, images, masks)
+            if "LPIPS" in metrics:
+                # the per-image distances, as the metric object only returns the batch average
+                lpips = self.lpips_model.net(images * masks * 2 - 1, source_images * masks * 2 - 1)
+                results["LPIPS"] = lpips.reshape(len(images))
+
+        # a single transfer to the host for the whole batch
+        names = [name for name in metrics if name in results]
+        scores = torch.stack([results[name].float() for name in names]).cpu().numpy()
+        return dict(zip(names, scores))
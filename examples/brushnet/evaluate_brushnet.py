@@ -1,298 +1,370 @@
 from diffusers import StableDiffusionBrushNetPipeline, BrushNetModel, UniPCMultistepScheduler
 import torch
+import contextlib
 import cv2
+import glob
 import json
 import os
+import queue
+import threading
+import time
 import numpy as np
 from PIL import Image
 import argparse
 import pandas as pd
-import torch
-from torchvision.transforms import Resize
-from torchvision import transforms
-import torch.nn.functional as F
-import numpy as np
-from torchmetrics.multimodal import CLIPScore
-from torchmetrics.image import PeakSignalNoiseRatio, StructuralSimilarityIndexMeasure
-from torchmetrics.image.lpip import LearnedPerceptualImagePatchSimilarity
-from torchmetrics.regression import MeanSquaredError
-from urllib.request import urlretrieve 
-from PIL import Image
-import open_clip
-import os
-import hpsv2
-import ImageReward as RM
-import math
-from transformers import AutoProcessor, AutoModel
-
-def rle2mask(mask_rle, shape): # height, width
-    starts, lengths = [np.asarray(x, dtype=int) for x in (mask_rle[0:][::2], mask_rle[1:][::2])]
-    starts -= 1
-    ends = starts + lengths
-    binary_mask = np.zeros(shape[0] * shape[1], dtype=np.uint8)
-    for lo, hi in zip(starts, ends):
-        binary_mask[lo:hi] = 1
-    return binary_mask.reshape(shape)
-
-
-class MetricsCalculator:
-    def __init__(self, device,ckpt_path="data/ckpt") -> None:
-        self.device=device
-        # clip
-        self.clip_metric_calculator = CLIPScore(model_name_or_path="openai/clip-vit-large-patch14").to(device)
-        # lpips
-        self.lpips_metric_calculator = LearnedPerceptualImagePatchSimilarity(net_type='squeeze').to(device)
-        # aesthetic model
-        self.aesthetic_model = torch.nn.Linear(768, 1)
-        aesthetic_model_url = (
-                    "https://github.com/LAION-AI/aesthetic-predictor/blob/main/sa_0_4_vit_l_14_linear.pth?raw=true"
-                )
-        aesthetic_model_ckpt_path=os.path.join(ckpt_path,"sa_0_4_vit_l_14_linear.pth")
-        urlretrieve(aesthetic_model_url, aesthetic_model_ckpt_path)
-        self.aesthetic_model.load_state_dict(torch.load(aesthetic_model_ckpt_path))
-        self.aesthetic_model.eval()
-        self.clip_model, _, self.clip_preprocess = open_clip.create_model_and_transforms('ViT-L-14', pretrained='openai')
-        # image reward model
-        self.imagereward_model = RM.load("ImageReward-v1.0")
- 
-
-    def calculate_image_reward(self,image,prompt):
-        reward = self.imagereward_model.score(prompt, [image])
-        return reward
-
-    def calculate_hpsv21_score(self,image,prompt):
-        result = hpsv2.score(image, prompt, hps_version="v2.1")[0]
-        return result.item()
-
-    def calculate_aesthetic_score(self,img):
-        image = self.clip_preprocess(img).unsqueeze(0)
-        with torch.no_grad():
-            image_features = self.clip_model.encode_image(image)
-            image_features /= image_features.norm(dim=-1, keepdim=True)
-            prediction = self.aesthetic_model(image_features)
-        return prediction.cpu().item()
-
-    def calculate_clip_similarity(self, img, txt):
-        img = np.array(img)
-        
-        img_tensor=torch.tensor(img).permute(2,0,1).to(self.device)
-        
-        score = self.clip_metric_calculator(img_tensor, txt)
-        score = score.cpu().item()
-        
-        return score
-    
-    def calculate_psnr(self, img_pred, img_gt, mask=None):
-        img_pred = np.array(img_pred).astype(np.float32)/255.
-        img_gt = np.array(img_gt).astype(np.float32)/255.
-
-        assert img_pred.shape == img_gt.shape, "Image shapes should be the same."
-        if mask is not None:
-            mask = np.array(mask).astype(np.float32)
-            img_pred = img_pred * mask
-            img_gt = img_gt * mask
-        
-        difference = img_pred - img_gt
-        difference_square = difference ** 2
-        difference_square_sum = difference_square.sum()
-        difference_size = mask.sum()
-
-        mse = difference_square_sum/difference_size
-
-        if mse < 1.0e-10:
-            return 1000
-        PIXEL_MAX = 1
-        return 20 * math.log10(PIXEL_MAX / math.sqrt(mse))
-
-    
-    def calculate_lpips(self, img_gt, img_pred, mask=None):
-        img_pred = np.array(img_pred).astype(np.float32)/255
-        img_gt = np.array(img_gt).astype(np.float32)/255
-        assert img_pred.shape == img_gt.shape, "Image shapes should be the same."
-
-        if mask is not None:
-            mask = np.array(mask).astype(np.float32)
-            img_pred = img_pred * mask 
-            img_gt = img_gt * mask
-            
-        img_pred_tensor=torch.tensor(img_pred).permute(2,0,1).unsqueeze(0).to(self.device)
-        img_gt_tensor=torch.tensor(img_gt).permute(2,0,1).unsqueeze(0).to(self.device)
-            
-        score =  self.lpips_metric_calculator(img_pred_tensor*2-1,img_gt_tensor*2-1)
-        score = score.cpu().item()
-        
-        return score
-    
-    def calculate_mse(self, img_pred, img_gt, mask=None):
-        img_pred = np.array(img_pred).astype(np.float32)/255.
-        img_gt = np.array(img_gt).astype(np.float32)/255.
-
-        assert img_pred.shape == img_gt.shape, "Image shapes should be the same."
-        if mask is not None:
-            mask = np.array(mask).astype(np.float32)
-            img_pred = img_pred * mask
-            img_gt = img_gt * mask
-        
-        difference = img_pred - img_gt
-        difference_square = difference ** 2
-        difference_square_sum = difference_square.sum()
-        difference_size = mask.sum()
-
-        mse = difference_square_sum/difference_size
-
-        return mse.item()
-    
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--brushnet_ckpt_path', 
-                    type=str, 
-                    default="data/ckpt/segmentation_mask_brushnet_ckpt")
-parser.add_argument('--base_model_path', 
-                    type=str, 
-                    default="runwayml/stable-diffusion-v1-5")
-parser.add_argument('--image_save_path', 
-                    type=str, 
-                    default="runs/evaluation_result/BrushBench/brushnet_segmask/inside")
-parser.add_argument('--mapping_file', 
-                    type=str, 
-                    default="data/BrushBench/mapping_file.json")
-parser.add_argument('--base_dir', 
-                    type=str, 
-                    default="data/BrushBench")
-parser.add_argument('--mask_key', 
-                    type=str, 
-                    default="inpainting_mask")
-parser.add_argument('--blended', action='store_true')
-parser.add_argument('--paintingnet_conditioning_scale', type=float,default=1.0)
-
-args = parser.parse_args()
-
-device = "cuda" if torch.cuda.is_available() else "cpu"
-
-base_model_path = args.base_model_path
-brushnet_path = args.brushnet_ckpt_path
-
-brushnet = BrushNetModel.from_pretrained(brushnet_path, torch_dtype=torch.float16).to(device)
-pipe = StableDiffusionBrushNetPipeline.from_pretrained(
-    base_model_path, brushnet=brushnet, torch_dtype=torch.float16,low_cpu_mem_usage=False
-)
-
-# speed up diffusion process with faster scheduler and memory optimization
-pipe.scheduler = UniPCMultistepScheduler.from_config(pipe.scheduler.config)
-# remove following line if xformers is not installed or when using Torch 2.0.
-# pipe.enable_xformers_memory_efficient_attention()
-# memory optimization.
-pipe.enable_model_cpu_offload()
-
-with open(args.mapping_file,"r") as f:
-    mapping_file=json.load(f)
-
-for key, item in mapping_file.items():
-    print(f"generating image {key} ...")
-    image_path=item["image"]
-    mask=item[args.mask_key]
-    caption=item["caption"]
-   
-    init_image = cv2.imread(os.path.join(args.base_dir,image_path))[:,:,::-1]
-    mask_image = rle2mask(mask,(512,512))[:,:,np.newaxis]
-    init_image = init_image * (1-mask_image)
-
-    init_image = Image.fromarray(init_image).convert("RGB")
-    mask_image = Image.fromarray(mask_image.repeat(3,-1)*255).convert("RGB")
-
-    generator = torch.Generator(device).manual_seed(1234)
-
-    save_path= os.path.join(args.image_save_path,image_path) 
-    masked_image_save_path=save_path.replace(".jpg","_masked.jpg")
-
-    if os.path.exists(save_path) and os.path.exists(masked_image_save_path):
-        print(f"image {key} exitst! skip...")
-        continue
-
-    image = pipe(
-        caption, 
-        init_image, 
-        mask_image, 
-        num_inference_steps=50, 
-        generator=generator,
-        paintingnet_conditioning_scale=args.paintingnet_conditioning_scale
-    ).images[0]
-    
-    if not os.path.exists(os.path.dirname(save_path)):
-        os.makedirs(os.path.dirname(save_path))
-
-    if args.blended:
-        mask_np=rle2mask(mask,(512,512))[:,:,np.newaxis]
-        image_np=np.array(image)
-        init_image_np=cv2.imread(os.path.join(args.base_dir,image_path))[:,:,::-1]
-
-        # blur
-        mask_blurred = cv2.GaussianBlur(mask_np*255, (21, 21), 0)/255
-        mask_blurred = mask_blurred[:,:,np.newaxis]
-        mask_np = 1-(1-mask_np) * (1-mask_blurred)
-
-        image_pasted=init_image_np * (1-mask_np) + image_np*mask_np
-        image_pasted=image_pasted.astype(image_np.dtype)
-        image=Image.fromarray(image_pasted)
-
-    image.save(save_path)
-    init_image.save(masked_image_save_path)
-
-# evaluation
-evaluation_df = pd.DataFrame(columns=['Image ID','Image Reward', 'HPS V2.1', 'Aesthetic Score', 'PSNR', 'LPIPS', 'MSE', 'CLIP Similarity'])
-
-metrics_calculator=MetricsCalculator(device)
-
-for key, item in mapping_file.items():
-    print(f"evaluating image {key} ...")
-    image_path=item["image"]
-    mask=item[args.mask_key]
-    prompt=item["caption"]
-
-    src_image_path = os.path.join(args.base_dir, image_path)
-    src_image = Image.open(src_image_path).resize((512,512))
-
-    tgt_image_path=os.path.join(args.image_save_path, image_path)
-    tgt_image = Image.open(tgt_image_path).resize((512,512))
-
-    evaluation_result=[key]
-        
-    mask = rle2mask(mask,(512,512))
-    mask = 1 - mask[:,:,np.newaxis]
-
-    for metric in evaluation_df.columns.values.tolist()[1:]:
-        print(f"evluating metric: {metric}")
-
-        if metric == 'Image Reward':
-            metric_result = metrics_calculator.calculate_image_reward(tgt_image,prompt)
-            
-        if metric == 'HPS V2.1':
-            metric_result = metrics_calculator.calculate_hpsv21_score(tgt_image,prompt)
-        
-        if metric == 'Aesthetic Score':
-            metric_result = metrics_calculator.calculate_aesthetic_score(tgt_image)
-        
-        if metric == 'PSNR':
-            metric_result = metrics_calculator.calculate_psnr(src_image, tgt_image, mask)
-        
-        if metric == 'LPIPS':
-            metric_result = metrics_calculator.calculate_lpips(src_image, tgt_image, mask)
-        
-        if metric == 'MSE':
-            metric_result = metrics_calculator.calculate_mse(src_image, tgt_image, mask)
-        
-        if metric == 'CLIP Similarity':
-            metric_result = metrics_calculator.calculate_clip_similarity(tgt_image, prompt)
-
-        evaluation_result.append(metric_result)
-    
-    evaluation_df.loc[len(evaluation_df.index)] = evaluation_result
-
-print("The averaged evaluation result:")
-averaged_results=evaluation_df.mean(numeric_only=True)
-print(averaged_results)
-averaged_results.to_csv(os.path.join(args.image_save_path,"evaluation_result_sum.csv"))
-evaluation_df.to_csv(os.path.join(args.image_save_path,"evaluation_result.csv"))
-
-print(f"The generated images and evaluation results is saved in {args.image_save_path}")
\ No newline at end of file
+from accelerate import PartialState
+from brushbench_metrics import METRIC_NAMES, METRIC_VERSIONS, BatchedMetricsCalculator, load_images
+from mask_rle import rle_decode
+from metric_cache import MetricCache, content_hash
+
+
+def parse_args(input_args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--brushnet_ckpt_path',
+                        type=str,
+                        default="data/ckpt/segmentation_mask_brushnet_ckpt")
+    parser.add_argument('--base_model_path',
+                        type=str,
+                        default="runwayml/stable-diffusion-v1-5")
+    parser.add_argument('--image_save_path',
+                        type=str,
+                        default="runs/evaluation_result/BrushBench/brushnet_segmask/inside")
+    parser.add_argument('--mapping_file',
+                        type=str,
+                        default="data/BrushBench/mapping_file.json")
+    parser.add_argument('--base_dir',
+                        type=str,
+                        default="data/BrushBench")
+    parser.add_argument('--mask_key',
+                        type=str,
+                        default="inpainting_mask")
+    parser.add_argument('--blended', action='store_true')
+    parser.add_argument('--paintingnet_conditioning_scale', type=float,default=1.0)
+    parser.add_argument('--metrics_batch_size', type=int, default=16)
+    parser.add_argument('--generation_batch_size',
+                        type=int,
+                        default=1,
+                        help=("The number of images of the same resolution generated by one pipeline call, at most"
+                              " `--metrics_batch_size`. Every image keeps its own seeded generator."))
+    parser.add_argument('--num_shards',
+                        type=int,
+                        default=None,
+                        help=("The number of shards the images are split into. Defaults to the number of processes"
+                              " started by `accelerate launch`."))
+    parser.add_argument('--shard_index',
+                        type=int,
+                        default=None,
+                        help="The shard this process generates and scores. Defaults to the process index.")
+    parser.add_argument('--enable_model_cpu_offload', action='store_true')
+    parser.add_argument('--metric_cache_path',
+                        type=str,
+                        default="runs/evaluation_result/metric_cache.sqlite",
+                        help=("The cache of metric scores keyed by image content, shared by all the evaluations so"
+                              " only the scores of new images are computed. See `metric_cache.py` to query or prune"
+                              " it."))
+    parser.add_argument('--disable_metric_cache', action='store_true')
+    parser.add_argument('--metric_assets_dir',
+                        type=str,
+                        default="data/ckpt/metric_assets",
+                        help="The checksum-verified local cache of the metric model weights, see `metric_assets.py`.")
+    parser.add_argument('--offline',
+                        action='store_true',
+                        help="Only use the metric model weights in `--metric_assets_dir`, never download them.")
+    parser.add_argument('--merge_only',
+                        action='store_true',
+                        help="Only merge the per-image results of all the shards into the evaluation csv files.")
+
+    args = parser.parse_args(input_args)
+    if args.generation_batch_size < 1:
+        raise ValueError("`--generation_batch_size` must be at least 1.")
+    if (args.num_shards is None) != (args.shard_index is None):
+        raise ValueError("`--num_shards` and `--shard_index` must be set together.")
+    if args.num_shards is not None and not 0 <= args.shard_index < args.num_shards:
+        raise ValueError("`--shard_index` must be in the range [0, `--num_shards`).")
+    return args
+
+
+def shard_keys(keys, num_shards, shard_index):
+    # interleaved, so every shard gets a similar mix of the BrushBench categories
+    return keys[shard_index::num_shards]
+
+
+def results_path(image_save_path, num_shards, shard_index):
+    return os.path.join(image_save_path, f"evaluation_results-{shard_index:05d}-of-{num_shards:05d}.jsonl")
+
+
+def read_results(image_save_path):
+    """
+    Reads the per-image results of every shard in `image_save_path`, keyed by image id.
+    """
+    results = {}
+    for path in sorted(glob.glob(os.path.join(image_save_path, "evaluation_results-*.jsonl"))):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line of an interrupted run
+                    continue
+                results[record["Image ID"]] = record
+    return results
+
+
+def append_results(path, records):
+    """
+    Appends `records` to the results file at `path`, one JSON line each, and syncs them to disk.
+    """
+    with open(path, "a+b") as f:
+        prefix = b""
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            # start a new line after a line cut short by an interrupted run
+            prefix = b"" if f.read(1) == b"\n" else b"\n"
+        f.write(prefix + b"".join(json.dumps(record).encode() + b"\n" for record in records))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def merge_results(mapping_file, image_save_path):
+    """
+    Writes `evaluation_result.csv` and `evaluation_result_sum.csv` from the results of all the shards, once every
+    image of `mapping_file` has been scored. Returns whether they were written.
+    """
+    results = read_results(image_save_path)
+    missing = [key for key in mapping_file if key not in results]
+    if len(missing) > 0:
+        print(f"{len(missing)} images are not scored yet, run with `--merge_only` once all the shards are done.")
+        return False
+
+    evaluation_df = pd.DataFrame(
+        [[key]+[results[key][metric] for metric in METRIC_NAMES] for key in mapping_file],
+        columns=['Image ID']+METRIC_NAMES,
+    )
+    print("The averaged evaluation result:")
+    averaged_results=evaluation_df.mean(numeric_only=True)
+    print(averaged_results)
+    averaged_results.to_csv(os.path.join(image_save_path,"evaluation_result_sum.csv"))
+    evaluation_df.to_csv(os.path.join(image_save_path,"evaluation_result.csv"))
+    return True
+
+
+def generate_batch(pipe, batch, args, device):
+    captions, init_images, mask_images, save_paths = zip(*batch)
+
+    images = pipe(
+        list(captions),
+        list(init_images),
+        list(mask_images),
+        num_inference_steps=50,
+        # the seed of every image is the same as when it is generated on its own
+        generator=[torch.Generator(device).manual_seed(1234) for _ in batch],
+        paintingnet_conditioning_scale=args.paintingnet_conditioning_scale,
+        blended=args.blended,
+    ).images
+
+    for image, init_image, save_path in zip(images, init_images, save_paths):
+        if not os.path.exists(os.path.dirname(save_path)):
+            os.makedirs(os.path.dirname(save_path), exist_ok=True)
+
+        image.save(save_path)
+        init_image.save(save_path.replace(".jpg","_masked.jpg"))
+
+
+def generate_images(pipe, items, args, device):
+    """
+    Generates the images of `items` that do not exist yet, in batches of up to `--generation_batch_size` images of the
+    same resolution. Returns the number of generated images.
+    """
+    batches = {}
+    num_generated = 0
+    for item in items:
+        image_path=item["image"]
+        mask=item[args.mask_key]
+        caption=item["caption"]
+
+        save_path= os.path.join(args.image_save_path,image_path)
+        masked_image_save_path=save_path.replace(".jpg","_masked.jpg")
+
+        if os.path.exists(save_path) and os.path.exists(masked_image_save_path):
+            print(f"image {image_path} exitst! skip...")
+            continue
+
+        init_image = cv2.imread(os.path.join(args.base_dir,image_path))[:,:,::-1]
+        mask_image = rle_decode(mask,(512,512),order="C")[:,:,np.newaxis]
+        init_image = init_image * (1-mask_image)
+
+        init_image = Image.fromarray(init_image).convert("RGB")
+        mask_image = Image.fromarray(mask_image.repeat(3,-1)*255).convert("RGB")
+
+        batch = batches.setdefault(init_image.size, [])
+        batch.append((caption, init_image, mask_image, save_path))
+        if len(batch) == args.generation_batch_size:
+            generate_batch(pipe, batches.pop(init_image.size), args, device)
+            num_generated += args.generation_batch_size
+
+    for batch in batches.values():
+        generate_batch(pipe, batch, args, device)
+        num_generated += len(batch)
+    return num_generated
+
+
+def score_images(metrics_calculator, mapping_file, keys, args, metric_cache=None):
+    items=[mapping_file[key] for key in keys]
+
+    # every image is decoded once for all the metrics
+    src_images = load_images([os.path.join(args.base_dir, item["image"]) for item in items])
+    tgt_images = load_images([os.path.join(args.image_save_path, item["image"]) for item in items])
+    masks = np.stack([1 - rle_decode(item[args.mask_key],(512,512),order="C") for item in items])
+    masks = torch.from_numpy(masks)[:,None]
+    prompts = [item["caption"] for item in items]
+
+    scores = [{} for _ in keys]
+    if metric_cache is not None:
+        # the scores are cached under the content they are computed from, not the image ids
+        hashes = [
+            (content_hash(tgt.numpy()), content_hash(src.numpy()), content_hash(mask.numpy()), content_hash(prompt))
+            for tgt, src, mask, prompt in zip(tgt_images, src_images, masks, prompts)
+        ]
+        entries = [(i, metric) for i in range(len(keys)) for metric in METRIC_NAMES]
+        values = metric_cache.get([(*hashes[i], metric, METRIC_VERSIONS[metric]) for i, metric in entries])
+        for (i, metric), value in zip(entries, values):
+            if value is not None:
+                scores[i][metric] = value
+
+    missing = [i for i in range(len(keys)) if len(scores[i]) < len(METRIC_NAMES)]
+    if len(missing) > 0:
+        missing_metrics = [metric for metric in METRIC_NAMES if any(metric not in scores[i] for i in missing)]
+        computed = metrics_calculator(
+            tgt_images[missing],
+            src_images[missing],
+            masks[missing],
+            [prompts[i] for i in missing],
+            metrics=missing_metrics,
+        )
+        for j, i in enumerate(missing):
+            for metric in missing_metrics:
+                scores[i][metric] = float(computed[metric][j])
+        if metric_cache is not None:
+            metric_cache.put(
+                [(*hashes[i], metric, METRIC_VERSIONS[metric]) for i in missing for metric in missing_metrics],
+                [scores[i][metric] for i in missing for metric in missing_metrics],
+            )
+
+    return [
+        {"Image ID": key, **{metric: scores[i][metric] for metric in METRIC_NAMES}}
+        for i, key in enumerate(keys)
+    ]
+
+
+def main(args):
+    state = PartialState()
+    device = state.device
+    num_shards = args.num_shards if args.num_shards is not None else state.num_processes
+    shard_index = args.shard_index if args.shard_index is not None else state.process_index
+
+    with open(args.mapping_file,"r") as f:
+        mapping_file=json.load(f)
+
+    if args.merge_only:
+        if state.is_main_process:
+            merge_results(mapping_file, args.image_save_path)
+        return
+
+    os.makedirs(args.image_save_path, exist_ok=True)
+    # the per-image results of previous runs are kept, only the missing images are generated and scored
+    scored = read_results(args.image_save_path)
+    keys = [key for key in shard_keys(list(mapping_file.keys()), num_shards, shard_index) if key not in scored]
+    print(f"shard {shard_index}/{num_shards}: {len(keys)} images to generate and score")
+
+    if len(keys) > 0:
+        base_model_path = args.base_model_path
+        brushnet_path = args.brushnet_ckpt_path
+
+        brushnet = BrushNetModel.from_pretrained(brushnet_path, torch_dtype=torch.float16)
+        pipe = StableDiffusionBrushNetPipeline.from_pretrained(
+            base_model_path, brushnet=brushnet, torch_dtype=torch.float16,low_cpu_mem_usage=False
+        )
+
+        # speed up diffusion process with faster scheduler and memory optimization
+        pipe.scheduler = UniPCMultistepScheduler.from_config(pipe.scheduler.config)
+        # remove following line if xformers is not installed or when using Torch 2.0.
+        # pipe.enable_xformers_memory_efficient_attention()
+        if args.enable_model_cpu_offload:
+            # memory optimization.
+            pipe.enable_model_cpu_offload(device=device)
+        else:
+            pipe.to(device)
+
+        metrics_calculator=BatchedMetricsCalculator(device, ckpt_path=args.metric_assets_dir, offline=args.offline)
+        # the weights are downloaded and verified once per machine, before any process loads them
+        with state.local_main_process_first():
+            metrics_calculator.assets.fetch(metrics_calculator.metrics)
+        metric_cache = None
+        if not args.disable_metric_cache:
+            os.makedirs(os.path.dirname(os.path.abspath(args.metric_cache_path)), exist_ok=True)
+            metric_cache = MetricCache(args.metric_cache_path)
+        output_path = results_path(args.image_save_path, num_shards, shard_index)
+
+        # batch N is scored in this thread, on its own stream, while batch N+1 is generated
+        pending = queue.Queue(maxsize=2)
+        errors = []
+
+        def score_worker():
+            if device.type == "cuda":
+                stream = torch.cuda.stream(torch.cuda.Stream(device))
+            else:
+                stream = contextlib.nullcontext()
+            while True:
+                batch_keys = pending.get()
+                if batch_keys is None:
+                    return
+                try:
+                    with stream:
+                        print(f"evaluating images {batch_keys[0]} to {batch_keys[-1]} ...")
+                        records = score_images(metrics_calculator, mapping_file, batch_keys, args, metric_cache)
+                        append_results(output_path, records)
+                except BaseException as e:
+                    errors.append(e)
+                    return
+
+        scorer = threading.Thread(target=score_worker)
+        scorer.start()
+        num_generated, generation_time = 0, 0.0
+        try:
+            for start in range(0, len(keys), args.metrics_batch_size):
+                batch_keys = keys[start:start+args.metrics_batch_size]
+                print(f"generating images {batch_keys[0]} to {batch_keys[-1]} ...")
+                start_time = time.perf_counter()
+                num_generated += generate_images(pipe, [mapping_file[key] for key in batch_keys], args, device)
+                generation_time += time.perf_counter() - start_time
+                while scorer.is_alive() and len(errors) == 0:
+                    try:
+                        pending.put(batch_keys, timeout=1)
+                        break
+                    except queue.Full:
+                        continue
+                if len(errors) > 0:
+                    break
+        finally:
+            if scorer.is_alive():
+                pending.put(None)
+            scorer.join()
+            if metric_cache is not None:
+                metric_cache.close()
+        if len(errors) > 0:
+            raise errors[0]
+        if num_generated > 0:
+            print(
+                f"{device}: generated {num_generated} images in {generation_time:.1f}s,"
+                f" {num_generated / generation_time:.2f} images/s"
+            )
+
+    state.wait_for_everyone()
+    if state.is_main_process:
+        merge_results(mapping_file, args.image_save_path)
+    print(f"The generated images and evaluation results is saved in {args.image_save_path}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
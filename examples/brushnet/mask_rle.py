@@ -0,0 +1,119 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run-length encoding of binary masks, shared by the BrushNet training and evaluation scripts.
+
+A mask is encoded as a flat list `[start_1, length_1, start_2, length_2, ...]` of 1-based run starts over the flattened
+mask. BrushData flattens masks in column-major (`"F"`) order, BrushBench in row-major (`"C"`) order.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+def rle_encode(mask, order="F"):
+    """
+    Encodes the non-zero pixels of a 2D `mask` as a list of 1-based `[start, length, ...]` runs.
+    """
+    flat = np.asarray(mask).flatten(order=order) > 0
+    boundaries = np.flatnonzero(np.diff(np.concatenate([[False], flat, [False]])))
+    starts, ends = boundaries[::2], boundaries[1::2]
+    return np.stack([starts + 1, ends - starts], axis=1).flatten().tolist()
+
+
+def rle_decode(mask_rle, shape, order="F", out_shape=None, crop=None):
+    """
+    Decodes `[start, length, ...]` runs into a `uint8` mask.
+
+    Args:
+        mask_rle (`list` or `np.ndarray`):
+            The 1-based run starts and lengths.
+        shape (`Tuple[int, int]`):
+            The `(height, width)` of the encoded mask.
+        order (`str`, defaults to `"F"`):
+            The order the mask was flattened in, `"F"` for column-major and `"C"` for row-major.
+        out_shape (`Tuple[int, int]`, *optional*):
+            The `(height, width)` of the returned mask. Every output pixel is sampled at its center, so the mask is
+            never materialized at `shape` when `out_shape` is smaller. Defaults to the size of the decoded region.
+        crop (`Tuple[int, int, int, int]`, *optional*):
+            A `(top, left, height, width)` region of the encoded mask to decode, in the (possibly fractional)
+            coordinates of `shape`.
+    """
+    mask_rle = np.asarray(mask_rle, dtype=np.int64)
+    starts = mask_rle[0::2] - 1
+    ends = starts + mask_rle[1::2]
+    top, left, height, width = crop if crop is not None else (0, 0, shape[0], shape[1])
+    out_shape = tuple(out_shape) if out_shape is not None else (height, width)
+
+    if crop is None and out_shape == tuple(shape):
+        # expand the alternating background gaps and runs in one pass
+        gaps = starts - np.concatenate([[0], ends[:-1]])
+        counts = np.stack([gaps, ends - starts], axis=1).flatten()
+        counts = np.append(counts, shape[0] * shape[1] - (ends[-1] if len(ends) else 0))
+        values = np.arange(len(counts), dtype=np.uint8) % 2
+        return np.repeat(values, counts).reshape(shape, order=order)
+
+    rows = (top + (np.arange(out_shape[0]) + 0.5) * height / out_shape[0]).astype(np.int64)
+    cols = (left + (np.arange(out_shape[1]) + 0.5) * width / out_shape[1]).astype(np.int64)
+    if order == "F":
+        positions = cols[np.newaxis, :] * shape[0] + rows[:, np.newaxis]
+    else:
+        positions = rows[:, np.newaxis] * shape[1] + cols[np.newaxis, :]
+    # a pixel is set if the last run starting at or before it has not ended yet
+    runs = np.searchsorted(starts, positions, side="right") - 1
+    return ((runs >= 0) & (positions < ends[np.maximum(runs, 0)])).astype(np.uint8)
+
+
+class RLEMaskCache:
+    """
+    A least recently used cache of decoded masks, stored bit-packed to keep ~8x as many masks in the same memory.
+
+    Args:
+        max_bytes (`int`):
+            The maximum size of the packed masks held by the cache.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def decode(self, key, mask_rle, shape, order="F", out_shape=None):
+        """
+        Returns `rle_decode(mask_rle, shape, order, out_shape)`, reusing the mask cached under `key` and `out_shape`.
+        """
+        key = (key, None if out_shape is None else tuple(out_shape))
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            packed, mask_shape = self._entries[key]
+            return np.unpackbits(packed, count=mask_shape[0] * mask_shape[1]).reshape(mask_shape)
+
+        self.misses += 1
+        mask = rle_decode(mask_rle, shape, order=order, out_shape=out_shape)
+        packed = np.packbits(mask)
+        if packed.nbytes <= self.max_bytes:
+            self._entries[key] = (packed, mask.shape)
+            self.num_bytes += packed.nbytes
+            while self.num_bytes > self.max_bytes:
+                evicted, _ = self._entries.popitem(last=False)[1]
+                self.num_bytes -= evicted.nbytes
+        return mask
@@ -0,0 +1,234 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local, checksum-verified cache of the weights behind the BrushBench metrics.
+
+Every asset is downloaded once into the cache directory, and the SHA-256 of each of its files is recorded in the
+`assets.json` manifest next to them. Later runs only read the local files, which are hashed again whenever their size
+or modification time changed. In offline mode nothing is downloaded, and a missing asset is an error. Fill a cache on a
+machine with internet access and copy it, manifest included, to the evaluation nodes:
+
+    python metric_assets.py --cache_dir data/ckpt/metric_assets download
+    python metric_assets.py --cache_dir data/ckpt/metric_assets verify
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from urllib.request import urlretrieve
+
+
+# the files of every asset, downloaded from a URL or from a Hugging Face Hub repository
+ASSETS = {
+    "clip-vit-large-patch14": {
+        "repo_id": "openai/clip-vit-large-patch14",
+        "files": [
+            "config.json",
+            "model.safetensors",
+            "merges.txt",
+            "vocab.json",
+            "special_tokens_map.json",
+            "tokenizer_config.json",
+            "tokenizer.json",
+        ],
+    },
+    "aesthetic-predictor": {
+        "urls": {
+            "sa_0_4_vit_l_14_linear.pth": (
+                "https://github.com/LAION-AI/aesthetic-predictor/blob/main/sa_0_4_vit_l_14_linear.pth?raw=true"
+            ),
+        },
+    },
+    "squeezenet1_1": {
+        # laid out as a torch hub directory, the torchvision backbone of LPIPS loads it from there
+        "urls": {
+            "checkpoints/squeezenet1_1-b8a52dc0.pth": "https://download.pytorch.org/models/squeezenet1_1-b8a52dc0.pth",
+        },
+    },
+    "ImageReward-v1.0": {
+        "repo_id": "THUDM/ImageReward",
+        "files": ["ImageReward.pt", "med_config.json"],
+    },
+    "bert-base-uncased": {
+        # ImageReward loads this tokenizer by name, so it is kept in the Hugging Face cache and only verified here
+        "repo_id": "bert-base-uncased",
+        "files": ["config.json", "vocab.txt", "tokenizer_config.json", "tokenizer.json"],
+        "hf_cache": True,
+    },
+    "HPS_v2.1": {
+        "repo_id": "xswu/HPSv2",
+        "files": ["HPS_v2.1_compressed.pt"],
+    },
+}
+
+# the assets every metric is computed with
+METRIC_ASSETS = {
+    "Image Reward": ["ImageReward-v1.0", "bert-base-uncased"],
+    "HPS V2.1": ["HPS_v2.1"],
+    "Aesthetic Score": ["clip-vit-large-patch14", "aesthetic-predictor"],
+    "PSNR": [],
+    "LPIPS": ["squeezenet1_1"],
+    "MSE": [],
+    "CLIP Similarity": ["clip-vit-large-patch14"],
+}
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MetricAssets:
+    r"""
+    Resolves the assets of `ASSETS` to verified local files, see the module docstring.
+
+    Args:
+        cache_dir (`str`):
+            The directory the assets and their `assets.json` manifest are stored in.
+        offline (`bool`, defaults to `False`):
+            Never download an asset. Also enabled by the `HF_HUB_OFFLINE` environment variable.
+    """
+
+    def __init__(self, cache_dir, offline=False):
+        self.cache_dir = cache_dir
+        self.offline = offline or os.environ.get("HF_HUB_OFFLINE", "0").upper() in ("1", "ON", "YES", "TRUE")
+        self.manifest_path = os.path.join(cache_dir, "assets.json")
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _local_path(self, name, filename):
+        asset = ASSETS[name]
+        if asset.get("hf_cache", False):
+            import huggingface_hub
+
+            path = huggingface_hub.try_to_load_from_cache(asset["repo_id"], filename)
+            return path if isinstance(path, str) else None
+        path = os.path.join(self.cache_dir, name, filename)
+        return path if os.path.exists(path) else None
+
+    def _download(self, name, filename):
+        asset = ASSETS[name]
+        print(f"downloading {name}/{filename} ...")
+        if "urls" in asset:
+            path = os.path.join(self.cache_dir, name, filename)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # downloaded next to the final path, so an interrupted download is never taken for the asset
+            urlretrieve(asset["urls"][filename], f"{path}.{os.getpid()}.tmp")
+            os.replace(f"{path}.{os.getpid()}.tmp", path)
+            return path
+
+        import huggingface_hub
+
+        if asset.get("hf_cache", False):
+            return huggingface_hub.hf_hub_download(asset["repo_id"], filename)
+        return huggingface_hub.hf_hub_download(
+            asset["repo_id"],
+            filename,
+            local_dir=os.path.join(self.cache_dir, name),
+            local_dir_use_symlinks=False,
+        )
+
+    def resolve(self, name, full_check=False):
+        """
+        Returns the local paths of the files of the asset `name`, keyed by file name, downloading the missing ones
+        unless offline. Files whose size or modification time changed since they were recorded, or all of them with
+        `full_check`, are hashed and compared to the manifest.
+        """
+        asset = ASSETS[name]
+        filenames = asset["files"] if "files" in asset else list(asset["urls"])
+        manifest = self._read_manifest()
+        records = manifest.setdefault(name, {})
+        updated = False
+        paths = {}
+        for filename in filenames:
+            path = self._local_path(name, filename)
+            if path is None:
+                if self.offline:
+                    location = "the Hugging Face cache" if asset.get("hf_cache", False) else self.cache_dir
+                    raise FileNotFoundError(
+                        f"The metric asset {name}/{filename} is not in {location} and downloads are disabled. Run"
+                        f" `python metric_assets.py --cache_dir {self.cache_dir} download` on a machine with internet"
+                        f" access and copy {location}."
+                    )
+                path = self._download(name, filename)
+                records.pop(filename, None)
+
+            stat = os.stat(path)
+            record = records.get(filename)
+            if record is None:
+                records[filename] = {"sha256": file_sha256(path), "size": stat.st_size, "mtime": stat.st_mtime}
+                updated = True
+            elif full_check or (record["size"], record["mtime"]) != (stat.st_size, stat.st_mtime):
+                if file_sha256(path) != record["sha256"]:
+                    raise ValueError(
+                        f"The checksum of the metric asset {path} does not match {self.manifest_path}, delete the file"
+                        " to download it again."
+                    )
+                record["size"], record["mtime"] = stat.st_size, stat.st_mtime
+                updated = True
+            paths[filename] = path
+
+        if updated:
+            self._write_manifest(manifest)
+        return paths
+
+    def fetch(self, metrics, full_check=False):
+        """
+        Resolves all the assets of `metrics`, without loading them.
+        """
+        for name in dict.fromkeys(name for metric in metrics for name in METRIC_ASSETS[metric]):
+            self.resolve(name, full_check=full_check)
+
+
+def parse_args(input_args=None):
+    parser = argparse.ArgumentParser(description="Download or verify the weights of the BrushBench metrics.")
+    parser.add_argument("--cache_dir", type=str, default="data/ckpt/metric_assets")
+    parser.add_argument(
+        "--metrics", type=str, nargs="+", default=list(METRIC_ASSETS), help="The metrics whose assets are handled."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("download", help="Download the missing assets and record their checksums.")
+    subparsers.add_parser("verify", help="Hash every asset again and compare it to the recorded checksum.")
+
+    args = parser.parse_args(input_args)
+    unknown_metrics = [metric for metric in args.metrics if metric not in METRIC_ASSETS]
+    if len(unknown_metrics) > 0:
+        raise ValueError(f"Unknown metrics {unknown_metrics}, choose from {list(METRIC_ASSETS)}.")
+    return args
+
+
+def main(args):
+    assets = MetricAssets(args.cache_dir, offline=args.command == "verify")
+    assets.fetch(args.metrics, full_check=args.command == "verify")
+    print(f"the assets of {', '.join(args.metrics)} are in {args.cache_dir}")
+
+
+if __name__ == "__main__":
+    main(parse_args())
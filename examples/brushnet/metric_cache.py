@@ -0,0 +1,194 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A content-addressed cache of BrushBench metric scores.
+
+A score is stored under the hashes of the pixels it was computed from (the generated image, the source image and the
+mask), the hash of the caption, the metric name and the version of the metric model, so it is reused by any run that
+scores the same content, whatever checkpoint or output directory it comes from. The cache is a SQLite database that
+several evaluation processes can share.
+
+Query or prune it with:
+
+    python metric_cache.py --cache_path runs/evaluation_result/metric_cache.sqlite query
+    python metric_cache.py --cache_path runs/evaluation_result/metric_cache.sqlite prune --stale_versions
+"""
+
+import argparse
+import hashlib
+import sqlite3
+import time
+
+import numpy as np
+
+
+def content_hash(data):
+    """
+    The SHA-256 of an array (with its shape and dtype) or of a string.
+    """
+    if isinstance(data, str):
+        return hashlib.sha256(data.encode()).hexdigest()
+    data = np.ascontiguousarray(data)
+    digest = hashlib.sha256(f"{data.dtype.str}{data.shape}".encode())
+    digest.update(data.tobytes())
+    return digest.hexdigest()
+
+
+class MetricCache:
+    r"""
+    Scores stored by content, see the module docstring.
+
+    Args:
+        path (`str`):
+            The SQLite database file, created if it does not exist.
+        timeout (`float`, defaults to 60):
+            How long to wait, in seconds, for another process writing to the cache.
+    """
+
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        # scores are looked up and stored by the scoring thread of `evaluate_brushnet.py`
+        self.connection = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS scores ("
+            "output_hash TEXT, source_hash TEXT, mask_hash TEXT, prompt_hash TEXT, metric TEXT, version TEXT, "
+            "value REAL, created REAL, last_used REAL, "
+            "PRIMARY KEY (output_hash, source_hash, mask_hash, prompt_hash, metric, version))"
+        )
+        self.connection.commit()
+
+    def get(self, keys):
+        """
+        Looks up `keys`, tuples of `(output_hash, source_hash, mask_hash, prompt_hash, metric, version)`. Returns the
+        cached score of every key, `None` for the missing ones.
+        """
+        values = []
+        for key in keys:
+            row = self.connection.execute(
+                "SELECT value FROM scores WHERE output_hash=? AND source_hash=? AND mask_hash=? AND prompt_hash=? "
+                "AND metric=? AND version=?",
+                key,
+            ).fetchone()
+            values.append(None if row is None else row[0])
+        hits = [key for key, value in zip(keys, values) if value is not None]
+        if len(hits) > 0:
+            now = time.time()
+            self.connection.executemany(
+                "UPDATE scores SET last_used=? WHERE output_hash=? AND source_hash=? AND mask_hash=? "
+                "AND prompt_hash=? AND metric=? AND version=?",
+                [(now, *key) for key in hits],
+            )
+            self.connection.commit()
+        return values
+
+    def put(self, keys, values):
+        """
+        Stores the score `values` under `keys`, see `get`.
+        """
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(*key, float(value), now, now) for key, value in zip(keys, values)],
+        )
+        self.connection.commit()
+
+    def stats(self, output_hash=None):
+        """
+        The number of scores and the time they were last used, per metric and version, optionally only for the
+        generated image with `output_hash`.
+        """
+        query = "SELECT metric, version, COUNT(*), MAX(last_used) FROM scores"
+        parameters = ()
+        if output_hash is not None:
+            query += " WHERE output_hash=?"
+            parameters = (output_hash,)
+        query += " GROUP BY metric, version ORDER BY metric, version"
+        return self.connection.execute(query, parameters).fetchall()
+
+    def prune(self, unused_for=None, keep_versions=None):
+        """
+        Deletes the scores that were not used for `unused_for` seconds, and the scores of the metrics in the
+        `keep_versions` dict whose version is not the one it maps them to. Returns the number of deleted scores.
+        """
+        num_deleted = 0
+        if unused_for is not None:
+            cursor = self.connection.execute("DELETE FROM scores WHERE last_used<?", (time.time() - unused_for,))
+            num_deleted += cursor.rowcount
+        for metric, version in (keep_versions or {}).items():
+            cursor = self.connection.execute("DELETE FROM scores WHERE metric=? AND version!=?", (metric, version))
+            num_deleted += cursor.rowcount
+        self.connection.commit()
+        return num_deleted
+
+    def close(self):
+        self.connection.close()
+
+
+def parse_args(input_args=None):
+    parser = argparse.ArgumentParser(description="Query or prune a BrushBench metric cache.")
+    parser.add_argument("--cache_path", type=str, default="runs/evaluation_result/metric_cache.sqlite")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    query_parser = subparsers.add_parser("query", help="Print the number of cached scores per metric and version.")
+    query_parser.add_argument(
+        "--image", type=str, default=None, help="Only count the scores of this generated image, and print them."
+    )
+    prune_parser = subparsers.add_parser("prune", help="Delete cached scores.")
+    prune_parser.add_argument(
+        "--unused_days", type=float, default=None, help="Delete the scores that were not used for this many days."
+    )
+    prune_parser.add_argument(
+        "--stale_versions",
+        action="store_true",
+        help="Delete the scores computed with another version of a metric model than the current one.",
+    )
+    prune_parser.add_argument("--vacuum", action="store_true", help="Shrink the database file after pruning.")
+
+    args = parser.parse_args(input_args)
+    if args.command == "prune" and args.unused_days is None and not args.stale_versions:
+        raise ValueError("`prune` needs `--unused_days` and/or `--stale_versions`.")
+    return args
+
+
+def main(args):
+    cache = MetricCache(args.cache_path)
+    if args.command == "query":
+        output_hash = None
+        if args.image is not None:
+            from brushbench_metrics import load_images
+
+            # hashed like `evaluate_brushnet.py` hashes the images it scores
+            output_hash = content_hash(load_images([args.image])[0].numpy())
+            for metric, value in cache.connection.execute(
+                "SELECT metric, value FROM scores WHERE output_hash=? ORDER BY metric", (output_hash,)
+            ):
+                print(f"{metric}: {value}")
+        for metric, version, count, last_used in cache.stats(output_hash):
+            print(f"{metric} ({version}): {count} scores, last used {time.ctime(last_used)}")
+    else:
+        keep_versions = None
+        if args.stale_versions:
+            from brushbench_metrics import METRIC_VERSIONS
+
+            keep_versions = METRIC_VERSIONS
+        unused_for = args.unused_days * 24 * 3600 if args.unused_days is not None else None
+        print(f"deleted {cache.prune(unused_for=unused_for, keep_versions=keep_versions)} scores")
+        if args.vacuum:
+            cache.connection.execute("VACUUM")
+    cache.close()
+
+
+if __name__ == "__main__":
+    main(parse_args())
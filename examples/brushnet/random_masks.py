@@ -0,0 +1,184 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batched random brush masks, drawn on the training device.
+
+The strokes follow the distribution of `MyWebDataset.random_brush_gen` in `train_brushnet.py`. They are sampled in the
+pixel coordinates of every source image and rasterized as thick polylines at the pixel centers of its training crop, so
+the masks don't depend on the resolution the image was decoded at.
+"""
+
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def _uniform(low, high, generator):
+    return low + (high - low) * torch.rand(low.shape, generator=generator, device=low.device)
+
+
+def _randint(high, generator):
+    # integers in `[0, high)` for a tensor of upper bounds
+    return torch.floor(torch.rand(high.shape, generator=generator, device=high.device) * high)
+
+
+def random_brush_masks(
+    canvas_sizes,
+    crops,
+    out_shape,
+    device=None,
+    generator=None,
+    max_tries=4,
+    min_num_vertex=0,
+    max_num_vertex=8,
+    mean_angle=2 * math.pi / 5,
+    angle_range=2 * math.pi / 15,
+    min_width=128,
+    max_width=128,
+):
+    """
+    Draws random brush strokes for a batch of images.
+
+    Args:
+        canvas_sizes (`np.ndarray` or `torch.Tensor`):
+            The `(height, width)` of every source image, of shape `(batch_size, 2)`.
+        crops (`np.ndarray` or `torch.Tensor`):
+            The `(top, left, height, width)` region of every source image the mask is rasterized for, of shape
+            `(batch_size, 4)`.
+        out_shape (`Tuple[int, int]`):
+            The `(height, width)` of the returned masks.
+        device (`torch.device`, *optional*):
+            The device to draw the masks on.
+        generator (`torch.Generator`, *optional*):
+            A generator on `device` to make the masks deterministic.
+
+    Returns:
+        `torch.Tensor`: The masks of shape `(batch_size, 1, height, width)`, 1 inside the strokes and 0 elsewhere.
+    """
+    canvas_sizes = torch.as_tensor(canvas_sizes, dtype=torch.float32, device=device)
+    crops = torch.as_tensor(crops, dtype=torch.float32, device=device)
+    batch_size = canvas_sizes.shape[0]
+    num_strokes = max_tries - 1
+    num_segments = max_num_vertex - 1
+    H, W = canvas_sizes[:, 0, None], canvas_sizes[:, 1, None]
+    average_radius = torch.sqrt(H * H + W * W) / 8
+
+    def stroke_tensor(value):
+        return torch.full((batch_size, num_strokes), value, dtype=torch.float32, device=canvas_sizes.device)
+
+    stroke_active = torch.arange(num_strokes, device=canvas_sizes.device) < _randint(
+        torch.full((batch_size, 1), max_tries, dtype=torch.float32, device=canvas_sizes.device), generator
+    )
+    num_vertex = min_num_vertex + _randint(stroke_tensor(max_num_vertex - min_num_vertex), generator)
+    angle_min = mean_angle - _uniform(stroke_tensor(0), stroke_tensor(angle_range), generator)
+    angle_max = mean_angle + _uniform(stroke_tensor(0), stroke_tensor(angle_range), generator)
+
+    # like `random_brush_gen`, the start vertex and the clipping bounds swap the height and the width of the canvas
+    x = _randint(H.expand(-1, num_strokes), generator)
+    y = _randint(W.expand(-1, num_strokes), generator)
+    vertices = [torch.stack([x, y], -1)]
+    for i in range(num_segments):
+        angle = _uniform(angle_min, angle_max, generator)
+        if i % 2 == 0:
+            angle = 2 * math.pi - angle
+        scale = torch.floor(average_radius / 2)
+        noise = torch.randn((batch_size, num_strokes), generator=generator, device=canvas_sizes.device)
+        r = torch.minimum(torch.clamp(average_radius + scale * noise, min=0), 2 * average_radius)
+        new_x = torch.minimum(torch.clamp(x + r * torch.cos(angle), min=0), H).trunc()
+        new_y = torch.minimum(torch.clamp(y + r * torch.sin(angle), min=0), W).trunc()
+        # strokes with fewer vertices stay at their last vertex, which still draws its end cap
+        keep = i < num_vertex
+        x, y = torch.where(keep, new_x, x), torch.where(keep, new_y, y)
+        vertices.append(torch.stack([x, y], -1))
+    vertices = torch.stack(vertices, 2)
+    width = _uniform(stroke_tensor(min_width), stroke_tensor(max_width), generator).trunc()
+
+    flip = torch.rand((batch_size, 2), generator=generator, device=canvas_sizes.device) > 0.5
+    vertices[..., 0] = torch.where(flip[:, 1, None, None], W[..., None] - 1 - vertices[..., 0], vertices[..., 0])
+    vertices[..., 1] = torch.where(flip[:, 0, None, None], H[..., None] - 1 - vertices[..., 1], vertices[..., 1])
+
+    # pixel centers of the output grid in the pixel coordinates of the source image
+    steps_y = (torch.arange(out_shape[0], device=canvas_sizes.device) + 0.5) / out_shape[0]
+    steps_x = (torch.arange(out_shape[1], device=canvas_sizes.device) + 0.5) / out_shape[1]
+    grid_y = (crops[:, 0, None] + steps_y * crops[:, 2, None] - 0.5)[:, :, None]
+    grid_x = (crops[:, 1, None] + steps_x * crops[:, 3, None] - 0.5)[:, None, :]
+
+    # a pixel is inside a stroke if its squared distance to the closest segment is within the squared half width
+    masks = torch.zeros((batch_size, *out_shape), dtype=torch.bool, device=canvas_sizes.device)
+    for stroke in range(num_strokes):
+        distance = None
+        for i in range(num_segments):
+            (x0, y0), (x1, y1) = vertices[:, stroke, i].unbind(-1), vertices[:, stroke, i + 1].unbind(-1)
+            dx, dy = (x1 - x0)[:, None, None], (y1 - y0)[:, None, None]
+            px, py = grid_x - x0[:, None, None], grid_y - y0[:, None, None]
+            t = ((px * dx + py * dy) / torch.clamp(dx * dx + dy * dy, min=1e-6)).clamp(0, 1)
+            segment_distance = (px - t * dx) ** 2 + (py - t * dy) ** 2
+            distance = segment_distance if distance is None else torch.minimum(distance, segment_distance)
+        radius = (width[:, stroke] / 2)[:, None, None]
+        masks |= (distance <= radius * radius) & stroke_active[:, stroke, None, None]
+    return masks[:, None].float()
+
+
+def _morphology(masks, kernel_size, erode):
+    # `cv2.erode` / `cv2.dilate` with a square kernel anchored at its center
+    pad = (kernel_size // 2, kernel_size - 1 - kernel_size // 2)
+    if erode:
+        return -F.max_pool2d(F.pad(-masks, pad + pad, value=-1.0), kernel_size, stride=1)
+    return F.max_pool2d(F.pad(masks, pad + pad, value=0.0), kernel_size, stride=1)
+
+
+def random_brush_mask_conditioning(pixel_values, canvas_sizes, crops, generator=None, **kwargs):
+    """
+    Masks `pixel_values` with `random_brush_masks` and returns the masked images and the masks, augmented like the
+    `--random_mask` samples of `MyWebDataset`: the masks are opened with an 8 pixel kernel 30% of the time and the
+    masked region is swapped with the kept region 50% of the time.
+
+    Args:
+        pixel_values (`torch.Tensor`):
+            The images in `[-1, 1]`, of shape `(batch_size, channels, height, width)`.
+        canvas_sizes (`np.ndarray`):
+            The `(height, width)` of every source image, of shape `(batch_size, 2)`.
+        crops (`np.ndarray`):
+            The `(top, left, height, width)` region of every source image `pixel_values` was cropped from, of shape
+            `(batch_size, 4)`.
+        generator (`torch.Generator`, *optional*):
+            A generator on the device of `pixel_values` to make the masks deterministic.
+        kwargs:
+            Passed to `random_brush_masks`.
+
+    Returns:
+        `Tuple[torch.Tensor, torch.Tensor]`: The masked images, with masked pixels set to -1, and the masks of shape
+        `(batch_size, 1, height, width)`, 1 where `pixel_values` is kept.
+    """
+    batch_size, _, height, width = pixel_values.shape
+    device = pixel_values.device
+    masks = 1 - random_brush_masks(canvas_sizes, crops, (height, width), device=device, generator=generator, **kwargs)
+
+    # the 8 pixel kernel is sized in source pixels, so the kernel of every crop is known on the host
+    kernel_sizes = np.maximum(1, np.round(8 * height / np.asarray(crops, dtype=np.float64)[:, 2])).astype(int)
+    opened = masks.clone()
+    for kernel_size in np.unique(kernel_sizes):
+        index = torch.from_numpy(np.flatnonzero(kernel_sizes == kernel_size)).to(device)
+        selected = masks.index_select(0, index)
+        selected = _morphology(_morphology(selected, kernel_size, erode=True), kernel_size, erode=False)
+        opened.index_copy_(0, index, selected)
+    random = torch.rand((batch_size, 2, 1, 1, 1), generator=generator, device=device)
+    masks = torch.where(random[:, 0] < 0.3, opened, masks)
+    masks = torch.where(random[:, 1] < 0.5, 1 - masks, masks)
+
+    conditioning_pixel_values = torch.where(masks > 0, pixel_values, torch.full_like(pixel_values, -1.0))
+    return conditioning_pixel_values, masks
@@ -0,0 +1,181 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import safetensors.torch
+import torch
+
+from diffusers import UNet2DModel
+
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from async_checkpoint import (  # noqa: E402
+    AsyncCheckpointWriter,
+    collect_random_states,
+    is_async_checkpoint,
+    load_async_checkpoint,
+    verify_checkpoint,
+)
+
+
+def get_model():
+    return UNet2DModel(
+        sample_size=8,
+        in_channels=1,
+        out_channels=1,
+        block_out_channels=(8, 8),
+        layers_per_block=1,
+        norm_num_groups=4,
+        down_block_types=("DownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "UpBlock2D"),
+    )
+
+
+def get_training_state(model):
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    lr_scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step: 1.0 / (step + 1))
+    return optimizer, lr_scheduler
+
+
+def train_step(model, optimizer, lr_scheduler):
+    model(torch.randn(2, 1, 8, 8), 1).sample.square().mean().backward()
+    optimizer.step()
+    lr_scheduler.step()
+    optimizer.zero_grad()
+
+
+class AsyncCheckpointTests(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.model = get_model()
+        self.optimizer, self.lr_scheduler = get_training_state(self.model)
+        train_step(self.model, self.optimizer, self.lr_scheduler)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_save_and_load(self):
+        writer = AsyncCheckpointWriter(self.tmpdir.name)
+        writer.save(
+            "checkpoint-1",
+            self.model,
+            self.optimizer,
+            self.lr_scheduler,
+            json_files={"data_stream.json": {"epoch": 3}},
+        )
+        # the snapshot is taken in `save`, so training can go on while the checkpoint is written
+        state_dict = {name: tensor.clone() for name, tensor in self.model.state_dict().items()}
+        optimizer_state = self.optimizer.state_dict()["state"][0]["exp_avg"].clone()
+        train_step(self.model, self.optimizer, self.lr_scheduler)
+        writer.wait()
+
+        path = os.path.join(self.tmpdir.name, "checkpoint-1")
+        self.assertTrue(is_async_checkpoint(path))
+        self.assertTrue(verify_checkpoint(path))
+        with open(os.path.join(path, "data_stream.json")) as f:
+            self.assertEqual(json.load(f), {"epoch": 3})
+
+        model = UNet2DModel.from_pretrained(path, subfolder="brushnet")
+        optimizer, lr_scheduler = get_training_state(model)
+        load_async_checkpoint(path, model, optimizer, lr_scheduler)
+        for name, tensor in model.state_dict().items():
+            self.assertTrue(torch.equal(tensor, state_dict[name]), name)
+        self.assertTrue(torch.equal(optimizer.state_dict()["state"][0]["exp_avg"], optimizer_state))
+        self.assertEqual(lr_scheduler.last_epoch, 1)
+
+    def test_random_states_per_process(self):
+        # two processes, each with its own random states and mask generator
+        random_states, expected_noise, expected_masks = [], [], []
+        for process_index in range(2):
+            torch.manual_seed(process_index)
+            mask_generator = torch.Generator().manual_seed(100 + process_index)
+            random_states.append(collect_random_states({"mask_generator": mask_generator, "unused": None}))
+            expected_noise.append(torch.rand(2))
+            expected_masks.append(torch.rand(2, generator=mask_generator))
+        writer = AsyncCheckpointWriter(self.tmpdir.name)
+        writer.save("checkpoint-1", self.model, self.optimizer, random_states=random_states)
+        writer.wait()
+
+        path = os.path.join(self.tmpdir.name, "checkpoint-1")
+        model = get_model()
+        for process_index in range(2):
+            torch.manual_seed(42)
+            mask_generator = torch.Generator()
+            generators = {"mask_generator": mask_generator}
+            self.assertTrue(
+                load_async_checkpoint(path, model, self.optimizer, process_index=process_index, generators=generators)
+            )
+            self.assertTrue(torch.equal(torch.rand(2), expected_noise[process_index]))
+            self.assertTrue(torch.equal(torch.rand(2, generator=mask_generator), expected_masks[process_index]))
+
+        # a process the checkpoint has no random states for keeps its own
+        torch.manual_seed(7)
+        expected = torch.rand(2)
+        torch.manual_seed(7)
+        self.assertFalse(load_async_checkpoint(path, model, self.optimizer, process_index=2))
+        self.assertTrue(torch.equal(torch.rand(2), expected))
+
+    def test_is_busy(self):
+        writer = AsyncCheckpointWriter(self.tmpdir.name)
+        self.assertFalse(writer.is_busy())
+        # the write is held until `written` is set
+        written = threading.Event()
+        with mock.patch.object(safetensors.torch, "save_file", side_effect=lambda *args, **kwargs: written.wait()):
+            writer.save("checkpoint-1", self.model, self.optimizer)
+            self.assertTrue(writer.is_busy())
+            written.set()
+            writer.wait()
+        self.assertFalse(writer.is_busy())
+
+    def test_total_limit(self):
+        writer = AsyncCheckpointWriter(self.tmpdir.name, total_limit=2)
+        for step in range(1, 4):
+            writer.save(f"checkpoint-{step}", self.model, self.optimizer)
+        writer.save("best_checkpoint", self.model, self.optimizer)
+        writer.save("best_checkpoint", self.model, self.optimizer)
+        writer.wait()
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ["best_checkpoint", "checkpoint-2", "checkpoint-3"])
+
+    def test_incomplete_checkpoint(self):
+        writer = AsyncCheckpointWriter(self.tmpdir.name)
+        writer.save("checkpoint-1", self.model, self.optimizer)
+        writer.wait()
+        path = os.path.join(self.tmpdir.name, "checkpoint-1")
+        with open(os.path.join(path, "optimizer.safetensors"), "ab") as f:
+            f.write(b"\0")
+        self.assertFalse(verify_checkpoint(path))
+        with self.assertRaises(ValueError):
+            load_async_checkpoint(path, get_model(), self.optimizer)
+
+    def test_write_error(self):
+        # the output directory is a file, so the checkpoint can't be written
+        output_dir = os.path.join(self.tmpdir.name, "output")
+        open(output_dir, "w").close()
+        writer = AsyncCheckpointWriter(output_dir)
+        writer.save("checkpoint-1", self.model, self.optimizer)
+        with self.assertRaises(RuntimeError):
+            writer.wait()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import os
+import sys
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from transformers import CLIPImageProcessor
+
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from brushbench_metrics import (  # noqa: E402
+    BatchedMetricsCalculator,
+    clip_preprocess,
+    load_images,
+    masked_mse,
+    masked_psnr,
+)
+
+
+def reference_mse(img_pred, img_gt, mask):
+    # the per-image metric `evaluate_brushnet.py` used to compute with numpy
+    img_pred = np.array(img_pred).astype(np.float32) / 255.0
+    img_gt = np.array(img_gt).astype(np.float32) / 255.0
+    mask = np.array(mask).astype(np.float32)
+    difference_square_sum = ((img_pred * mask - img_gt * mask) ** 2).sum()
+    return difference_square_sum / mask.sum()
+
+
+class BrushBenchMetricsTests(unittest.TestCase):
+    def setUp(self):
+        generator = np.random.RandomState(0)
+        self.images = generator.randint(0, 256, (3, 64, 64, 3)).astype(np.uint8)
+        self.source_images = generator.randint(0, 256, (3, 64, 64, 3)).astype(np.uint8)
+        self.masks = (generator.rand(3, 64, 64, 1) > 0.5).astype(np.uint8)
+
+    def to_tensors(self):
+        images = torch.from_numpy(self.images).permute(0, 3, 1, 2).float() / 255
+        source_images = torch.from_numpy(self.source_images).permute(0, 3, 1, 2).float() / 255
+        masks = torch.from_numpy(self.masks).permute(0, 3, 1, 2).float()
+        return images, source_images, masks
+
+    def test_masked_mse(self):
+        mse = masked_mse(*self.to_tensors())
+        for i in range(3):
+            expected = reference_mse(self.images[i], self.source_images[i], self.masks[i])
+            self.assertAlmostEqual(mse[i].item(), expected, places=5)
+
+    def test_masked_psnr(self):
+        images, source_images, masks = self.to_tensors()
+        psnr = masked_psnr(images, source_images, masks)
+        for i in range(3):
+            mse = reference_mse(self.images[i], self.source_images[i], self.masks[i])
+            self.assertAlmostEqual(psnr[i].item(), 20 * math.log10(1 / math.sqrt(mse)), places=3)
+        self.assertEqual(masked_psnr(images, images, masks).tolist(), [1000.0] * 3)
+
+    def test_clip_preprocess(self):
+        image = cv2.GaussianBlur(np.random.RandomState(1).randint(0, 256, (512, 384, 3)).astype(np.uint8), (0, 0), 3)
+        processor = CLIPImageProcessor(size={"shortest_edge": 224}, crop_size={"height": 224, "width": 224})
+        expected = processor(Image.fromarray(image), return_tensors="pt").pixel_values
+        pixel_values = clip_preprocess(torch.from_numpy(image).permute(2, 0, 1)[None])
+        self.assertEqual(pixel_values.shape, (1, 3, 224, 224))
+        # the processor rounds the resized image to 8 bits
+        self.assertLess((pixel_values - expected).abs().mean().item(), 0.01)
+
+    def test_load_images(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for i, image in enumerate(self.images):
+                paths.append(os.path.join(tmpdir, f"{i}.png"))
+                cv2.imwrite(paths[-1], image[:, :, ::-1])
+            images = load_images(paths, size=(64, 64))
+            self.assertTrue(torch.equal(images, torch.from_numpy(self.images).permute(0, 3, 1, 2)))
+            self.assertEqual(load_images(paths, size=(32, 48)).shape, (3, 3, 48, 32))
+
+    def test_metric_models_are_loaded_lazily(self):
+        images, source_images, masks = self.to_tensors()
+        images, source_images = (images * 255).to(torch.uint8), (source_images * 255).to(torch.uint8)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # no weights are cached and none can be downloaded
+            calculator = BatchedMetricsCalculator("cpu", ckpt_path=tmpdir, offline=True)
+            scores = calculator(images, source_images, masks, ["a cake"] * 3, metrics=["PSNR", "MSE"])
+            self.assertEqual(list(scores), ["PSNR", "MSE"])
+            np.testing.assert_allclose(scores["MSE"], masked_mse(source_images / 255, images / 255, masks), rtol=1e-5)
+            with self.assertRaises(FileNotFoundError):
+                calculator(images, source_images, masks, ["a cake"] * 3, metrics=["CLIP Similarity"])
+
+
+if __name__ == "__main__":
+    unittest.main()
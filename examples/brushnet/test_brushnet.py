@@ -49,21 +49,8 @@ image = pipe(
     mask_image, 
     num_inference_steps=50, 
     generator=generator,
-    brushnet_conditioning_scale=brushnet_conditioning_scale
+    brushnet_conditioning_scale=brushnet_conditioning_scale,
+    blended=blended,
 ).images[0]
 
-if blended:
-    image_np=np.array(image)
-    init_image_np=cv2.imread(image_path)[:,:,::-1]
-    mask_np = 1.*(cv2.imread(mask_path).sum(-1)>255)[:,:,np.newaxis]
-
-    # blur, you can adjust the parameters for better performance
-    mask_blurred = cv2.GaussianBlur(mask_np*255, (21, 21), 0)/255
-    mask_blurred = mask_blurred[:,:,np.newaxis]
-    mask_np = 1-(1-mask_np) * (1-mask_blurred)
-
-    image_pasted=init_image_np * (1-mask_np) + image_np*mask_np
-    image_pasted=image_pasted.astype(image_np.dtype)
-    image=Image.fromarray(image_pasted)
-
 image.save("output.png")
\ No newline at end of file
@@ -0,0 +1,102 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import pickle
+import sys
+import tarfile
+import tempfile
+import unittest
+
+import torch
+from accelerate import Accelerator
+from transformers import CLIPTokenizer
+
+from diffusers import AutoencoderKL
+
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from test_brushnet_lcm_distill import write_brushdata_shard  # noqa: E402
+from train_brushnet import LatentStore, MyWebDataset, precompute_latents  # noqa: E402
+
+
+def read_brushdata_shard(path):
+    examples = {}
+    with tarfile.open(path) as tar:
+        for member in tar.getmembers():
+            key, extension = member.name.split(".", 1)
+            examples.setdefault(key, {"__key__": key})[extension] = tar.extractfile(member).read()
+    return list(examples.values())
+
+
+class BrushNetLatentStoreTests(unittest.TestCase):
+    def test_precompute_latents(self):
+        torch.manual_seed(0)
+        vae = AutoencoderKL(
+            block_out_channels=[32, 64],
+            in_channels=3,
+            out_channels=3,
+            down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+            up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"],
+            latent_channels=4,
+        ).eval()
+        tokenizer = CLIPTokenizer.from_pretrained(
+            "hf-internal-testing/tiny-stable-diffusion-pipe", subfolder="tokenizer"
+        )
+        collate = MyWebDataset(resolution=32, tokenizer=tokenizer, random_mask=False)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            write_brushdata_shard(os.path.join(tmpdir, "000000.tar"), num_samples=3)
+            examples = read_brushdata_shard(os.path.join(tmpdir, "000000.tar"))
+
+            output_dir = os.path.join(tmpdir, "latents")
+            store = precompute_latents(
+                examples, vae, collate, output_dir, Accelerator(), batch_size=2, shard_size=2, fingerprint="a"
+            )
+            self.assertIsInstance(store, LatentStore)
+            self.assertEqual(len(store), 3)
+            self.assertEqual(len(store.shard_names), 2)
+
+            # one segmentation mask, kept and swapped
+            caption, pixel_values, conditioning_pixel_values, masks = collate.fixed_mask_variants(examples[2])
+            self.assertEqual(tuple(conditioning_pixel_values.shape), (2, 3, 32, 32))
+            with torch.no_grad():
+                expected = vae.encode(pixel_values[None]).latent_dist.parameters[0]
+                expected_conditioning = vae.encode(conditioning_pixel_values).latent_dist.parameters
+
+            item = store[2]
+            self.assertEqual(item["latent_parameters"].dtype, torch.float16)
+            self.assertTrue(torch.allclose(item["latent_parameters"].float(), expected, atol=1e-2))
+            # the variant is picked at random
+            matches = [
+                torch.allclose(item["conditioning_latent_parameters"].float(), parameters, atol=1e-2)
+                for parameters in expected_conditioning
+            ]
+            self.assertTrue(any(matches))
+            variant = matches.index(True)
+            self.assertEqual(tuple(item["masks"].shape), (1, 16, 16))
+            self.assertTrue(torch.equal(item["masks"], masks[variant : variant + 1, :, ::2, ::2][0]))
+            self.assertEqual(tuple(item["input_ids"].shape), (tokenizer.model_max_length,))
+
+            # the DataLoader workers reopen the shards
+            self.assertIsNone(pickle.loads(pickle.dumps(store))._shards)
+
+            # a matching fingerprint reuses the shards
+            os.remove(os.path.join(output_dir, "latents-000-00000.npy"))
+            store = precompute_latents(examples, vae, collate, output_dir, Accelerator(), fingerprint="a")
+            self.assertEqual(len(store), 3)
+            store = precompute_latents(examples, vae, collate, output_dir, Accelerator(), fingerprint="b")
+            self.assertEqual(len(store), 3)
+            self.assertEqual(len(store.shard_names), 1)
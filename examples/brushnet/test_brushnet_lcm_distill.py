@@ -0,0 +1,130 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import logging
+import os
+import sys
+import tarfile
+import tempfile
+
+import cv2
+import numpy as np
+import safetensors
+
+
+sys.path.append("..")
+from test_examples_utils import ExamplesTestsAccelerate, run_command  # noqa: E402
+
+
+logging.basicConfig(level=logging.DEBUG)
+
+logger = logging.getLogger()
+stream_handler = logging.StreamHandler(sys.stdout)
+logger.addHandler(stream_handler)
+
+
+def write_brushdata_shard(path, num_samples=4, height=80, width=72):
+    # a shard in the BrushData layout read by `MyWebDataset`, with one run-length encoded segmentation mask per image
+    mask = np.zeros((height, width), np.uint8)
+    mask[10:50, 20:60] = 1
+    runs = np.flatnonzero(np.diff(np.concatenate([[0], mask.flatten(order="F"), [0]])))
+    rle = [int(value) for start, end in zip(runs[::2], runs[1::2]) for value in (start + 1, end - start)]
+
+    with tarfile.open(path, "w") as tar:
+        for i in range(num_samples):
+            image = np.random.RandomState(i).randint(0, 255, (height, width, 3), dtype=np.uint8)
+            files = {
+                "image": cv2.imencode(".jpg", image)[1].tobytes(),
+                "caption": b"a photo of a cake",
+                "height": str(height).encode(),
+                "width": str(width).encode(),
+                "segmentation": json.dumps({"mask": [rle]}).encode(),
+            }
+            for extension, data in files.items():
+                info = tarfile.TarInfo(f"{i:06d}.{extension}")
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+
+class BrushNetLCMDistillation(ExamplesTestsAccelerate):
+    def test_brushnet_lcm_distill_lora(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "data"))
+            write_brushdata_shard(os.path.join(tmpdir, "data", "000000.tar"))
+
+            test_args = f"""
+                examples/brushnet/train_brushnet_lcm_distill.py
+                --pretrained_model_name_or_path hf-internal-testing/tiny-stable-diffusion-pipe
+                --train_data_dir {tmpdir}/data
+                --distill_target lora
+                --resolution 64
+                --lora_rank 4
+                --num_ddim_timesteps 10
+                --train_batch_size 1
+                --gradient_accumulation_steps 1
+                --max_train_steps 2
+                --learning_rate 5.0e-04
+                --lr_scheduler constant
+                --lr_warmup_steps 0
+                --output_dir {tmpdir}/output
+                """.split()
+
+            run_command(self._launch_args + test_args)
+            # save_pretrained smoke test
+            self.assertTrue(os.path.isfile(os.path.join(tmpdir, "output", "pytorch_lora_weights.safetensors")))
+
+            # make sure the state_dict has the correct naming in the parameters.
+            lora_state_dict = safetensors.torch.load_file(
+                os.path.join(tmpdir, "output", "pytorch_lora_weights.safetensors")
+            )
+            is_lora = all("lora" in k for k in lora_state_dict.keys())
+            self.assertTrue(is_lora)
+
+    def test_brushnet_lcm_distill_brushnet_checkpointing(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "data"))
+            write_brushdata_shard(os.path.join(tmpdir, "data", "000000.tar"))
+
+            test_args = f"""
+                examples/brushnet/train_brushnet_lcm_distill.py
+                --pretrained_model_name_or_path hf-internal-testing/tiny-stable-diffusion-pipe
+                --train_data_dir {tmpdir}/data
+                --distill_target brushnet
+                --resolution 64
+                --num_ddim_timesteps 10
+                --train_batch_size 1
+                --gradient_accumulation_steps 1
+                --max_train_steps 3
+                --checkpointing_steps 2
+                --learning_rate 5.0e-04
+                --lr_scheduler constant
+                --lr_warmup_steps 0
+                --output_dir {tmpdir}/output
+                """.split()
+
+            run_command(self._launch_args + test_args)
+
+            output_dir = os.path.join(tmpdir, "output")
+            self.assertTrue(os.path.isfile(os.path.join(output_dir, "diffusion_pytorch_model.safetensors")))
+            self.assertTrue(
+                os.path.isfile(os.path.join(output_dir, "brushnet_target", "diffusion_pytorch_model.safetensors"))
+            )
+            self.assertEqual({x for x in os.listdir(output_dir) if "checkpoint" in x}, {"checkpoint-2"})
+            self.assertEqual(
+                set(os.listdir(os.path.join(output_dir, "checkpoint-2"))) & {"brushnet", "brushnet_target"},
+                {"brushnet", "brushnet_target"},
+            )
@@ -0,0 +1,76 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import sys
+import tempfile
+
+from diffusers import BrushNetModel, UNet2DConditionModel
+
+
+sys.path.append("..")
+from test_brushnet_lcm_distill import write_brushdata_shard  # noqa: E402
+from test_examples_utils import ExamplesTestsAccelerate, run_command  # noqa: E402
+
+
+logging.basicConfig(level=logging.DEBUG)
+
+logger = logging.getLogger()
+stream_handler = logging.StreamHandler(sys.stdout)
+logger.addHandler(stream_handler)
+
+
+class BrushNetLiteDistillation(ExamplesTestsAccelerate):
+    def test_brushnet_lite_distill_checkpointing(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "data"))
+            write_brushdata_shard(os.path.join(tmpdir, "data", "000000.tar"))
+
+            unet = UNet2DConditionModel.from_pretrained(
+                "hf-internal-testing/tiny-stable-diffusion-pipe", subfolder="unet"
+            )
+            teacher_brushnet = BrushNetModel.from_unet(unet)
+            teacher_brushnet.save_pretrained(os.path.join(tmpdir, "teacher"))
+
+            test_args = f"""
+                examples/brushnet/train_brushnet_lite_distill.py
+                --pretrained_model_name_or_path hf-internal-testing/tiny-stable-diffusion-pipe
+                --brushnet_model_name_or_path {tmpdir}/teacher
+                --train_data_dir {tmpdir}/data
+                --lite_layers_per_block 1
+                --lite_no_up_blocks
+                --resolution 64
+                --train_batch_size 1
+                --gradient_accumulation_steps 1
+                --max_train_steps 3
+                --checkpointing_steps 2
+                --learning_rate 5.0e-04
+                --lr_scheduler constant
+                --lr_warmup_steps 0
+                --output_dir {tmpdir}/output
+                """.split()
+
+            run_command(self._launch_args + test_args)
+
+            output_dir = os.path.join(tmpdir, "output")
+            self.assertTrue(os.path.isfile(os.path.join(output_dir, "diffusion_pytorch_model.safetensors")))
+            self.assertEqual({x for x in os.listdir(output_dir) if "checkpoint" in x}, {"checkpoint-2"})
+
+            brushnet = BrushNetModel.from_pretrained(output_dir)
+            self.assertEqual(brushnet.config.layers_per_block, 1)
+            self.assertEqual(brushnet.config.unet_layers_per_block, unet.config.layers_per_block)
+            self.assertEqual(len(brushnet.up_blocks), 0)
+            self.assertEqual(len(brushnet.brushnet_down_blocks), len(teacher_brushnet.brushnet_down_blocks))
@@ -0,0 +1,64 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+from accelerate import Accelerator
+from transformers import CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
+
+from train_brushnet_sdxl import encode_prompt, precompute_text_embeddings
+
+
+class SDXLTextEmbeddingStore(unittest.TestCase):
+    def test_precompute_text_embeddings(self):
+        model_name = "hf-internal-testing/tiny-stable-diffusion-xl-pipe"
+        tokenizers = [
+            CLIPTokenizer.from_pretrained(model_name, subfolder="tokenizer"),
+            CLIPTokenizer.from_pretrained(model_name, subfolder="tokenizer_2"),
+        ]
+        text_encoders = [
+            CLIPTextModel.from_pretrained(model_name, subfolder="text_encoder"),
+            CLIPTextModelWithProjection.from_pretrained(model_name, subfolder="text_encoder_2"),
+        ]
+        captions = ["a cake on the table", "a sofa in the room", ["a vase", "a jar"], "", "a red car"]
+        accelerator = Accelerator(cpu=True)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = precompute_text_embeddings(
+                captions, text_encoders, tokenizers, tmpdir, accelerator, batch_size=2, shard_size=3, fingerprint="0"
+            )
+            self.assertEqual(
+                sorted(name for name in os.listdir(tmpdir) if name.startswith("prompt_embeds")),
+                ["prompt_embeds-00000.npy", "prompt_embeds-00001.npy"],
+            )
+
+            # the batched embeddings match the ones encoded in the training loop
+            prompt_embeds, text_embeds = encode_prompt(captions, text_encoders, tokenizers, 0, is_train=False)
+            self.assertEqual(len(store), len(captions))
+            for i in range(len(captions)):
+                self.assertLess(np.abs(store[i][0] - prompt_embeds[i].numpy()).max(), 1e-2)
+                self.assertLess(np.abs(store[i][1] - text_embeds[i].numpy()).max(), 1e-2)
+            self.assertTrue(np.array_equal(store.empty_prompt()[0], store[3][0]))
+
+            # DataLoader workers receive the paths and map the shards themselves
+            self.assertIsNone(pickle.loads(pickle.dumps(store))._shards)
+
+            # a second run with the same fingerprint does not encode again
+            reused = precompute_text_embeddings(captions, None, None, tmpdir, accelerator, fingerprint="0")
+            self.assertTrue(np.array_equal(reused[4][0], store[4][0]))
@@ -0,0 +1,101 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import random
+import sys
+import unittest
+
+import cv2
+import numpy as np
+from transformers import CLIPTokenizer
+
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from train_brushnet import MyWebDataset  # noqa: E402
+
+
+def make_example(height, width):
+    mask = np.zeros((height, width), np.uint8)
+    mask[height // 4 : height // 2, width // 3 : width - 10] = 1
+    runs = np.flatnonzero(np.diff(np.concatenate([[0], mask.flatten(order="F"), [0]])))
+    rle = [int(value) for start, end in zip(runs[::2], runs[1::2]) for value in (start + 1, end - start)]
+
+    # smooth content so that decoding at a DCT scale-down stays close to resizing the full decode
+    image = cv2.resize(np.random.RandomState(0).randint(0, 255, (8, 8, 3), dtype=np.uint8), (width, height))
+    example = {
+        "caption": b"a photo of a cake",
+        "height": str(height).encode(),
+        "width": str(width).encode(),
+        "image": cv2.imencode(".jpg", image)[1].tobytes(),
+        "segmentation": json.dumps({"mask": [rle]}).encode(),
+    }
+    return example, mask, rle
+
+
+class MyWebDatasetTests(unittest.TestCase):
+    def get_dataset(self, **kwargs):
+        tokenizer = CLIPTokenizer.from_pretrained(
+            "hf-internal-testing/tiny-stable-diffusion-pipe", subfolder="tokenizer"
+        )
+        return MyWebDataset(resolution=64, tokenizer=tokenizer, random_mask=False, **kwargs)
+
+    def test_decode_scale_factor(self):
+        dataset = self.get_dataset()
+        self.assertEqual(dataset.decode_scale_factor(600, 800), 8)
+        self.assertEqual(dataset.decode_scale_factor(300, 800), 4)
+        self.assertEqual(dataset.decode_scale_factor(127, 800), 1)
+        self.assertEqual(self.get_dataset(full_resolution_decode=True).decode_scale_factor(600, 800), 1)
+
+    def test_mask_cache(self):
+        example, _, _ = make_example(300, 400)
+        example["__key__"] = "000000"
+
+        batches = []
+        for mask_cache_mb in (0, 1, 1):
+            random.seed(0)
+            dataset = self.get_dataset(mask_cache_mb=mask_cache_mb)
+            batches.append(dataset([example, example]))
+        self.assertEqual((dataset.mask_cache.hits, dataset.mask_cache.misses), (1, 1))
+        self.assertTrue((batches[0]["masks"] == batches[1]["masks"]).all())
+
+    def test_reduced_decode_matches_full_decode(self):
+        example, _, _ = make_example(300, 400)
+
+        batches = []
+        for full_resolution_decode in (True, False):
+            random.seed(0)
+            batches.append(self.get_dataset(full_resolution_decode=full_resolution_decode)([example]))
+
+        for key in ("pixel_values", "conditioning_pixel_values", "masks"):
+            self.assertEqual(batches[0][key].shape, batches[1][key].shape)
+        self.assertEqual(tuple(batches[1]["pixel_values"].shape), (1, 3, 64, 64))
+        self.assertLess((batches[0]["pixel_values"] - batches[1]["pixel_values"]).abs().mean().item(), 0.05)
+        self.assertLess((batches[0]["masks"] - batches[1]["masks"]).abs().mean().item(), 0.05)
+
+    def test_device_random_mask(self):
+        example, _, _ = make_example(300, 400)
+        dataset = MyWebDataset(
+            resolution=64, tokenizer=self.get_dataset().tokenizer, random_mask=True, device_random_mask=True
+        )
+        batch = dataset([example, example])
+
+        self.assertEqual(set(batch.keys()), {"pixel_values", "mask_canvas_sizes", "mask_crops", "input_ids"})
+        self.assertEqual(tuple(batch["pixel_values"].shape), (2, 3, 64, 64))
+        self.assertTrue((batch["mask_canvas_sizes"] == [300, 400]).all())
+        # square crops over the short side of the source image
+        self.assertTrue((batch["mask_crops"][:, 2:] == 300).all())
+        self.assertTrue((batch["mask_crops"][:, 0] == 0).all())
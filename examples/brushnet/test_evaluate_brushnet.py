@@ -0,0 +1,198 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import sys
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+import pandas as pd
+import torch
+
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from brushbench_metrics import METRIC_NAMES  # noqa: E402
+from evaluate_brushnet import (  # noqa: E402
+    append_results,
+    generate_images,
+    merge_results,
+    parse_args,
+    read_results,
+    results_path,
+    score_images,
+    shard_keys,
+)
+from mask_rle import rle_encode  # noqa: E402
+from metric_cache import MetricCache  # noqa: E402
+
+
+def make_record(key):
+    return {"Image ID": key, **{metric: float(i + int(key)) for i, metric in enumerate(METRIC_NAMES)}}
+
+
+class CountingMetricsCalculator:
+    # stands in for `BatchedMetricsCalculator`, scoring every image with its mean pixel value
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, images, source_images, masks, prompts, metrics=None):
+        self.calls.append((len(images), list(metrics)))
+        return {metric: images.float().mean(dim=(1, 2, 3)).numpy() for metric in metrics}
+
+
+class RecordingPipeline:
+    # stands in for `StableDiffusionBrushNetPipeline`, returning the masked input images
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, prompt, image, mask, generator=None, **kwargs):
+        self.calls.append((prompt, [g.initial_seed() for g in generator]))
+        return argparse.Namespace(images=image)
+
+
+class EvaluateBrushNetTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.mapping_file = {f"{i:09d}": {"image": f"images/{i}.jpg", "caption": "a cake"} for i in range(10)}
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_shard_keys(self):
+        keys = list(self.mapping_file)
+        shards = [shard_keys(keys, 3, shard_index) for shard_index in range(3)]
+        self.assertEqual([len(shard) for shard in shards], [4, 3, 3])
+        self.assertEqual(sorted(sum(shards, [])), keys)
+
+    def test_append_and_read_results(self):
+        path = results_path(self.tmpdir.name, 2, 0)
+        keys = list(self.mapping_file)
+        append_results(path, [make_record(key) for key in keys[:2]])
+        # an interrupted run leaves a partial line behind
+        with open(path, "a") as f:
+            f.write('{"Image ID": "0000')
+        append_results(path, [make_record(keys[2])])
+        self.assertEqual(read_results(self.tmpdir.name), {key: make_record(key) for key in keys[:3]})
+
+    def test_merge_results(self):
+        keys = list(self.mapping_file)
+        for shard_index in range(2):
+            shard = shard_keys(keys, 2, shard_index)
+            append_results(results_path(self.tmpdir.name, 2, shard_index), [make_record(key) for key in shard[:-1]])
+        self.assertFalse(merge_results(self.mapping_file, self.tmpdir.name))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir.name, "evaluation_result.csv")))
+
+        append_results(results_path(self.tmpdir.name, 2, 1), [make_record(keys[-1])])
+        append_results(results_path(self.tmpdir.name, 2, 0), [make_record(keys[-2])])
+        self.assertTrue(merge_results(self.mapping_file, self.tmpdir.name))
+        evaluation_df = pd.read_csv(os.path.join(self.tmpdir.name, "evaluation_result.csv"), dtype={"Image ID": str})
+        self.assertEqual(evaluation_df["Image ID"].tolist(), keys)
+        self.assertEqual(evaluation_df["PSNR"].tolist(), [make_record(key)["PSNR"] for key in keys])
+        averaged_results = pd.read_csv(os.path.join(self.tmpdir.name, "evaluation_result_sum.csv"), index_col=0)
+        self.assertAlmostEqual(averaged_results.loc["PSNR"].item(), evaluation_df["PSNR"].mean())
+
+    def test_score_images_with_metric_cache(self):
+        generator = np.random.RandomState(0)
+        for directory in ["base", "output"]:
+            os.makedirs(os.path.join(self.tmpdir.name, directory, "images"))
+        mask = np.zeros((512, 512), dtype=np.uint8)
+        mask[100:200, 50:300] = 1
+        mapping_file = {}
+        for i in range(3):
+            for directory in ["base", "output"]:
+                image = generator.randint(0, 256, (512, 512, 3)).astype(np.uint8)
+                cv2.imwrite(os.path.join(self.tmpdir.name, directory, "images", f"{i}.png"), image)
+            mapping_file[f"{i:03d}"] = {
+                "image": f"images/{i}.png",
+                "caption": "a cake",
+                "inpainting_mask": rle_encode(mask, order="C"),
+            }
+        args = argparse.Namespace(
+            base_dir=os.path.join(self.tmpdir.name, "base"),
+            image_save_path=os.path.join(self.tmpdir.name, "output"),
+            mask_key="inpainting_mask",
+        )
+        metric_cache = MetricCache(os.path.join(self.tmpdir.name, "metric_cache.sqlite"))
+        calculator = CountingMetricsCalculator()
+        keys = list(mapping_file)
+
+        records = score_images(calculator, mapping_file, keys[:2], args, metric_cache)
+        self.assertEqual(calculator.calls, [(2, METRIC_NAMES)])
+        # only the image that was not scored yet is computed
+        self.assertEqual(score_images(calculator, mapping_file, keys, args, metric_cache)[:2], records)
+        self.assertEqual(calculator.calls[1], (1, METRIC_NAMES))
+
+        # a changed caption is a new entry
+        mapping_file[keys[0]]["caption"] = "a cat"
+        score_images(calculator, mapping_file, keys, args, metric_cache)
+        self.assertEqual(calculator.calls[2], (1, METRIC_NAMES))
+
+        # so is a new version of a metric model, only that metric is computed again
+        metric_cache.prune(keep_versions={"CLIP Similarity": "another version"})
+        score_images(calculator, mapping_file, keys, args, metric_cache)
+        self.assertEqual(calculator.calls[3], (3, ["CLIP Similarity"]))
+        metric_cache.close()
+
+    def test_generate_images_in_batches(self):
+        os.makedirs(os.path.join(self.tmpdir.name, "base", "images"))
+        mask = np.zeros((512, 512), dtype=np.uint8)
+        mask[100:200, 50:300] = 1
+        mapping_file = {}
+        for i in range(5):
+            image = np.full((512, 512, 3), i, dtype=np.uint8)
+            cv2.imwrite(os.path.join(self.tmpdir.name, "base", "images", f"{i}.jpg"), image)
+            mapping_file[f"{i:03d}"] = {
+                "image": f"images/{i}.jpg",
+                "caption": f"caption {i}",
+                "inpainting_mask": rle_encode(mask, order="C"),
+            }
+        args = argparse.Namespace(
+            base_dir=os.path.join(self.tmpdir.name, "base"),
+            image_save_path=os.path.join(self.tmpdir.name, "output"),
+            mask_key="inpainting_mask",
+            generation_batch_size=2,
+            paintingnet_conditioning_scale=1.0,
+            blended=False,
+        )
+        pipe = RecordingPipeline()
+        items = list(mapping_file.values())
+
+        self.assertEqual(generate_images(pipe, items, args, torch.device("cpu")), 5)
+        expected_prompts = [[f"caption {i}" for i in batch] for batch in [[0, 1], [2, 3], [4]]]
+        self.assertEqual([prompts for prompts, _ in pipe.calls], expected_prompts)
+        # every image is seeded as when it is generated on its own
+        self.assertEqual([seeds for _, seeds in pipe.calls], [[1234, 1234], [1234, 1234], [1234]])
+        for i in range(5):
+            self.assertTrue(os.path.exists(os.path.join(args.image_save_path, "images", f"{i}.jpg")))
+            self.assertTrue(os.path.exists(os.path.join(args.image_save_path, "images", f"{i}_masked.jpg")))
+
+        # the existing images are not generated again
+        os.remove(os.path.join(args.image_save_path, "images", "3.jpg"))
+        self.assertEqual(generate_images(pipe, items, args, torch.device("cpu")), 1)
+        self.assertEqual(pipe.calls[-1][0], ["caption 3"])
+
+    def test_shard_arguments(self):
+        self.assertEqual(parse_args(["--num_shards", "4", "--shard_index", "3"]).shard_index, 3)
+        with self.assertRaises(ValueError):
+            parse_args(["--num_shards", "4"])
+        with self.assertRaises(ValueError):
+            parse_args(["--num_shards", "4", "--shard_index", "4"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mask_rle import RLEMaskCache, rle_decode, rle_encode  # noqa: E402
+
+
+def reference_rle_decode(mask_rle, shape, order):
+    # the per-run loop the training and evaluation scripts used to decode with
+    starts, lengths = [np.asarray(x, dtype=int) for x in (mask_rle[0:][::2], mask_rle[1:][::2])]
+    starts -= 1
+    ends = starts + lengths
+    img = np.zeros(shape[0] * shape[1], dtype=np.uint8)
+    for lo, hi in zip(starts, ends):
+        img[lo:hi] = 1
+    return img.reshape(shape, order=order)
+
+
+class MaskRLETests(unittest.TestCase):
+    def setUp(self):
+        generator = np.random.RandomState(0)
+        self.mask = (generator.rand(48, 64) > 0.6).astype(np.uint8)
+        self.mask[:, 0] = 1
+        self.mask[-1, -1] = 1
+
+    def test_round_trip(self):
+        for order in ("F", "C"):
+            mask_rle = rle_encode(self.mask, order=order)
+            self.assertTrue((reference_rle_decode(mask_rle, self.mask.shape, order) == self.mask).all())
+            self.assertTrue((rle_decode(mask_rle, self.mask.shape, order=order) == self.mask).all())
+        self.assertEqual(rle_encode(np.zeros((4, 4))), [])
+        self.assertEqual(rle_decode([], (4, 4)).sum(), 0)
+
+    def test_decode_at_out_shape(self):
+        for order in ("F", "C"):
+            mask_rle = rle_encode(self.mask, order=order)
+            reduced = rle_decode(mask_rle, self.mask.shape, order=order, out_shape=(12, 16))
+            self.assertTrue((reduced == self.mask[2::4, 2::4]).all())
+
+    def test_decode_crop(self):
+        mask_rle = rle_encode(self.mask)
+        cropped = rle_decode(mask_rle, self.mask.shape, crop=(8, 4, 32, 40))
+        self.assertTrue((cropped == self.mask[8:40, 4:44]).all())
+
+        # fractional crops on a reduced grid match cropping the reduced mask
+        reduced = rle_decode(mask_rle, self.mask.shape, out_shape=(24, 32))
+        cropped = rle_decode(mask_rle, self.mask.shape, out_shape=(16, 16), crop=(6, 20, 32, 32))
+        self.assertTrue((cropped == reduced[3:19, 10:26]).all())
+
+    def test_cache(self):
+        mask_rle = rle_encode(self.mask)
+        packed_size = self.mask.size // 8
+        cache = RLEMaskCache(max_bytes=2 * packed_size)
+
+        for key in ("a", "b", "a", "c", "a", "b"):
+            self.assertTrue((cache.decode(key, mask_rle, self.mask.shape) == self.mask).all())
+        # "b" was evicted by "c" as the least recently used entry
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+        self.assertEqual((len(cache), cache.num_bytes), (2, 2 * packed_size))
+
+        reduced = cache.decode("a", mask_rle, self.mask.shape, out_shape=(12, 16))
+        self.assertTrue((reduced == self.mask[2::4, 2::4]).all())
+        self.assertEqual(cache.misses, 5)
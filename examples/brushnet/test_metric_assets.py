@@ -0,0 +1,89 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import metric_assets  # noqa: E402
+from metric_assets import MetricAssets, file_sha256  # noqa: E402
+
+
+class MetricAssetsTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmpdir.name, "weights.pth")
+        with open(self.source, "wb") as f:
+            f.write(b"weights")
+        # a URL asset served from the local file system
+        assets = mock.patch.dict(
+            metric_assets.ASSETS, {"test-asset": {"urls": {"weights/linear.pth": Path(self.source).as_uri()}}}
+        )
+        assets.start()
+        self.addCleanup(assets.stop)
+        self.cache_dir = os.path.join(self.tmpdir.name, "cache")
+        # the tests download unless they ask for offline mode themselves
+        environ = mock.patch.dict(os.environ)
+        environ.start()
+        self.addCleanup(environ.stop)
+        os.environ.pop("HF_HUB_OFFLINE", None)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_download_once(self):
+        path = MetricAssets(self.cache_dir).resolve("test-asset")["weights/linear.pth"]
+        self.assertEqual(path, os.path.join(self.cache_dir, "test-asset", "weights", "linear.pth"))
+        self.assertEqual(Path(path).read_bytes(), b"weights")
+
+        # the cached file is used without the source, and offline
+        os.remove(self.source)
+        self.assertEqual(MetricAssets(self.cache_dir, offline=True).resolve("test-asset")["weights/linear.pth"], path)
+
+    def test_offline(self):
+        with self.assertRaises(FileNotFoundError):
+            MetricAssets(self.cache_dir, offline=True).resolve("test-asset")
+        with mock.patch.dict(os.environ, {"HF_HUB_OFFLINE": "1"}):
+            self.assertTrue(MetricAssets(self.cache_dir).offline)
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, "test-asset")))
+
+    def test_checksum(self):
+        assets = MetricAssets(self.cache_dir)
+        path = assets.resolve("test-asset")["weights/linear.pth"]
+        self.assertEqual(assets._read_manifest()["test-asset"]["weights/linear.pth"]["sha256"], file_sha256(path))
+
+        # a file changed in place, with the same size and modification time, is only caught by a full check
+        stat = os.stat(path)
+        with open(path, "wb") as f:
+            f.write(b"WEIGHTS")
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        assets.resolve("test-asset")
+        with self.assertRaises(ValueError):
+            assets.resolve("test-asset", full_check=True)
+
+        # any other change is caught on every use
+        with open(path, "wb") as f:
+            f.write(b"other weights")
+        with self.assertRaises(ValueError):
+            assets.resolve("test-asset")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from metric_cache import MetricCache, content_hash, parse_args  # noqa: E402
+
+
+class MetricCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = MetricCache(os.path.join(self.tmpdir.name, "metric_cache.sqlite"))
+        self.hashes = ("output", "source", "mask", "prompt")
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def test_content_hash(self):
+        image = np.arange(12, dtype=np.uint8).reshape(3, 4)
+        self.assertEqual(content_hash(image), content_hash(image.copy()))
+        self.assertNotEqual(content_hash(image), content_hash(image.reshape(4, 3)))
+        self.assertNotEqual(content_hash(image), content_hash(image.astype(np.int64)))
+        self.assertNotEqual(content_hash("a cake"), content_hash("a cat"))
+
+    def test_get_and_put(self):
+        keys = [(*self.hashes, "PSNR", "v1"), (*self.hashes, "MSE", "v1")]
+        self.assertEqual(self.cache.get(keys), [None, None])
+        self.cache.put(keys[:1], [21.5])
+        self.assertEqual(self.cache.get(keys), [21.5, None])
+        # another metric model version is another score
+        self.assertEqual(self.cache.get([(*self.hashes, "PSNR", "v2")]), [None])
+
+        # the scores are shared by every connection to the cache
+        other = MetricCache(self.cache.path)
+        self.assertEqual(other.get(keys[:1]), [21.5])
+        other.close()
+
+    def test_prune(self):
+        keys = [(*self.hashes, "PSNR", "v1"), (*self.hashes, "PSNR", "v2"), (*self.hashes, "MSE", "v1")]
+        self.cache.put(keys, [1, 2, 3])
+        self.assertEqual(self.cache.prune(keep_versions={"PSNR": "v2"}), 1)
+        self.assertEqual(self.cache.stats(), [("MSE", "v1", 1, mock.ANY), ("PSNR", "v2", 1, mock.ANY)])
+
+        self.assertEqual(self.cache.prune(unused_for=3600), 0)
+        self.cache.connection.execute("UPDATE scores SET last_used=? WHERE metric='MSE'", (time.time() - 7200,))
+        self.assertEqual(self.cache.prune(unused_for=3600), 1)
+        self.assertEqual(self.cache.get([(*self.hashes, "PSNR", "v2")]), [2.0])
+
+    def test_prune_arguments(self):
+        self.assertTrue(parse_args(["prune", "--stale_versions"]).stale_versions)
+        with self.assertRaises(ValueError):
+            parse_args(["prune"])
+
+
+if __name__ == "__main__":
+    unittest.main()
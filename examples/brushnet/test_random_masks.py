@@ -0,0 +1,73 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+
+import numpy as np
+import torch
+
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from random_masks import random_brush_mask_conditioning, random_brush_masks  # noqa: E402
+
+
+class RandomBrushMaskTests(unittest.TestCase):
+    canvas_sizes = np.array([[96, 128], [128, 96], [64, 64], [96, 128]])
+    crops = np.array([[0, 16, 96, 96], [16, 0, 96, 96], [0, 0, 64, 64], [0, 32, 96, 96]])
+
+    def get_masks(self, seed, **kwargs):
+        generator = torch.Generator().manual_seed(seed)
+        return random_brush_masks(self.canvas_sizes, self.crops, (48, 48), generator=generator, **kwargs)
+
+    def test_seeded(self):
+        masks = self.get_masks(0, min_width=32, max_width=32)
+        self.assertEqual(masks.shape, (4, 1, 48, 48))
+        self.assertTrue(torch.equal(masks, self.get_masks(0, min_width=32, max_width=32)))
+        self.assertFalse(torch.equal(masks, self.get_masks(1, min_width=32, max_width=32)))
+        self.assertTrue(((masks == 0) | (masks == 1)).all())
+
+    def test_crop_resolution(self):
+        def get_mask(crop, out_shape):
+            generator = torch.Generator().manual_seed(0)
+            return random_brush_masks([[96, 128]], [crop], out_shape, generator=generator, min_width=32, max_width=32)
+
+        full = get_mask([0, 0, 96, 128], (96, 128))
+        self.assertGreater(full.sum(), 0)
+        # the same strokes are rasterized for any crop, at any resolution
+        self.assertTrue(torch.equal(full[:, :, :, 32:], get_mask([0, 32, 96, 96], (96, 96))))
+        half = get_mask([0, 32, 96, 96], (48, 48))
+        self.assertLess((full[:, :, ::2, 32::2] - half).abs().mean(), 0.05)
+
+    def test_stroke_distribution(self):
+        masks = torch.cat([self.get_masks(seed, max_tries=1) for seed in range(4)])
+        self.assertEqual(masks.sum(), 0)
+
+        masks = torch.cat([self.get_masks(seed, min_width=16, max_width=16) for seed in range(64)])
+        coverage = masks.mean().item()
+        self.assertGreater(coverage, 0.01)
+        self.assertLess(coverage, 0.5)
+
+    def test_conditioning(self):
+        pixel_values = torch.rand(4, 3, 48, 48) * 2 - 1
+        generator = torch.Generator().manual_seed(0)
+        conditioning_pixel_values, masks = random_brush_mask_conditioning(
+            pixel_values, self.canvas_sizes, self.crops, generator=generator
+        )
+        self.assertEqual(masks.shape, (4, 1, 48, 48))
+        kept = masks.expand(-1, 3, -1, -1) > 0
+        self.assertTrue(torch.equal(conditioning_pixel_values[kept], pixel_values[kept]))
+        self.assertTrue((conditioning_pixel_values[~kept] == -1).all())
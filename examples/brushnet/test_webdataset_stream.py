@@ -0,0 +1,126 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import sys
+import tarfile
+import tempfile
+import unittest
+
+import torch
+
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from webdataset_stream import WebDatasetStream, load_shard_index  # noqa: E402
+
+
+def write_shard(path, shard, num_samples):
+    with tarfile.open(path, "w") as tar:
+        for i in range(num_samples):
+            # a long key, stored with an extended header
+            key = f"{'sample' * 20 if i == 1 else ''}{shard}_{i:04d}"
+            for extension in ("caption", "height"):
+                data = f"{shard}-{i}".encode()
+                info = tarfile.TarInfo(f"{key}.{extension}")
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+
+def captions(batch):
+    return [example["caption"].decode() for example in batch]
+
+
+class WebDatasetStreamTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.shard_paths = []
+        for shard, num_samples in enumerate([7, 5, 9, 3]):
+            self.shard_paths.append(os.path.join(self.tmpdir.name, f"{shard:06d}.tar"))
+            write_shard(self.shard_paths[-1], shard, num_samples)
+        self.shard_index = load_shard_index(self.shard_paths)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read_epoch(self, world_size, batch_size, num_workers=0, **kwargs):
+        batches = []
+        for rank in range(world_size):
+            stream = WebDatasetStream(
+                self.shard_paths, self.shard_index, batch_size=batch_size, rank=rank, world_size=world_size, **kwargs
+            )
+            dataloader = torch.utils.data.DataLoader(
+                stream, batch_size=batch_size, num_workers=num_workers, collate_fn=captions
+            )
+            batches.append(list(dataloader))
+        return batches
+
+    def test_shard_index(self):
+        self.assertEqual([len(offsets) - 1 for offsets in self.shard_index], [7, 5, 9, 3])
+        cache_path = os.path.join(self.tmpdir.name, "cache", "shard_index.json")
+        load_shard_index(self.shard_paths, cache_path=cache_path)
+        cached = load_shard_index(self.shard_paths, cache_path=cache_path)
+        self.assertTrue(all((a == b).all() for a, b in zip(cached, self.shard_index)))
+
+    def test_samples(self):
+        (batches,) = self.read_epoch(1, 1)
+        samples = [caption for batch in batches for caption in batch]
+        self.assertEqual(samples[:8], [f"0-{i}" for i in range(7)] + ["1-0"])
+        stream = WebDatasetStream(self.shard_paths, self.shard_index)
+        sample = next(iter(stream))
+        self.assertEqual(sample["__key__"], "0_0000")
+        self.assertEqual(sample["__url__"], self.shard_paths[0])
+        self.assertEqual(sample["height"], b"0-0")
+
+    def test_disjoint_ranks(self):
+        batches = self.read_epoch(3, 2, shuffle_buffer_size=4, seed=1)
+        # 24 samples over 3 processes, 4 batches of 2 each
+        self.assertEqual([len(rank_batches) for rank_batches in batches], [4, 4, 4])
+        samples = [caption for rank_batches in batches for batch in rank_batches for caption in batch]
+        self.assertEqual(len(set(samples)), 24)
+
+    def test_workers(self):
+        batches = self.read_epoch(2, 2, shuffle_buffer_size=4, seed=1)
+        self.assertEqual(self.read_epoch(2, 2, num_workers=2, shuffle_buffer_size=4, seed=1), batches)
+
+    def test_shuffle(self):
+        first_epoch = self.read_epoch(1, 4, shuffle_buffer_size=4, seed=1)
+        self.assertEqual(self.read_epoch(1, 4, shuffle_buffer_size=4, seed=1), first_epoch)
+        stream = WebDatasetStream(self.shard_paths, self.shard_index, batch_size=4, shuffle_buffer_size=4, seed=1)
+        stream.set_epoch(1)
+        second_epoch = list(torch.utils.data.DataLoader(stream, batch_size=4, collate_fn=captions))
+        self.assertNotEqual(second_epoch, first_epoch[0])
+        self.assertEqual(sorted(sum(second_epoch, [])), sorted(sum(first_epoch[0], [])))
+
+    def test_resume(self):
+        (batches,) = self.read_epoch(1, 2, shuffle_buffer_size=4, seed=1)
+        stream = WebDatasetStream(self.shard_paths, self.shard_index, batch_size=2, shuffle_buffer_size=4, seed=1)
+        for _ in torch.utils.data.DataLoader(stream, batch_size=2, collate_fn=captions):
+            stream.batches_consumed += 1
+            if stream.batches_consumed == 5:
+                break
+
+        resumed = WebDatasetStream(self.shard_paths, self.shard_index, batch_size=2, shuffle_buffer_size=4, seed=1)
+        resumed.load_state_dict(stream.state_dict())
+        resumed.set_epoch(0)
+        dataloader = torch.utils.data.DataLoader(resumed, batch_size=2, num_workers=2, collate_fn=captions)
+        self.assertEqual(list(dataloader), batches[5:])
+
+        with self.assertRaises(ValueError):
+            WebDatasetStream(self.shard_paths[1:], batch_size=2).load_state_dict(stream.state_dict())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,6 +4,7 @@
 import argparse
 import contextlib
 import gc
+import hashlib
 import logging
 import math
 import os
@@ -23,14 +24,23 @@ from torch.utils.data import Dataset
 import transformers
 from accelerate import Accelerator
 from accelerate.logging import get_logger
-from accelerate.utils import ProjectConfiguration, set_seed
-from datasets import load_dataset
+from accelerate.data_loader import DataLoaderShard
+from accelerate.utils import ProjectConfiguration, gather_object, set_seed
+from async_checkpoint import (
+    AsyncCheckpointWriter,
+    collect_random_states,
+    is_async_checkpoint,
+    load_async_checkpoint,
+)
 from huggingface_hub import create_repo, upload_folder
 from packaging import version
 from PIL import Image, ImageDraw
 from torchvision import transforms
 from tqdm.auto import tqdm
 from transformers import AutoTokenizer, PretrainedConfig
+from mask_rle import RLEMaskCache, rle_decode
+from random_masks import random_brush_mask_conditioning
+from webdataset_stream import WebDatasetStream, load_shard_index
 
 import diffusers
 from diffusers import (
@@ -41,6 +51,7 @@ from diffusers import (
     UNet2DConditionModel,
     UniPCMultistepScheduler,
 )
+from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
 from diffusers.optimization import get_scheduler
 from diffusers.utils import check_min_version, is_wandb_available
 from diffusers.utils.hub_utils import load_or_create_model_card, populate_model_card
@@ -323,6 +334,15 @@ def parse_args(input_args=None):
         default=None,
         help=("Max number of checkpoints to store."),
     )
+    parser.add_argument(
+        "--async_checkpointing",
+        action="store_true",
+        help=(
+            "Write the checkpoints from a background thread. Only the BrushNet weights and the optimizer state are"
+            " copied to CPU memory in the training loop; they are written as safetensors while training continues, and"
+            " a checkpoint only appears under its name once it is complete."
+        ),
+    )
     parser.add_argument(
         "--resume_from_checkpoint",
         type=str,
@@ -570,6 +590,82 @@ def parse_args(input_args=None):
             "Training BrushNet with random mask"
         ),
     )
+    parser.add_argument(
+        "--timesteps_per_sample",
+        type=int,
+        default=1,
+        help=(
+            "The number of timesteps, each with its own noise, that every sample is trained at in one step. The"
+            " decoded images, their latents and text embeddings are reused for all of them, and the timesteps are"
+            " stratified over the noise schedule. The loss averages over all of them, so the gradient scale and the"
+            " learning rate don't depend on this value."
+        ),
+    )
+    parser.add_argument(
+        "--shuffle_buffer_size",
+        type=int,
+        default=1000,
+        help=(
+            "The number of samples every process shuffles the training stream with. The shards are also shuffled every"
+            " epoch. 0 reads the shards and their samples in order."
+        ),
+    )
+    parser.add_argument(
+        "--precomputed_latents_dir",
+        type=str,
+        default=None,
+        help=(
+            "A directory for the VAE latent distributions of the whole dataset, for training with the segmentation"
+            " masks (without `--random_mask`). If set, every image is center cropped and encoded once before"
+            " training, together with every masked variant of it (each mask, with the masked region kept or swapped),"
+            " and the training loop samples from the stored distributions instead of running the VAE encoder."
+            " Existing latents are reused when the data, the VAE and `--resolution` match. This changes the"
+            " augmentation: the random crop is replaced by the center crop, the masks are not opened (eroded and"
+            " dilated, otherwise done for 30% of the samples), and only `--precompute_max_masks` masks per image"
+            " are trained on."
+        ),
+    )
+    parser.add_argument(
+        "--precompute_batch_size",
+        type=int,
+        default=16,
+        help="Batch size (per device) for encoding the images when `--precomputed_latents_dir` is set.",
+    )
+    parser.add_argument(
+        "--precompute_max_masks",
+        type=int,
+        default=4,
+        help=(
+            "The number of segmentation masks per image, picked at random, that masked variants are stored for when"
+            " `--precomputed_latents_dir` is set."
+        ),
+    )
+    parser.add_argument(
+        "--device_random_mask",
+        action="store_true",
+        help=(
+            "With `--random_mask`, draw the random masks for the whole batch on the training device instead of in the"
+            " dataloader workers. Seeded with `--seed` on every process."
+        ),
+    )
+    parser.add_argument(
+        "--mask_cache_mb",
+        type=int,
+        default=0,
+        help=(
+            "Size in MB of the bit-packed LRU cache of decoded segmentation masks kept by every dataloader worker."
+            " Masks are keyed by sample and mask index, so they are only decoded once while they stay cached."
+            " Defaults to 0 (masks are decoded for every sample)."
+        ),
+    )
+    parser.add_argument(
+        "--full_resolution_decode",
+        action="store_true",
+        help=(
+            "Decode training images at their full source resolution. By default JPEGs are decoded at the largest DCT"
+            " scale-down (1/2, 1/4 or 1/8) whose short side still covers `--resolution`."
+        ),
+    )
 
     if input_args is not None:
         args = parser.parse_args(input_args)
@@ -585,6 +681,17 @@ def parse_args(input_args=None):
     if args.proportion_empty_prompts < 0 or args.proportion_empty_prompts > 1:
         raise ValueError("`--proportion_empty_prompts` must be in the range [0, 1].")
 
+    if args.timesteps_per_sample < 1:
+        raise ValueError("`--timesteps_per_sample` must be at least 1.")
+
+    if args.device_random_mask and not args.random_mask:
+        raise ValueError("`--device_random_mask` requires `--random_mask`.")
+
+    if args.precomputed_latents_dir is not None and args.random_mask:
+        raise ValueError(
+            "`--precomputed_latents_dir` only stores the segmentation masks, it can't be used with `--random_mask`."
+        )
+
     if args.validation_prompt is not None and args.validation_image is None:
         raise ValueError("`--validation_image` must be set if `--validation_prompt` is set")
 
@@ -612,10 +719,27 @@ def parse_args(input_args=None):
 
 
 class MyWebDataset():
-    def __init__(self,resolution,tokenizer,random_mask):
+    # JPEG DCT scale-downs supported by `cv2.imdecode`, keyed by the size reduction factor
+    reduced_decode_flags = {
+        8: cv2.IMREAD_REDUCED_COLOR_8,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        1: cv2.IMREAD_COLOR,
+    }
+
+    def __init__(
+        self,resolution,tokenizer,random_mask,proportion_empty_prompts=0,full_resolution_decode=False,mask_cache_mb=0,
+        device_random_mask=False,
+    ):
         self.resolution = resolution
         self.tokenizer = tokenizer
         self.random_mask = random_mask
+        # leave the random masks to `random_brush_mask_conditioning` in the training loop
+        self.device_random_mask = random_mask and device_random_mask
+        self.proportion_empty_prompts = proportion_empty_prompts
+        self.full_resolution_decode = full_resolution_decode
+        # every dataloader worker holds its own copy of the cache
+        self.mask_cache = RLEMaskCache(mask_cache_mb * 2**20) if mask_cache_mb > 0 else None
 
     def random_brush_gen(
         self,
@@ -674,25 +798,23 @@ class MyWebDataset():
         return mask
 
 
-    def random_mask_gen(self, h, w):
+    def random_mask_gen(self, h, w, brush_width=128):
         mask = np.ones((h, w), np.uint8)
-        mask = np.logical_and(mask, 1 - self.random_brush_gen(4, h, w))  # hole denoted as 0, reserved as 1
+        mask = np.logical_and(mask, 1 - self.random_brush_gen(4, h, w, min_width=brush_width, max_width=brush_width))  # hole denoted as 0, reserved as 1
         return mask[np.newaxis, ...].astype(np.float32)
 
 
-    def rle2mask(self, mask_rle, shape):# height width
-        # Decode rle encoded mask.
-        mask_rle=np.array(mask_rle)
-        starts, lengths = [np.asarray(x, dtype=int) for x in (mask_rle[0:][::2], mask_rle[1:][::2])]
-        starts -= 1
-        ends = starts + lengths
-        img = np.zeros(shape[0] * shape[1], dtype=np.uint8)
-        for lo, hi in zip(starts, ends):
-            img[lo:hi] = 1
-        return img.reshape(shape, order='F')
+    def decode_scale_factor(self, height, width):
+        # largest JPEG scale-down whose decoded short side still covers the training resolution
+        if self.full_resolution_decode:
+            return 1
+        for factor in (8, 4, 2):
+            if min(height, width) // factor >= self.resolution:
+                return factor
+        return 1
 
     def tokenize_captions(self, caption, is_train=True):
-        if random.random() < args.proportion_empty_prompts:
+        if random.random() < self.proportion_empty_prompts:
             caption=""
         elif isinstance(caption, str):
             caption=caption
@@ -701,37 +823,107 @@ class MyWebDataset():
             caption=random.choice(caption) if is_train else caption[0]
         else:
             raise ValueError(
-                f"Caption column `{caption_column}` should contain either strings or lists of strings."
+                "Caption should contain either strings or lists of strings."
             )
         inputs = self.tokenizer(
             caption, max_length=self.tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
         )
         return inputs.input_ids
 
+    def to_pixel_values(self, image):
+        image=cv2.resize(image,(self.resolution,self.resolution),interpolation=cv2.INTER_CUBIC)
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        image = (image.astype(np.float32) / 127.5) - 1.0
+        return torch.tensor(image).permute(2,0,1)
+
+    def fixed_mask_variants(self, example, max_masks=None):
+        # the center crop of an example with its segmentation masks, each with the masked region kept and swapped
+        caption=example["caption"].decode('utf-8')
+        height=int(example["height"].decode('utf-8'))
+        width=int(example["width"].decode('utf-8'))
+        factor=self.decode_scale_factor(height,width)
+        image = cv2.imdecode(np.asarray(bytearray(example["image"]), dtype="uint8"), self.reduced_decode_flags[factor])
+        segmentation = json.loads(example["segmentation"])
+
+        w,h,c=image.shape
+        crop_size=min(w,h)
+        top,left=(w-crop_size)//2,(h-crop_size)//2
+        image=image[top:top+crop_size,left:left+crop_size,:]
+        crop=(top*height/w,left*width/h,crop_size*height/w,crop_size*width/h)
+
+        mask_rles=segmentation["mask"]
+        if max_masks is not None and len(mask_rles)>max_masks:
+            mask_rles=random.sample(mask_rles,max_masks)
+        masks=[
+            rle_decode(mask_rle,(height,width),out_shape=(crop_size,crop_size),crop=crop)[:,:,np.newaxis]
+            for mask_rle in mask_rles
+        ]
+        if len(masks)==0:
+            masks=[np.ones_like(image)[:,:,[0]]]
+
+        conditioning_pixel_values=[]
+        resized_masks=[]
+        for mask in masks:
+            for mask in (mask,1-mask):
+                conditioning_pixel_values.append(self.to_pixel_values(image*mask))
+                mask=cv2.resize(mask,(self.resolution,self.resolution),interpolation=cv2.INTER_CUBIC)[:,:,np.newaxis]
+                resized_masks.append(torch.tensor(mask.astype(np.float32)).permute(2,0,1))
+
+        return caption, self.to_pixel_values(image), torch.stack(conditioning_pixel_values), torch.stack(resized_masks)
+
     def __call__(self,examples):
         pixel_values=[]
         conditioning_pixel_values=[]
         masks=[]
+        mask_canvases=[]
         input_ids=[]
         
         for example in examples:
             caption=example["caption"].decode('utf-8')
             height=int(example["height"].decode('utf-8'))
             width=int(example["width"].decode('utf-8'))
-            image = cv2.imdecode(np.asarray(bytearray(example["image"]), dtype="uint8"), cv2.IMREAD_COLOR)
+            # decode straight to the smallest size that still covers `resolution`, and build the mask at that size
+            factor=self.decode_scale_factor(height,width)
+            image = cv2.imdecode(np.asarray(bytearray(example["image"]), dtype="uint8"), self.reduced_decode_flags[factor])
             segmentation = json.loads(example["segmentation"])
 
-            if len(segmentation["mask"])>0:
-                mask=self.rle2mask(random.choice(segmentation["mask"]),(height,width))[:,:,np.newaxis]
+            # random square crop over the short side, taken before resizing so only the kept pixels are resampled
+            w,h,c=image.shape
+            crop_size=min(w,h)
+            random_crop=[random.randint(0,w-crop_size),random.randint(0,h-crop_size)]
+            image=image[random_crop[0]:random_crop[0]+crop_size,random_crop[1]:random_crop[1]+crop_size,:]
+
+            if self.device_random_mask:
+                # source image size and crop, in source pixels
+                mask_canvases.append(
+                    [height,width,random_crop[0]*height/w,random_crop[1]*width/h,crop_size*height/w,crop_size*width/h]
+                )
+                pixel_values.append(self.to_pixel_values(image))
+                input_ids.append(self.tokenize_captions(caption)[0])
+                continue
+
+            if self.random_mask:
+                mask = self.random_mask_gen(w,h,brush_width=128//factor)[0][:,:,np.newaxis]
+                mask=mask[random_crop[0]:random_crop[0]+crop_size,random_crop[1]:random_crop[1]+crop_size,:]
+            elif len(segmentation["mask"])>0:
+                mask_index=random.randrange(len(segmentation["mask"]))
+                mask_rle=segmentation["mask"][mask_index]
+                if self.mask_cache is not None and "__key__" in example:
+                    mask=self.mask_cache.decode(
+                        (example.get("__url__"),example["__key__"],mask_index),mask_rle,(height,width),out_shape=(w,h)
+                    )
+                    mask=mask[random_crop[0]:random_crop[0]+crop_size,random_crop[1]:random_crop[1]+crop_size,np.newaxis]
+                else:
+                    # decode only the crop, on the grid of the decoded image
+                    crop=(random_crop[0]*height/w,random_crop[1]*width/h,crop_size*height/w,crop_size*width/h)
+                    mask=rle_decode(mask_rle,(height,width),out_shape=(crop_size,crop_size),crop=crop)[:,:,np.newaxis]
             else:
                 mask=np.ones_like(image)[:,:,[0]]
-            
-            if self.random_mask:
-                mask = self.random_mask_gen(image.shape[0],image.shape[1])[0][:,:,np.newaxis]
 
             
             if random.random()<0.3:
-                kernel = np.ones((8,8),np.uint8)  
+                kernel_size=max(1,8//factor)
+                kernel = np.ones((kernel_size,kernel_size),np.uint8)  
                 mask_erosion = cv2.erode(mask,kernel,iterations = 1)
                 mask_dilation = cv2.dilate(mask_erosion,kernel,iterations = 1)
                 mask=1*(mask_dilation>0)[:,:,np.newaxis]
@@ -742,44 +934,33 @@ class MyWebDataset():
             if random.random()<0.5:
                 masked_image=image-masked_image
                 mask=1-mask
-            
-            w,h,c=image.shape
-            if w>h:
-                scale=self.resolution/h          
-            else:
-                scale=self.resolution/w
-            w_new=int(np.ceil(w*scale))
-            h_new=int(np.ceil(h*scale))
-            
-            image=cv2.resize(image,(h_new,w_new),interpolation=cv2.INTER_CUBIC)
-            masked_image=cv2.resize(masked_image,(h_new,w_new),interpolation=cv2.INTER_CUBIC)
-            mask=cv2.resize(mask,(h_new,w_new),interpolation=cv2.INTER_CUBIC)[:,:,np.newaxis]
-
-            random_crop=[random.randint(0,w_new-self.resolution),random.randint(0,h_new-self.resolution)]
-
-            image=image[random_crop[0]:random_crop[0]+self.resolution,random_crop[1]:random_crop[1]+self.resolution,:]
-            masked_image=masked_image[random_crop[0]:random_crop[0]+self.resolution,random_crop[1]:random_crop[1]+self.resolution,:]
-            mask=mask[random_crop[0]:random_crop[0]+self.resolution,random_crop[1]:random_crop[1]+self.resolution,:]
-            
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            masked_image = cv2.cvtColor(masked_image, cv2.COLOR_BGR2RGB)
-            image = (image.astype(np.float32) / 127.5) - 1.0
-            masked_image = (masked_image.astype(np.float32) / 127.5) - 1.0
 
+            mask=cv2.resize(mask,(self.resolution,self.resolution),interpolation=cv2.INTER_CUBIC)[:,:,np.newaxis]
             mask=mask.astype(np.float32)
 
-            pixel_values.append(torch.tensor(image).permute(2,0,1))
-            conditioning_pixel_values.append(torch.tensor(masked_image).permute(2,0,1))
+            pixel_values.append(self.to_pixel_values(image))
+            conditioning_pixel_values.append(self.to_pixel_values(masked_image))
             masks.append(torch.tensor(mask).permute(2,0,1))
             input_ids.append(self.tokenize_captions(caption)[0])
 
         pixel_values = torch.stack(pixel_values)
         pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
+        input_ids = torch.stack(input_ids)
+
+        if self.device_random_mask:
+            # kept as arrays so that they stay on the host when the batch is moved to the device
+            mask_canvases = np.array(mask_canvases)
+            return {
+                "pixel_values": pixel_values,
+                "mask_canvas_sizes": mask_canvases[:,:2],
+                "mask_crops": mask_canvases[:,2:],
+                "input_ids": input_ids,
+            }
+
         conditioning_pixel_values = torch.stack(conditioning_pixel_values)
         conditioning_pixel_values = conditioning_pixel_values.to(memory_format=torch.contiguous_format).float()
         masks = torch.stack(masks)
         masks = masks.to(memory_format=torch.contiguous_format).float()
-        input_ids = torch.stack(input_ids)
 
         return {
             "pixel_values": pixel_values,
@@ -789,6 +970,170 @@ class MyWebDataset():
         }
 
 
+class LatentStore(Dataset):
+    r"""
+    Reads the VAE latent distributions written by `precompute_latents`. Every item is the target image of a sample with
+    one of its masked variants, picked at random. The shards are memory-mapped on first access, so every DataLoader
+    worker shares the page cache instead of unpickling its own copy.
+    """
+
+    def __init__(self, path, tokenizer, proportion_empty_prompts=0):
+        self.path = path
+        self.tokenizer = tokenizer
+        self.proportion_empty_prompts = proportion_empty_prompts
+        with open(os.path.join(path, "metadata.json")) as f:
+            metadata = json.load(f)
+        self.shard_names = [shard["name"] for shard in metadata["shards"]]
+        self.shard_offsets = np.cumsum([0] + [shard["num_samples"] for shard in metadata["shards"]])
+        self._shards = None
+
+    def __len__(self):
+        return int(self.shard_offsets[-1])
+
+    def __getstate__(self):
+        # send the paths to the DataLoader workers, not the mapped arrays
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        return state
+
+    def _open(self):
+        self._shards = []
+        for name in self.shard_names:
+            shard = {
+                key: np.load(os.path.join(self.path, f"{key}-{name}.npy"), mmap_mode="r")
+                for key in ("latents", "conditioning_latents", "masks", "variant_offsets")
+            }
+            with open(os.path.join(self.path, f"captions-{name}.json")) as f:
+                shard["captions"] = json.load(f)
+            self._shards.append(shard)
+
+    def __getitem__(self, index):
+        if self._shards is None:
+            self._open()
+        shard_index = np.searchsorted(self.shard_offsets, index, side="right") - 1
+        shard = self._shards[shard_index]
+        index = index - self.shard_offsets[shard_index]
+        variant = random.randrange(shard["variant_offsets"][index], shard["variant_offsets"][index + 1])
+
+        caption = "" if random.random() < self.proportion_empty_prompts else shard["captions"][index]
+        input_ids = self.tokenizer(
+            caption,
+            max_length=self.tokenizer.model_max_length,
+            padding="max_length",
+            truncation=True,
+            return_tensors="pt",
+        ).input_ids[0]
+        return {
+            "latent_parameters": torch.from_numpy(np.array(shard["latents"][index])),
+            "conditioning_latent_parameters": torch.from_numpy(np.array(shard["conditioning_latents"][variant])),
+            "masks": torch.from_numpy(shard["masks"][variant].astype(np.float32)),
+            "input_ids": input_ids,
+        }
+
+
+def precompute_latents(
+    train_dataset,
+    vae,
+    collate,
+    output_dir,
+    accelerator,
+    batch_size=16,
+    shard_size=1000,
+    max_masks=None,
+    fingerprint=None,
+):
+    r"""
+    Encodes the center crop of every example of `train_dataset` with `vae`, together with the masked variants built by
+    `collate.fixed_mask_variants`, and writes the float16 latent distribution parameters to `.npy` shards of up to
+    `shard_size` samples in `output_dir`. The masks are stored at the latent resolution. The examples are split over
+    the processes of `accelerator`. Returns a `LatentStore` reading them back, and reuses the shards of a previous run
+    with the same `fingerprint`.
+    """
+    metadata_path = os.path.join(output_dir, "metadata.json")
+    if os.path.isfile(metadata_path):
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        if metadata["fingerprint"] == fingerprint:
+            logger.info(f"Reusing the latents in {output_dir}")
+            return LatentStore(output_dir, collate.tokenizer, collate.proportion_empty_prompts)
+
+    accelerator.wait_for_everyone()
+    if accelerator.is_main_process:
+        os.makedirs(output_dir, exist_ok=True)
+        if os.path.isfile(metadata_path):
+            os.remove(metadata_path)
+    accelerator.wait_for_everyone()
+
+    def encode(pixel_values):
+        parameters = []
+        for start in range(0, len(pixel_values), batch_size):
+            batch = pixel_values[start : start + batch_size].to(accelerator.device, dtype=vae.dtype)
+            parameters.append(vae.encode(batch).latent_dist.parameters.to(torch.float16).cpu())
+        return torch.cat(parameters)
+
+    shards = []
+    buffer = {"latents": [], "conditioning_latents": [], "masks": [], "num_variants": [], "captions": []}
+
+    def write_shard():
+        name = f"{accelerator.process_index:03d}-{len(shards):05d}"
+        for key in ("latents", "conditioning_latents", "masks"):
+            np.save(os.path.join(output_dir, f"{key}-{name}.npy"), torch.cat(buffer[key]).numpy())
+        variant_offsets = np.cumsum([0] + buffer["num_variants"])
+        np.save(os.path.join(output_dir, f"variant_offsets-{name}.npy"), variant_offsets)
+        with open(os.path.join(output_dir, f"captions-{name}.json"), "w") as f:
+            json.dump(buffer["captions"], f)
+        shards.append({"name": name, "num_samples": len(buffer["captions"])})
+        for value in buffer.values():
+            value.clear()
+
+    pending = []
+
+    def encode_pending():
+        captions, pixel_values, conditioning_pixel_values, masks = zip(*pending)
+        latents = encode(torch.stack(pixel_values))
+        conditioning_latents = encode(torch.cat(conditioning_pixel_values))
+        # the nearest neighbor downsampling the training loop applies to the masks of `MyWebDataset`
+        masks = F.interpolate(torch.cat(masks), size=latents.shape[-2:]).to(torch.uint8)
+        buffer["latents"].append(latents)
+        buffer["conditioning_latents"].append(conditioning_latents)
+        buffer["masks"].append(masks)
+        buffer["num_variants"].extend(len(variants) for variants in conditioning_pixel_values)
+        buffer["captions"].extend(captions)
+        pending.clear()
+        if len(buffer["captions"]) >= shard_size:
+            write_shard()
+
+    progress_bar = tqdm(desc="Encoding images", disable=not accelerator.is_local_main_process)
+    with torch.no_grad():
+        for index, example in enumerate(train_dataset):
+            if index % accelerator.num_processes != accelerator.process_index:
+                continue
+            pending.append(collate.fixed_mask_variants(example, max_masks=max_masks))
+            if len(pending) == batch_size:
+                encode_pending()
+            progress_bar.update(1)
+        if len(pending) > 0:
+            encode_pending()
+    if len(buffer["captions"]) > 0:
+        write_shard()
+    progress_bar.close()
+    with open(os.path.join(output_dir, f"shards-{accelerator.process_index:03d}.json"), "w") as f:
+        json.dump(shards, f)
+
+    # the metadata is written last, so an interrupted run is never mistaken for a complete one
+    accelerator.wait_for_everyone()
+    if accelerator.is_main_process:
+        shards = []
+        for process_index in range(accelerator.num_processes):
+            with open(os.path.join(output_dir, f"shards-{process_index:03d}.json")) as f:
+                shards.extend(json.load(f))
+        with open(metadata_path, "w") as f:
+            json.dump({"shards": shards, "fingerprint": fingerprint}, f)
+    accelerator.wait_for_everyone()
+
+    return LatentStore(output_dir, collate.tokenizer, collate.proportion_empty_prompts)
+
+
 # def make_train_dataset(args, tokenizer, accelerator):
 #     # Get the datasets: you can either provide your own training and evaluation files (see below)
 #     # or specify a Dataset from the hub (the dataset will be downloaded automatically from the datasets Hub).
@@ -1025,6 +1370,11 @@ def main(args):
 
                     i -= 1
 
+                # the position of the training stream, the same on every process
+                if args.precomputed_latents_dir is None:
+                    with open(os.path.join(output_dir, "data_stream.json"), "w") as f:
+                        json.dump(train_stream.state_dict(), f)
+
         def load_model_hook(models, input_dir):
             while len(models) > 0:
                 # pop models so that they are not loaded again
@@ -1106,6 +1456,14 @@ def main(args):
         eps=args.adam_epsilon,
     )
 
+    # For mixed precision training we cast the text_encoder and vae weights to half-precision
+    # as these models are only used for inference, keeping weights in full precision is not required.
+    weight_dtype = torch.float32
+    if accelerator.mixed_precision == "fp16":
+        weight_dtype = torch.float16
+    elif accelerator.mixed_precision == "bf16":
+        weight_dtype = torch.bfloat16
+
     # train_dataset = make_train_dataset(args, tokenizer, accelerator)
 
     # train_dataloader = torch.utils.data.DataLoader(
@@ -1115,19 +1473,85 @@ def main(args):
     #     batch_size=args.train_batch_size,
     #     num_workers=args.dataloader_num_workers,
     # )
-    train_dataset = load_dataset("webdataset", 
-                    data_files={"train": os.path.join(args.train_data_dir,"*.tar")}, 
-                    split="train", 
-                    streaming=True)
-    train_dataset_len= 10000*len(os.listdir(args.train_data_dir))
-    train_dataloader = torch.utils.data.DataLoader(
-        train_dataset,
-        shuffle=False,
-        collate_fn=MyWebDataset(resolution = args.resolution, tokenizer=tokenizer,random_mask=args.random_mask),
-        batch_size=args.train_batch_size,
-        num_workers=args.dataloader_num_workers,
+    shard_paths = sorted(
+        os.path.join(args.train_data_dir, shard) for shard in os.listdir(args.train_data_dir) if shard.endswith(".tar")
+    )
+    # the main process indexes the shards first, the others read its cached index
+    with accelerator.main_process_first():
+        shard_index = load_shard_index(shard_paths, cache_path=os.path.join(args.output_dir, "shard_index.json"))
+    collate_fn=MyWebDataset(
+        resolution=args.resolution,
+        tokenizer=tokenizer,
+        random_mask=args.random_mask,
+        proportion_empty_prompts=args.proportion_empty_prompts,
+        full_resolution_decode=args.full_resolution_decode,
+        mask_cache_mb=args.mask_cache_mb,
+        device_random_mask=args.device_random_mask,
     )
-    train_dataloader_len=train_dataset_len//args.train_batch_size
+    if args.precomputed_latents_dir is not None:
+        logger.warning(
+            "Training on precomputed latents: the images are center cropped instead of randomly cropped, the masks"
+            f" are not opened, and at most {args.precompute_max_masks} masks per image (`--precompute_max_masks`)"
+            " are used."
+        )
+        # Encode every image and its masked variants once, instead of twice per step in the training loop. The
+        # samples can then be shuffled, as the store is a map-style dataset.
+        shards = sorted(os.listdir(args.train_data_dir))
+        fingerprint = hashlib.sha256(
+            json.dumps(
+                [
+                    args.pretrained_model_name_or_path,
+                    args.revision,
+                    args.variant,
+                    args.resolution,
+                    args.full_resolution_decode,
+                    args.precompute_max_masks,
+                    args.seed,
+                    [(shard, os.path.getsize(os.path.join(args.train_data_dir, shard))) for shard in shards],
+                ],
+                default=str,
+            ).encode()
+        ).hexdigest()
+        vae.to(accelerator.device, dtype=weight_dtype)
+        train_dataset = precompute_latents(
+            WebDatasetStream(shard_paths, shard_index),
+            vae,
+            collate_fn,
+            args.precomputed_latents_dir,
+            accelerator,
+            batch_size=args.precompute_batch_size,
+            max_masks=args.precompute_max_masks,
+            fingerprint=fingerprint,
+        )
+        train_dataset_len = len(train_dataset)
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            shuffle=True,
+            batch_size=args.train_batch_size,
+            num_workers=args.dataloader_num_workers,
+        )
+        train_dataloader_len = train_dataset_len // args.train_batch_size
+    else:
+        # Every process streams its own samples, so the dataloader is not sharded by `accelerator.prepare`, which
+        # would read every batch on the main process and dispatch it.
+        train_stream = WebDatasetStream(
+            shard_paths,
+            shard_index,
+            batch_size=args.train_batch_size,
+            shuffle_buffer_size=args.shuffle_buffer_size,
+            seed=args.seed if args.seed is not None else 0,
+            rank=accelerator.process_index,
+            world_size=accelerator.num_processes,
+        )
+        train_dataset_len = train_stream.num_samples
+        train_dataloader = DataLoaderShard(
+            train_stream,
+            device=accelerator.device,
+            collate_fn=collate_fn,
+            batch_size=args.train_batch_size,
+            num_workers=args.dataloader_num_workers,
+        )
+        train_dataloader_len = train_stream.num_batches
 
 
     # Scheduler and math around the number of training steps.
@@ -1147,17 +1571,9 @@ def main(args):
     )
 
     # Prepare everything with our `accelerator`.
-    brushnet, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
-        brushnet, optimizer, train_dataloader, lr_scheduler
-    )
-
-    # For mixed precision training we cast the text_encoder and vae weights to half-precision
-    # as these models are only used for inference, keeping weights in full precision is not required.
-    weight_dtype = torch.float32
-    if accelerator.mixed_precision == "fp16":
-        weight_dtype = torch.float16
-    elif accelerator.mixed_precision == "bf16":
-        weight_dtype = torch.bfloat16
+    brushnet, optimizer, lr_scheduler = accelerator.prepare(brushnet, optimizer, lr_scheduler)
+    if args.precomputed_latents_dir is not None:
+        train_dataloader = accelerator.prepare(train_dataloader)
 
     # Move vae, unet and text_encoder to device and cast to weight_dtype
     vae.to(accelerator.device, dtype=weight_dtype)
@@ -1194,10 +1610,17 @@ def main(args):
     logger.info(f"  Instantaneous batch size per device = {args.train_batch_size}")
     logger.info(f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}")
     logger.info(f"  Gradient Accumulation steps = {args.gradient_accumulation_steps}")
+    logger.info(f"  Timesteps per sample = {args.timesteps_per_sample}")
+    logger.info(f"  Loss terms per optimization step = {total_batch_size * args.timesteps_per_sample}")
     logger.info(f"  Total optimization steps = {args.max_train_steps}")
     global_step = 0
     first_epoch = 0
 
+    # draws the `--device_random_mask` masks, seeded separately on every process
+    mask_generator = None
+    if args.device_random_mask and args.seed is not None:
+        mask_generator = torch.Generator(device=accelerator.device).manual_seed(args.seed + accelerator.process_index)
+
     # Potentially load in the weights and states from a previous save
     if args.resume_from_checkpoint:
         if args.resume_from_checkpoint != "latest":
@@ -1217,11 +1640,39 @@ def main(args):
             initial_global_step = 0
         else:
             accelerator.print(f"Resuming from checkpoint {path}")
-            accelerator.load_state(os.path.join(args.output_dir, path),map_location="cpu")
+            checkpoint_path = os.path.join(args.output_dir, path)
             global_step = int(path.split("-")[1])
+            restored_random_states = False
+            if is_async_checkpoint(checkpoint_path):
+                restored_random_states = load_async_checkpoint(
+                    checkpoint_path,
+                    unwrap_model(brushnet),
+                    optimizer,
+                    lr_scheduler,
+                    scaler=accelerator.scaler,
+                    process_index=accelerator.process_index,
+                    generators={"mask_generator": mask_generator},
+                )
+                if not restored_random_states and args.seed is not None:
+                    # saved by fewer processes, this one is seeded apart from the others and from the first run
+                    set_seed(args.seed + global_step, device_specific=True)
+            else:
+                accelerator.load_state(checkpoint_path,map_location="cpu")
+            if not restored_random_states and mask_generator is not None:
+                # `accelerator.save_state` does not store the mask generator
+                mask_generator.manual_seed(
+                    args.seed + global_step * accelerator.num_processes + accelerator.process_index
+                )
 
             initial_global_step = global_step
             first_epoch = global_step // num_update_steps_per_epoch
+            # checkpoints saved before the stream position was stored restart the stream
+            stream_state_path = os.path.join(checkpoint_path, "data_stream.json")
+            if args.precomputed_latents_dir is None and os.path.isfile(stream_state_path):
+                with open(stream_state_path) as f:
+                    train_stream.load_state_dict(json.load(f))
+                # the stream continues after the last batch of the checkpoint
+                first_epoch = train_stream.epoch
     else:
         initial_global_step = 0
 
@@ -1234,14 +1685,38 @@ def main(args):
     )
 
     image_logs = None
+    checkpoint_writer = None
+    if args.async_checkpointing and accelerator.is_main_process:
+        checkpoint_writer = AsyncCheckpointWriter(args.output_dir, total_limit=args.checkpoints_total_limit)
+
     for epoch in range(first_epoch, args.num_train_epochs):
+        if args.precomputed_latents_dir is None:
+            train_stream.set_epoch(epoch)
         for step, batch in enumerate(train_dataloader):
+            if args.precomputed_latents_dir is None:
+                train_stream.batches_consumed += 1
             with accelerator.accumulate(brushnet):
+                if args.device_random_mask:
+                    batch["conditioning_pixel_values"], batch["masks"] = random_brush_mask_conditioning(
+                        batch["pixel_values"],
+                        batch["mask_canvas_sizes"],
+                        batch["mask_crops"],
+                        generator=mask_generator,
+                    )
+
                 # Convert images to latent space
-                latents = vae.encode(batch["pixel_values"].to(dtype=weight_dtype)).latent_dist.sample()
+                if args.precomputed_latents_dir is not None:
+                    # sample from the stored latent distributions instead of running the VAE encoder
+                    latents = DiagonalGaussianDistribution(batch["latent_parameters"].to(dtype=weight_dtype)).sample()
+                    conditioning_latents = DiagonalGaussianDistribution(
+                        batch["conditioning_latent_parameters"].to(dtype=weight_dtype)
+                    ).sample()
+                else:
+                    latents = vae.encode(batch["pixel_values"].to(dtype=weight_dtype)).latent_dist.sample()
+                    conditioning_latents = vae.encode(
+                        batch["conditioning_pixel_values"].to(dtype=weight_dtype)
+                    ).latent_dist.sample()
                 latents = latents * vae.config.scaling_factor
-
-                conditioning_latents=vae.encode(batch["conditioning_pixel_values"].to(dtype=weight_dtype)).latent_dist.sample()
                 conditioning_latents = conditioning_latents * vae.config.scaling_factor
 
                 masks = torch.nn.functional.interpolate(
@@ -1254,11 +1729,25 @@ def main(args):
 
                 conditioning_latents=torch.concat([conditioning_latents,masks],1)
 
+                # Reuse every sample for `--timesteps_per_sample` noisy versions of it
+                num_samples = latents.shape[0]
+                latents = latents.repeat_interleave(args.timesteps_per_sample, dim=0)
+                conditioning_latents = conditioning_latents.repeat_interleave(args.timesteps_per_sample, dim=0)
+
                 # Sample noise that we'll add to the latents
                 noise = torch.randn_like(latents)
                 bsz = latents.shape[0]
                 # Sample a random timestep for each image
-                timesteps = torch.randint(0, noise_scheduler.config.num_train_timesteps, (bsz,), device=latents.device)
+                if args.timesteps_per_sample > 1:
+                    # one timestep from each of `--timesteps_per_sample` equal parts of the schedule, for every sample
+                    strata = torch.arange(args.timesteps_per_sample, device=latents.device).repeat(num_samples)
+                    timesteps = (strata + torch.rand(bsz, device=latents.device)) / args.timesteps_per_sample
+                    timesteps = (timesteps * noise_scheduler.config.num_train_timesteps).long()
+                    timesteps = timesteps.clamp(max=noise_scheduler.config.num_train_timesteps - 1)
+                else:
+                    timesteps = torch.randint(
+                        0, noise_scheduler.config.num_train_timesteps, (bsz,), device=latents.device
+                    )
                 timesteps = timesteps.long()
 
                 # Add noise to the latents according to the noise magnitude at each timestep
@@ -1267,6 +1756,7 @@ def main(args):
 
                 # Get the text embedding for conditioning
                 encoder_hidden_states = text_encoder(batch["input_ids"], return_dict=False)[0]
+                encoder_hidden_states = encoder_hidden_states.repeat_interleave(args.timesteps_per_sample, dim=0)
 
                 down_block_res_samples, mid_block_res_sample, up_block_res_samples = brushnet(
                     noisy_latents,
@@ -1313,8 +1803,29 @@ def main(args):
                 progress_bar.update(1)
                 global_step += 1
 
+                random_states = None
+                if args.async_checkpointing and global_step % args.checkpointing_steps == 0:
+                    # every process resumes from its own random states
+                    random_states = gather_object([collect_random_states({"mask_generator": mask_generator})])
+
                 if accelerator.is_main_process:
-                    if global_step % args.checkpointing_steps == 0:
+                    if global_step % args.checkpointing_steps == 0 and checkpoint_writer is not None:
+                        save_path = os.path.join(args.output_dir, f"checkpoint-{global_step}")
+                        checkpoint_writer.save(
+                            f"checkpoint-{global_step}",
+                            unwrap_model(brushnet),
+                            optimizer,
+                            lr_scheduler,
+                            scaler=accelerator.scaler,
+                            json_files=(
+                                {"data_stream.json": train_stream.state_dict()}
+                                if args.precomputed_latents_dir is None
+                                else None
+                            ),
+                            random_states=random_states,
+                        )
+                        logger.info(f"Writing state to {save_path} in the background")
+                    elif global_step % args.checkpointing_steps == 0:
                         # _before_ saving state, check if this save would set us over the `checkpoints_total_limit`
                         if args.checkpoints_total_limit is not None:
                             checkpoints = os.listdir(args.output_dir)
@@ -1359,6 +1870,9 @@ def main(args):
             if global_step >= args.max_train_steps:
                 break
 
+    if checkpoint_writer is not None:
+        checkpoint_writer.wait()
+
     # Create the pipeline using using the trained modules and save it.
     accelerator.wait_for_everyone()
     if accelerator.is_main_process:
@@ -0,0 +1,1345 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import argparse
+import copy
+import gc
+import json
+import logging
+import math
+import os
+import shutil
+from pathlib import Path
+
+import accelerate
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.utils.checkpoint
+import transformers
+from accelerate import Accelerator
+from accelerate.data_loader import DataLoaderShard
+from accelerate.logging import get_logger
+from accelerate.utils import ProjectConfiguration, set_seed
+from packaging import version
+from peft import LoraConfig
+from peft.utils import get_peft_model_state_dict, set_peft_model_state_dict
+from PIL import Image
+from random_masks import random_brush_mask_conditioning
+from tqdm.auto import tqdm
+from train_brushnet import MyWebDataset, import_model_class_from_model_name_or_path
+from transformers import AutoTokenizer
+from webdataset_stream import WebDatasetStream, load_shard_index
+
+import diffusers
+from diffusers import (
+    AutoencoderKL,
+    BrushNetModel,
+    DDPMScheduler,
+    LCMScheduler,
+    StableDiffusionBrushNetPipeline,
+    UNet2DConditionModel,
+)
+from diffusers.optimization import get_scheduler
+from diffusers.utils import (
+    check_min_version,
+    convert_state_dict_to_diffusers,
+    convert_unet_state_dict_to_peft,
+    is_wandb_available,
+)
+from diffusers.utils.import_utils import is_xformers_available
+from diffusers.utils.torch_utils import is_compiled_module
+
+
+if is_wandb_available():
+    import wandb
+
+# Will error if the minimal version of diffusers is not installed. Remove at your own risks.
+check_min_version("0.27.0.dev0")
+
+logger = get_logger(__name__)
+
+
+def log_validation(vae, text_encoder, tokenizer, unet, brushnet, args, accelerator, weight_dtype, step):
+    logger.info("Running validation... ")
+
+    pipeline = StableDiffusionBrushNetPipeline.from_pretrained(
+        args.pretrained_model_name_or_path,
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        brushnet=brushnet,
+        safety_checker=None,
+        revision=args.revision,
+        variant=args.variant,
+        torch_dtype=weight_dtype,
+    )
+    pipeline.scheduler = LCMScheduler.from_config(pipeline.scheduler.config)
+    pipeline = pipeline.to(accelerator.device)
+    pipeline.set_progress_bar_config(disable=True)
+
+    if args.enable_xformers_memory_efficient_attention:
+        pipeline.enable_xformers_memory_efficient_attention()
+
+    if args.seed is None:
+        generator = None
+    else:
+        generator = torch.Generator(device=accelerator.device).manual_seed(args.seed)
+
+    image_logs = []
+    for validation_prompt, validation_image, validation_mask in zip(
+        args.validation_prompt, args.validation_image, args.validation_mask
+    ):
+        validation_image = Image.open(validation_image).convert("RGB")
+        validation_mask = Image.open(validation_mask).convert("RGB")
+        validation_image = Image.composite(
+            Image.new("RGB", validation_image.size, (0, 0, 0)), validation_image, validation_mask.convert("L")
+        )
+
+        images = []
+        for _ in range(args.num_validation_images):
+            with torch.autocast("cuda", enabled=accelerator.device.type == "cuda"):
+                image = pipeline(
+                    validation_prompt,
+                    validation_image,
+                    validation_mask,
+                    num_inference_steps=args.validation_num_inference_steps,
+                    guidance_scale=1.0,
+                    generator=generator,
+                ).images[0]
+            images.append(image)
+
+        image_logs.append(
+            {"validation_image": validation_image, "images": images, "validation_prompt": validation_prompt}
+        )
+
+    for tracker in accelerator.trackers:
+        if tracker.name == "tensorboard":
+            for log in image_logs:
+                formatted_images = [np.asarray(log["validation_image"])]
+                formatted_images += [np.asarray(image) for image in log["images"]]
+                formatted_images = np.stack(formatted_images)
+                tracker.writer.add_images(log["validation_prompt"], formatted_images, step, dataformats="NHWC")
+        elif tracker.name == "wandb":
+            formatted_images = []
+            for log in image_logs:
+                formatted_images.append(wandb.Image(log["validation_image"], caption="BrushNet conditioning"))
+                for image in log["images"]:
+                    formatted_images.append(wandb.Image(image, caption=log["validation_prompt"]))
+            tracker.log({"validation": formatted_images})
+        else:
+            logger.warn(f"image logging not implemented for {tracker.name}")
+
+    del pipeline
+    gc.collect()
+    torch.cuda.empty_cache()
+
+    return image_logs
+
+
+def append_dims(x, target_dims):
+    """Appends dimensions to the end of a tensor until it has target_dims dimensions."""
+    dims_to_append = target_dims - x.ndim
+    if dims_to_append < 0:
+        raise ValueError(f"input has {x.ndim} dims but target_dims is {target_dims}, which is less")
+    return x[(...,) + (None,) * dims_to_append]
+
+
+# From LCMScheduler.get_scalings_for_boundary_condition_discrete
+def scalings_for_boundary_conditions(timestep, sigma_data=0.5, timestep_scaling=10.0):
+    scaled_timestep = timestep_scaling * timestep
+    c_skip = sigma_data**2 / (scaled_timestep**2 + sigma_data**2)
+    c_out = scaled_timestep / (scaled_timestep**2 + sigma_data**2) ** 0.5
+    return c_skip, c_out
+
+
+# Compare LCMScheduler.step, Step 4
+def get_predicted_original_sample(model_output, timesteps, sample, prediction_type, alphas, sigmas):
+    alphas = extract_into_tensor(alphas, timesteps, sample.shape)
+    sigmas = extract_into_tensor(sigmas, timesteps, sample.shape)
+    if prediction_type == "epsilon":
+        pred_x_0 = (sample - sigmas * model_output) / alphas
+    elif prediction_type == "sample":
+        pred_x_0 = model_output
+    elif prediction_type == "v_prediction":
+        pred_x_0 = alphas * sample - sigmas * model_output
+    else:
+        raise ValueError(
+            f"Prediction type {prediction_type} is not supported; currently, `epsilon`, `sample`, and `v_prediction`"
+            f" are supported."
+        )
+
+    return pred_x_0
+
+
+# Based on step 4 in DDIMScheduler.step
+def get_predicted_noise(model_output, timesteps, sample, prediction_type, alphas, sigmas):
+    alphas = extract_into_tensor(alphas, timesteps, sample.shape)
+    sigmas = extract_into_tensor(sigmas, timesteps, sample.shape)
+    if prediction_type == "epsilon":
+        pred_epsilon = model_output
+    elif prediction_type == "sample":
+        pred_epsilon = (sample - alphas * model_output) / sigmas
+    elif prediction_type == "v_prediction":
+        pred_epsilon = alphas * model_output + sigmas * sample
+    else:
+        raise ValueError(
+            f"Prediction type {prediction_type} is not supported; currently, `epsilon`, `sample`, and `v_prediction`"
+            f" are supported."
+        )
+
+    return pred_epsilon
+
+
+def extract_into_tensor(a, t, x_shape):
+    b, *_ = t.shape
+    out = a.gather(-1, t)
+    return out.reshape(b, *((1,) * (len(x_shape) - 1)))
+
+
+class DDIMSolver:
+    def __init__(self, alpha_cumprods, timesteps=1000, ddim_timesteps=50):
+        # DDIM sampling parameters
+        step_ratio = timesteps // ddim_timesteps
+        self.ddim_timesteps = (np.arange(1, ddim_timesteps + 1) * step_ratio).round().astype(np.int64) - 1
+        self.ddim_alpha_cumprods = alpha_cumprods[self.ddim_timesteps]
+        self.ddim_alpha_cumprods_prev = np.asarray(
+            [alpha_cumprods[0]] + alpha_cumprods[self.ddim_timesteps[:-1]].tolist()
+        )
+        # convert to torch tensors
+        self.ddim_timesteps = torch.from_numpy(self.ddim_timesteps).long()
+        self.ddim_alpha_cumprods = torch.from_numpy(self.ddim_alpha_cumprods)
+        self.ddim_alpha_cumprods_prev = torch.from_numpy(self.ddim_alpha_cumprods_prev)
+
+    def to(self, device):
+        self.ddim_timesteps = self.ddim_timesteps.to(device)
+        self.ddim_alpha_cumprods = self.ddim_alpha_cumprods.to(device)
+        self.ddim_alpha_cumprods_prev = self.ddim_alpha_cumprods_prev.to(device)
+        return self
+
+    def ddim_step(self, pred_x0, pred_noise, timestep_index):
+        alpha_cumprod_prev = extract_into_tensor(self.ddim_alpha_cumprods_prev, timestep_index, pred_x0.shape)
+        dir_xt = (1.0 - alpha_cumprod_prev).sqrt() * pred_noise
+        x_prev = alpha_cumprod_prev.sqrt() * pred_x0 + dir_xt
+        return x_prev
+
+
+@torch.no_grad()
+def update_ema(target_params, source_params, rate=0.99):
+    """
+    Update target parameters to be closer to those of source parameters using
+    an exponential moving average.
+
+    :param target_params: the target parameter sequence.
+    :param source_params: the source parameter sequence.
+    :param rate: the EMA rate (closer to 1 means slower).
+    """
+    for targ, src in zip(target_params, source_params):
+        targ.detach().mul_(rate).add_(src, alpha=1 - rate)
+
+
+def predict_noise(
+    unet, brushnet, sample, timesteps, encoder_hidden_states, brushnet_cond, unet_dtype, brushnet_dtype
+):
+    """Runs the BrushNet and adds its residuals to the UNet, like a single step of `StableDiffusionBrushNetPipeline`."""
+    down_block_res_samples, mid_block_res_sample, up_block_res_samples = brushnet(
+        sample.to(brushnet_dtype),
+        timesteps,
+        encoder_hidden_states=encoder_hidden_states.to(brushnet_dtype),
+        brushnet_cond=brushnet_cond.to(brushnet_dtype),
+        return_dict=False,
+    )
+    return unet(
+        sample.to(unet_dtype),
+        timesteps,
+        encoder_hidden_states=encoder_hidden_states.to(unet_dtype),
+        down_block_add_samples=[res_sample.to(unet_dtype) for res_sample in down_block_res_samples],
+        mid_block_add_sample=mid_block_res_sample.to(unet_dtype),
+        up_block_add_samples=[res_sample.to(unet_dtype) for res_sample in up_block_res_samples],
+        return_dict=False,
+    )[0]
+
+
+def parse_args(input_args=None):
+    parser = argparse.ArgumentParser(description="Simple example of a BrushNet latent consistency distillation script.")
+    parser.add_argument(
+        "--pretrained_model_name_or_path",
+        type=str,
+        default=None,
+        required=True,
+        help="Path to pretrained model or model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--brushnet_model_name_or_path",
+        type=str,
+        default=None,
+        help="Path to the pretrained teacher brushnet model or model identifier from huggingface.co/models."
+        " If not specified the teacher brushnet weights are initialized from unet.",
+    )
+    parser.add_argument(
+        "--revision",
+        type=str,
+        default=None,
+        required=False,
+        help="Revision of pretrained model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--variant",
+        type=str,
+        default=None,
+        help="Variant of the model files of the pretrained model identifier from huggingface.co/models, 'e.g.' fp16",
+    )
+    parser.add_argument(
+        "--tokenizer_name",
+        type=str,
+        default=None,
+        help="Pretrained tokenizer name or path if not the same as model_name",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default="brushnet-lcm",
+        help="The output directory where the model predictions and checkpoints will be written.",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="A seed for reproducible training.")
+    parser.add_argument(
+        "--resolution",
+        type=int,
+        default=512,
+        help=(
+            "The resolution for input images, all the images in the train/validation dataset will be resized to this"
+            " resolution"
+        ),
+    )
+    parser.add_argument(
+        "--train_batch_size", type=int, default=4, help="Batch size (per device) for the training dataloader."
+    )
+    parser.add_argument("--num_train_epochs", type=int, default=10000)
+    parser.add_argument(
+        "--max_train_steps",
+        type=int,
+        default=None,
+        help="Total number of training steps to perform.  If provided, overrides num_train_epochs.",
+    )
+    parser.add_argument(
+        "--checkpointing_steps",
+        type=int,
+        default=500,
+        help=(
+            "Save a checkpoint of the training state every X updates. Checkpoints can be used for resuming training"
+            " via `--resume_from_checkpoint`."
+        ),
+    )
+    parser.add_argument(
+        "--checkpoints_total_limit",
+        type=int,
+        default=None,
+        help=("Max number of checkpoints to store."),
+    )
+    parser.add_argument(
+        "--resume_from_checkpoint",
+        type=str,
+        default=None,
+        help=(
+            "Whether training should be resumed from a previous checkpoint. Use a path saved by"
+            ' `--checkpointing_steps`, or `"latest"` to automatically select the last available checkpoint.'
+        ),
+    )
+    parser.add_argument(
+        "--gradient_accumulation_steps",
+        type=int,
+        default=1,
+        help="Number of updates steps to accumulate before performing a backward/update pass.",
+    )
+    parser.add_argument(
+        "--gradient_checkpointing",
+        action="store_true",
+        help="Whether or not to use gradient checkpointing to save memory at the expense of slower backward pass.",
+    )
+    parser.add_argument(
+        "--learning_rate",
+        type=float,
+        default=1e-6,
+        help="Initial learning rate (after the potential warmup period) to use.",
+    )
+    parser.add_argument(
+        "--scale_lr",
+        action="store_true",
+        default=False,
+        help="Scale the learning rate by the number of GPUs, gradient accumulation steps, and batch size.",
+    )
+    parser.add_argument(
+        "--lr_scheduler",
+        type=str,
+        default="constant",
+        help=(
+            'The scheduler type to use. Choose between ["linear", "cosine", "cosine_with_restarts", "polynomial",'
+            ' "constant", "constant_with_warmup"]'
+        ),
+    )
+    parser.add_argument(
+        "--lr_warmup_steps", type=int, default=500, help="Number of steps for the warmup in the lr scheduler."
+    )
+    parser.add_argument(
+        "--use_8bit_adam", action="store_true", help="Whether or not to use 8-bit Adam from bitsandbytes."
+    )
+    parser.add_argument(
+        "--shuffle_buffer_size",
+        type=int,
+        default=1000,
+        help=(
+            "The number of samples every process shuffles the training stream with. The shards are also shuffled every"
+            " epoch. 0 reads the shards and their samples in order."
+        ),
+    )
+    parser.add_argument(
+        "--dataloader_num_workers",
+        type=int,
+        default=0,
+        help=(
+            "Number of subprocesses to use for data loading. 0 means that the data will be loaded in the main process."
+        ),
+    )
+    parser.add_argument("--adam_beta1", type=float, default=0.9, help="The beta1 parameter for the Adam optimizer.")
+    parser.add_argument("--adam_beta2", type=float, default=0.999, help="The beta2 parameter for the Adam optimizer.")
+    parser.add_argument("--adam_weight_decay", type=float, default=1e-2, help="Weight decay to use.")
+    parser.add_argument("--adam_epsilon", type=float, default=1e-08, help="Epsilon value for the Adam optimizer")
+    parser.add_argument("--max_grad_norm", default=1.0, type=float, help="Max gradient norm.")
+    parser.add_argument(
+        "--logging_dir",
+        type=str,
+        default="logs",
+        help=(
+            "[TensorBoard](https://www.tensorflow.org/tensorboard) log directory. Will default to"
+            " *output_dir/runs/**CURRENT_DATETIME_HOSTNAME***."
+        ),
+    )
+    parser.add_argument(
+        "--allow_tf32",
+        action="store_true",
+        help=(
+            "Whether or not to allow TF32 on Ampere GPUs. Can be used to speed up training. For more information, see"
+            " https://pytorch.org/docs/stable/notes/cuda.html#tensorfloat-32-tf32-on-ampere-devices"
+        ),
+    )
+    parser.add_argument(
+        "--report_to",
+        type=str,
+        default="tensorboard",
+        help=(
+            'The integration to report the results and logs to. Supported platforms are `"tensorboard"`'
+            ' (default), `"wandb"` and `"comet_ml"`. Use `"all"` to report to all integrations.'
+        ),
+    )
+    parser.add_argument(
+        "--mixed_precision",
+        type=str,
+        default=None,
+        choices=["no", "fp16", "bf16"],
+        help=(
+            "Whether to use mixed precision. Choose between fp16 and bf16 (bfloat16). Bf16 requires PyTorch >="
+            " 1.10.and an Nvidia Ampere GPU.  Default to the value of accelerate config of the current system or the"
+            " flag passed with the `accelerate.launch` command. Use this argument to override the accelerate config."
+        ),
+    )
+    parser.add_argument(
+        "--enable_xformers_memory_efficient_attention", action="store_true", help="Whether or not to use xformers."
+    )
+    parser.add_argument(
+        "--set_grads_to_none",
+        action="store_true",
+        help=(
+            "Save more memory by using setting grads to None instead of zero. Be aware, that this changes certain"
+            " behaviors, so disable this argument if it causes any problems. More info:"
+            " https://pytorch.org/docs/stable/generated/torch.optim.Optimizer.zero_grad.html"
+        ),
+    )
+    parser.add_argument(
+        "--train_data_dir",
+        type=str,
+        default=None,
+        required=True,
+        help="A folder containing the training data as webdataset `.tar` shards in the format of BrushData.",
+    )
+    parser.add_argument(
+        "--proportion_empty_prompts",
+        type=float,
+        default=0,
+        help="Proportion of image prompts to be replaced with empty strings. Defaults to 0 (no prompt replacement).",
+    )
+    parser.add_argument(
+        "--random_mask",
+        action="store_true",
+        help=(
+            "Distill BrushNet with random mask"
+        ),
+    )
+    parser.add_argument(
+        "--device_random_mask",
+        action="store_true",
+        help=(
+            "With `--random_mask`, draw the random masks for the whole batch on the training device instead of in the"
+            " dataloader workers. Seeded with `--seed` on every process."
+        ),
+    )
+    parser.add_argument(
+        "--mask_cache_mb",
+        type=int,
+        default=0,
+        help=(
+            "Size in MB of the bit-packed LRU cache of decoded segmentation masks kept by every dataloader worker."
+            " Masks are keyed by sample and mask index, so they are only decoded once while they stay cached."
+            " Defaults to 0 (masks are decoded for every sample)."
+        ),
+    )
+    parser.add_argument(
+        "--full_resolution_decode",
+        action="store_true",
+        help=(
+            "Decode training images at their full source resolution. By default JPEGs are decoded at the largest DCT"
+            " scale-down (1/2, 1/4 or 1/8) whose short side still covers `--resolution`."
+        ),
+    )
+    # ----Distillation----
+    parser.add_argument(
+        "--distill_target",
+        type=str,
+        default="lora",
+        choices=["lora", "brushnet"],
+        help=(
+            "What the few-step student learns. `lora` trains an LCM-LoRA on the UNet against the frozen teacher"
+            " brushnet, `brushnet` trains a student brushnet for a frozen (optionally LCM-LoRA fused) UNet."
+        ),
+    )
+    parser.add_argument(
+        "--lcm_lora_path",
+        type=str,
+        default=None,
+        help=(
+            "LCM-LoRA that is fused into the UNet of the student when `--distill_target=brushnet`, for example"
+            " `latent-consistency/lcm-lora-sdv1-5`. The teacher always uses the UNet without it."
+        ),
+    )
+    parser.add_argument(
+        "--lora_rank",
+        type=int,
+        default=64,
+        help="The rank of the LoRA projection matrix.",
+    )
+    parser.add_argument(
+        "--lora_alpha",
+        type=int,
+        default=64,
+        help=(
+            "The value of the LoRA alpha parameter, which controls the scaling factor in front of the LoRA weight"
+            " update delta_W. No scaling will be performed if this value is equal to `lora_rank`."
+        ),
+    )
+    parser.add_argument(
+        "--lora_dropout",
+        type=float,
+        default=0.0,
+        help="The dropout probability for the dropout layer added before applying the LoRA to each layer input.",
+    )
+    parser.add_argument(
+        "--lora_target_modules",
+        type=str,
+        default=None,
+        help=(
+            "A comma-separated string of target module keys to add LoRA to. If not set, a default list of modules will"
+            " be used. By default, LoRA will be applied to all conv and linear layers."
+        ),
+    )
+    parser.add_argument(
+        "--w_min",
+        type=float,
+        default=3.0,
+        required=False,
+        help=(
+            "The minimum guidance scale value for guidance scale sampling. Note that we are using the Imagen CFG"
+            " formulation rather than the LCM formulation, which means all guidance scales have 1 added to them as"
+            " compared to the original paper."
+        ),
+    )
+    parser.add_argument(
+        "--w_max",
+        type=float,
+        default=15.0,
+        required=False,
+        help=(
+            "The maximum guidance scale value for guidance scale sampling. Note that we are using the Imagen CFG"
+            " formulation rather than the LCM formulation, which means all guidance scales have 1 added to them as"
+            " compared to the original paper."
+        ),
+    )
+    parser.add_argument(
+        "--num_ddim_timesteps",
+        type=int,
+        default=50,
+        help="The number of timesteps to use for DDIM sampling.",
+    )
+    parser.add_argument(
+        "--timestep_scaling_factor",
+        type=float,
+        default=10.0,
+        help=(
+            "The multiplicative timestep scaling factor used when calculating the boundary scalings for LCM. The"
+            " higher the scaling is, the lower the approximation error, but the default value of 10.0 should typically"
+            " suffice."
+        ),
+    )
+    parser.add_argument(
+        "--loss_type",
+        type=str,
+        default="huber",
+        choices=["l2", "huber"],
+        help="The type of loss to use for the LCD loss.",
+    )
+    parser.add_argument(
+        "--huber_c",
+        type=float,
+        default=0.001,
+        help="The huber loss parameter. Only used if `--loss_type=huber`.",
+    )
+    parser.add_argument(
+        "--ema_decay",
+        type=float,
+        default=0.95,
+        required=False,
+        help=(
+            "The exponential moving average (EMA) rate or decay factor of the target brushnet. Only used if"
+            " `--distill_target=brushnet`."
+        ),
+    )
+    # ----Validation----
+    parser.add_argument(
+        "--validation_prompt",
+        type=str,
+        default=None,
+        nargs="+",
+        help="A set of prompts evaluated every `--validation_steps` with a few-step LCMScheduler.",
+    )
+    parser.add_argument(
+        "--validation_image",
+        type=str,
+        default=None,
+        nargs="+",
+        help="A set of paths to the images inpainted for the `--validation_prompt`s.",
+    )
+    parser.add_argument(
+        "--validation_mask",
+        type=str,
+        default=None,
+        nargs="+",
+        help="A set of paths to the masks of the `--validation_image`s.",
+    )
+    parser.add_argument(
+        "--num_validation_images",
+        type=int,
+        default=4,
+        help="Number of images to be generated for each `--validation_image`, `--validation_prompt` pair",
+    )
+    parser.add_argument(
+        "--validation_num_inference_steps",
+        type=int,
+        default=4,
+        help="Number of LCMScheduler steps used for validation.",
+    )
+    parser.add_argument(
+        "--validation_steps",
+        type=int,
+        default=100,
+        help="Run validation every X steps.",
+    )
+    parser.add_argument(
+        "--tracker_project_name",
+        type=str,
+        default="train_brushnet_lcm_distill",
+        help=(
+            "The `project_name` argument passed to Accelerator.init_trackers for"
+            " more information see https://huggingface.co/docs/accelerate/v0.17.0/en/package_reference/accelerator#accelerate.Accelerator"
+        ),
+    )
+
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
+
+    if args.proportion_empty_prompts < 0 or args.proportion_empty_prompts > 1:
+        raise ValueError("`--proportion_empty_prompts` must be in the range [0, 1].")
+
+    if args.device_random_mask and not args.random_mask:
+        raise ValueError("`--device_random_mask` requires `--random_mask`.")
+
+    if args.lcm_lora_path is not None and args.distill_target != "brushnet":
+        raise ValueError("`--lcm_lora_path` can only be used with `--distill_target=brushnet`.")
+
+    validation_args = [args.validation_prompt, args.validation_image, args.validation_mask]
+    if any(arg is not None for arg in validation_args):
+        if any(arg is None for arg in validation_args) or len({len(arg) for arg in validation_args}) != 1:
+            raise ValueError(
+                "`--validation_prompt`, `--validation_image` and `--validation_mask` must be set together and have"
+                " the same number of values."
+            )
+
+    if args.resolution % 8 != 0:
+        raise ValueError(
+            "`--resolution` must be divisible by 8 for consistently sized encoded images between the VAE and the brushnet encoder."
+        )
+
+    return args
+
+
+def main(args):
+    logging_dir = Path(args.output_dir, args.logging_dir)
+
+    accelerator_project_config = ProjectConfiguration(project_dir=args.output_dir, logging_dir=logging_dir)
+
+    accelerator = Accelerator(
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        mixed_precision=args.mixed_precision,
+        log_with=args.report_to,
+        project_config=accelerator_project_config,
+    )
+
+    # Make one log on every process with the configuration for debugging.
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    logger.info(accelerator.state, main_process_only=False)
+    if accelerator.is_local_main_process:
+        transformers.utils.logging.set_verbosity_warning()
+        diffusers.utils.logging.set_verbosity_info()
+    else:
+        transformers.utils.logging.set_verbosity_error()
+        diffusers.utils.logging.set_verbosity_error()
+
+    # If passed along, set the training seed now.
+    if args.seed is not None:
+        set_seed(args.seed)
+
+    if accelerator.is_main_process:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    # 1. Create the noise scheduler and the desired noise schedule.
+    noise_scheduler = DDPMScheduler.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="scheduler", revision=args.revision
+    )
+
+    # DDPMScheduler calculates the alpha and sigma noise schedules (based on the alpha bars) for us
+    alpha_schedule = torch.sqrt(noise_scheduler.alphas_cumprod)
+    sigma_schedule = torch.sqrt(1 - noise_scheduler.alphas_cumprod)
+    # Initialize the DDIM ODE solver for distillation.
+    solver = DDIMSolver(
+        noise_scheduler.alphas_cumprod.numpy(),
+        timesteps=noise_scheduler.config.num_train_timesteps,
+        ddim_timesteps=args.num_ddim_timesteps,
+    )
+
+    # 2. Load the tokenizer, text encoder and VAE.
+    if args.tokenizer_name:
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name, revision=args.revision, use_fast=False)
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(
+            args.pretrained_model_name_or_path, subfolder="tokenizer", revision=args.revision, use_fast=False
+        )
+    text_encoder_cls = import_model_class_from_model_name_or_path(args.pretrained_model_name_or_path, args.revision)
+    text_encoder = text_encoder_cls.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="text_encoder", revision=args.revision, variant=args.variant
+    )
+    vae = AutoencoderKL.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="vae", revision=args.revision, variant=args.variant
+    )
+
+    # 3. Load the teacher UNet and BrushNet.
+    teacher_unet = UNet2DConditionModel.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="unet", revision=args.revision, variant=args.variant
+    )
+    if args.brushnet_model_name_or_path:
+        logger.info("Loading existing teacher brushnet weights")
+        teacher_brushnet = BrushNetModel.from_pretrained(args.brushnet_model_name_or_path)
+    else:
+        logger.info("Initializing teacher brushnet weights from unet")
+        teacher_brushnet = BrushNetModel.from_unet(teacher_unet)
+
+    vae.requires_grad_(False)
+    text_encoder.requires_grad_(False)
+    teacher_unet.requires_grad_(False)
+    teacher_brushnet.requires_grad_(False)
+
+    # 4. Create the online student. Either the UNet gets a trainable LoRA and keeps the teacher BrushNet, or the
+    # BrushNet is trained for a frozen UNet. In the latter case an EMA copy of the student BrushNet is the target
+    # network of the consistency loss.
+    if args.distill_target == "lora":
+        unet = UNet2DConditionModel.from_pretrained(
+            args.pretrained_model_name_or_path, subfolder="unet", revision=args.revision, variant=args.variant
+        )
+        unet.requires_grad_(False)
+        if args.lora_target_modules is not None:
+            lora_target_modules = [module_key.strip() for module_key in args.lora_target_modules.split(",")]
+        else:
+            lora_target_modules = [
+                "to_q",
+                "to_k",
+                "to_v",
+                "to_out.0",
+                "proj_in",
+                "proj_out",
+                "ff.net.0.proj",
+                "ff.net.2",
+                "conv1",
+                "conv2",
+                "conv_shortcut",
+                "downsamplers.0.conv",
+                "upsamplers.0.conv",
+                "time_emb_proj",
+            ]
+        lora_config = LoraConfig(
+            r=args.lora_rank,
+            target_modules=lora_target_modules,
+            lora_alpha=args.lora_alpha,
+            lora_dropout=args.lora_dropout,
+        )
+        # only the LoRA projection matrices will be updated by the optimizer
+        unet.add_adapter(lora_config)
+        unet.train()
+        brushnet = teacher_brushnet
+        target_brushnet = teacher_brushnet
+        student = unet
+    else:
+        if args.lcm_lora_path is not None:
+            unet = UNet2DConditionModel.from_pretrained(
+                args.pretrained_model_name_or_path, subfolder="unet", revision=args.revision, variant=args.variant
+            )
+            lora_state_dict, network_alphas = StableDiffusionBrushNetPipeline.lora_state_dict(args.lcm_lora_path)
+            StableDiffusionBrushNetPipeline.load_lora_into_unet(lora_state_dict, network_alphas=network_alphas, unet=unet)
+            unet.fuse_lora()
+            unet.requires_grad_(False)
+        else:
+            unet = teacher_unet
+        brushnet = copy.deepcopy(teacher_brushnet)
+        brushnet.requires_grad_(True)
+        brushnet.train()
+        target_brushnet = copy.deepcopy(teacher_brushnet)
+        student = brushnet
+
+    # Taken from [Sayak Paul's Diffusers PR #6511](https://github.com/huggingface/diffusers/pull/6511/files)
+    def unwrap_model(model):
+        model = accelerator.unwrap_model(model)
+        model = model._orig_mod if is_compiled_module(model) else model
+        return model
+
+    # 5. Handle saving and loading of checkpoints
+    # `accelerate` 0.16.0 will have better support for customized saving
+    if version.parse(accelerate.__version__) >= version.parse("0.16.0"):
+        # create custom saving & loading hooks so that `accelerator.save_state(...)` serializes in a nice format
+        def save_model_hook(models, weights, output_dir):
+            if accelerator.is_main_process:
+                if args.distill_target == "lora":
+                    unet_lora_state_dict = convert_state_dict_to_diffusers(
+                        get_peft_model_state_dict(unwrap_model(unet))
+                    )
+                    StableDiffusionBrushNetPipeline.save_lora_weights(output_dir, unet_lora_layers=unet_lora_state_dict)
+                else:
+                    unwrap_model(brushnet).save_pretrained(os.path.join(output_dir, "brushnet"))
+                    target_brushnet.save_pretrained(os.path.join(output_dir, "brushnet_target"))
+
+                for _ in range(len(weights)):
+                    # make sure to pop weight so that corresponding model is not saved again
+                    weights.pop()
+
+                # the position of the training stream, the same on every process
+                with open(os.path.join(output_dir, "data_stream.json"), "w") as f:
+                    json.dump(train_stream.state_dict(), f)
+
+        def load_model_hook(models, input_dir):
+            while len(models) > 0:
+                # pop models so that they are not loaded again
+                model = models.pop()
+
+                if args.distill_target == "lora":
+                    lora_state_dict, _ = StableDiffusionBrushNetPipeline.lora_state_dict(input_dir)
+                    unet_state_dict = {
+                        k.replace("unet.", ""): v for k, v in lora_state_dict.items() if k.startswith("unet.")
+                    }
+                    unet_state_dict = convert_unet_state_dict_to_peft(unet_state_dict)
+                    set_peft_model_state_dict(model, unet_state_dict, adapter_name="default")
+                else:
+                    load_model = BrushNetModel.from_pretrained(input_dir, subfolder="brushnet")
+                    model.load_state_dict(load_model.state_dict())
+                    load_model = BrushNetModel.from_pretrained(input_dir, subfolder="brushnet_target")
+                    target_brushnet.load_state_dict(load_model.state_dict())
+                    del load_model
+
+        accelerator.register_save_state_pre_hook(save_model_hook)
+        accelerator.register_load_state_pre_hook(load_model_hook)
+
+    # 6. Enable optimizations
+    if args.enable_xformers_memory_efficient_attention:
+        if is_xformers_available():
+            import xformers
+
+            xformers_version = version.parse(xformers.__version__)
+            if xformers_version == version.parse("0.0.16"):
+                logger.warn(
+                    "xFormers 0.0.16 cannot be used for training in some GPUs. If you observe problems during training, please update xFormers to at least 0.0.17. See https://huggingface.co/docs/diffusers/main/en/optimization/xformers for more details."
+                )
+            for model in {unet, teacher_unet, brushnet, teacher_brushnet, target_brushnet}:
+                model.enable_xformers_memory_efficient_attention()
+        else:
+            raise ValueError("xformers is not available. Make sure it is installed correctly")
+
+    if args.gradient_checkpointing:
+        student.enable_gradient_checkpointing()
+
+    # Check that all trainable models are in full precision
+    low_precision_error_string = (
+        " Please make sure to always have all model weights in full float32 precision when starting training - even if"
+        " doing mixed precision training, copy of the weights should still be float32."
+    )
+
+    if unwrap_model(student).dtype != torch.float32:
+        raise ValueError(
+            f"Student loaded as datatype {unwrap_model(student).dtype}. {low_precision_error_string}"
+        )
+
+    # Enable TF32 for faster training on Ampere GPUs,
+    # cf https://pytorch.org/docs/stable/notes/cuda.html#tensorfloat-32-tf32-on-ampere-devices
+    if args.allow_tf32:
+        torch.backends.cuda.matmul.allow_tf32 = True
+
+    if args.scale_lr:
+        args.learning_rate = (
+            args.learning_rate * args.gradient_accumulation_steps * args.train_batch_size * accelerator.num_processes
+        )
+
+    # Use 8-bit Adam for lower memory usage or to fine-tune the model in 16GB GPUs
+    if args.use_8bit_adam:
+        try:
+            import bitsandbytes as bnb
+        except ImportError:
+            raise ImportError(
+                "To use 8-bit Adam, please install the bitsandbytes library: `pip install bitsandbytes`."
+            )
+
+        optimizer_class = bnb.optim.AdamW8bit
+    else:
+        optimizer_class = torch.optim.AdamW
+
+    # 7. Optimizer creation
+    params_to_optimize = [param for param in student.parameters() if param.requires_grad]
+    optimizer = optimizer_class(
+        params_to_optimize,
+        lr=args.learning_rate,
+        betas=(args.adam_beta1, args.adam_beta2),
+        weight_decay=args.adam_weight_decay,
+        eps=args.adam_epsilon,
+    )
+
+    # 8. Dataset creation and data processing, with the same masking as `train_brushnet.py`
+    shard_paths = sorted(
+        os.path.join(args.train_data_dir, shard) for shard in os.listdir(args.train_data_dir) if shard.endswith(".tar")
+    )
+    # the main process indexes the shards first, the others read its cached index
+    with accelerator.main_process_first():
+        shard_index = load_shard_index(shard_paths, cache_path=os.path.join(args.output_dir, "shard_index.json"))
+    # Every process streams its own samples, so the dataloader is not sharded by `accelerator.prepare`, which would
+    # read every batch on the main process and dispatch it.
+    train_stream = WebDatasetStream(
+        shard_paths,
+        shard_index,
+        batch_size=args.train_batch_size,
+        shuffle_buffer_size=args.shuffle_buffer_size,
+        seed=args.seed if args.seed is not None else 0,
+        rank=accelerator.process_index,
+        world_size=accelerator.num_processes,
+    )
+    train_dataset_len = train_stream.num_samples
+    train_dataloader = DataLoaderShard(
+        train_stream,
+        device=accelerator.device,
+        collate_fn=MyWebDataset(
+            resolution=args.resolution,
+            tokenizer=tokenizer,
+            random_mask=args.random_mask,
+            proportion_empty_prompts=args.proportion_empty_prompts,
+            full_resolution_decode=args.full_resolution_decode,
+            mask_cache_mb=args.mask_cache_mb,
+            device_random_mask=args.device_random_mask,
+        ),
+        batch_size=args.train_batch_size,
+        num_workers=args.dataloader_num_workers,
+    )
+    train_dataloader_len = train_stream.num_batches
+
+    # Scheduler and math around the number of training steps.
+    overrode_max_train_steps = False
+    num_update_steps_per_epoch = math.ceil(train_dataloader_len / args.gradient_accumulation_steps)
+    if args.max_train_steps is None:
+        args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
+        overrode_max_train_steps = True
+
+    lr_scheduler = get_scheduler(
+        args.lr_scheduler,
+        optimizer=optimizer,
+        num_warmup_steps=args.lr_warmup_steps * accelerator.num_processes,
+        num_training_steps=args.max_train_steps * accelerator.num_processes,
+    )
+
+    # Prepare everything with our `accelerator`.
+    student, optimizer, lr_scheduler = accelerator.prepare(student, optimizer, lr_scheduler)
+    if args.distill_target == "lora":
+        unet = student
+    else:
+        brushnet = student
+
+    # 9. Handle mixed precision and device placement
+    # For mixed precision training we cast all non-trainable weights to half-precision
+    # as these weights are only used for inference, keeping weights in full precision is not required.
+    weight_dtype = torch.float32
+    if accelerator.mixed_precision == "fp16":
+        weight_dtype = torch.float16
+    elif accelerator.mixed_precision == "bf16":
+        weight_dtype = torch.bfloat16
+
+    vae.to(accelerator.device, dtype=weight_dtype)
+    text_encoder.to(accelerator.device, dtype=weight_dtype)
+    teacher_unet.to(accelerator.device, dtype=weight_dtype)
+    teacher_brushnet.to(accelerator.device, dtype=weight_dtype)
+    if args.distill_target == "brushnet":
+        # the frozen student UNet is only used for inference, the EMA target is updated in full precision
+        unet.to(accelerator.device, dtype=weight_dtype)
+        target_brushnet.to(accelerator.device)
+
+    unet_dtype = unwrap_model(unet).dtype
+    brushnet_dtype = unwrap_model(brushnet).dtype
+    target_brushnet_dtype = target_brushnet.dtype
+
+    # Also move the alpha and sigma noise schedules to accelerator.device.
+    alpha_schedule = alpha_schedule.to(accelerator.device)
+    sigma_schedule = sigma_schedule.to(accelerator.device)
+    # Move the ODE solver to accelerator.device.
+    solver = solver.to(accelerator.device)
+
+    # The unconditional text embedding of the teacher's classifier free guidance
+    uncond_input_ids = tokenizer(
+        [""], max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
+    ).input_ids.to(accelerator.device)
+    uncond_prompt_embeds = text_encoder(uncond_input_ids, return_dict=False)[0]
+
+    # We need to recalculate our total training steps as the size of the training dataloader may have changed.
+    num_update_steps_per_epoch = math.ceil(train_dataloader_len / args.gradient_accumulation_steps)
+    if overrode_max_train_steps:
+        args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
+    # Afterwards we recalculate our number of training epochs
+    args.num_train_epochs = math.ceil(args.max_train_steps / num_update_steps_per_epoch)
+
+    # We need to initialize the trackers we use, and also store our configuration.
+    # The trackers initializes automatically on the main process.
+    if accelerator.is_main_process:
+        tracker_config = dict(vars(args))
+
+        # tensorboard cannot handle list types for config
+        tracker_config.pop("validation_prompt")
+        tracker_config.pop("validation_image")
+        tracker_config.pop("validation_mask")
+
+        accelerator.init_trackers(args.tracker_project_name, config=tracker_config)
+
+    # 10. Train!
+    total_batch_size = args.train_batch_size * accelerator.num_processes * args.gradient_accumulation_steps
+
+    logger.info("***** Running distillation *****")
+    logger.info(f"  Distillation target = {args.distill_target}")
+    logger.info(f"  Num examples = {train_dataset_len}")
+    logger.info(f"  Num batches each epoch = {train_dataloader_len}")
+    logger.info(f"  Num Epochs = {args.num_train_epochs}")
+    logger.info(f"  Instantaneous batch size per device = {args.train_batch_size}")
+    logger.info(f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}")
+    logger.info(f"  Gradient Accumulation steps = {args.gradient_accumulation_steps}")
+    logger.info(f"  Total optimization steps = {args.max_train_steps}")
+    global_step = 0
+    first_epoch = 0
+
+    # Potentially load in the weights and states from a previous save
+    if args.resume_from_checkpoint:
+        if args.resume_from_checkpoint != "latest":
+            path = os.path.basename(args.resume_from_checkpoint)
+        else:
+            # Get the most recent checkpoint
+            dirs = os.listdir(args.output_dir)
+            dirs = [d for d in dirs if d.startswith("checkpoint")]
+            dirs = sorted(dirs, key=lambda x: int(x.split("-")[1]))
+            path = dirs[-1] if len(dirs) > 0 else None
+
+        if path is None:
+            accelerator.print(
+                f"Checkpoint '{args.resume_from_checkpoint}' does not exist. Starting a new training run."
+            )
+            args.resume_from_checkpoint = None
+            initial_global_step = 0
+        else:
+            accelerator.print(f"Resuming from checkpoint {path}")
+            checkpoint_path = os.path.join(args.output_dir, path)
+            accelerator.load_state(checkpoint_path, map_location="cpu")
+            global_step = int(path.split("-")[1])
+
+            initial_global_step = global_step
+            first_epoch = global_step // num_update_steps_per_epoch
+            # checkpoints saved before the stream position was stored restart the stream
+            stream_state_path = os.path.join(checkpoint_path, "data_stream.json")
+            if os.path.isfile(stream_state_path):
+                with open(stream_state_path) as f:
+                    train_stream.load_state_dict(json.load(f))
+                # the stream continues after the last batch of the checkpoint
+                first_epoch = train_stream.epoch
+    else:
+        initial_global_step = 0
+
+    progress_bar = tqdm(
+        range(0, args.max_train_steps),
+        initial=initial_global_step,
+        desc="Steps",
+        # Only show the progress bar once on each machine.
+        disable=not accelerator.is_local_main_process,
+    )
+
+    # draws the `--device_random_mask` masks, seeded separately on every process
+    mask_generator = None
+    if args.device_random_mask and args.seed is not None:
+        mask_generator = torch.Generator(device=accelerator.device).manual_seed(args.seed + accelerator.process_index)
+
+    for epoch in range(first_epoch, args.num_train_epochs):
+        train_stream.set_epoch(epoch)
+        for step, batch in enumerate(train_dataloader):
+            train_stream.batches_consumed += 1
+            with accelerator.accumulate(student):
+                # 1. Encode the images, the masked images and the masks like `train_brushnet.py`
+                with torch.no_grad():
+                    if args.device_random_mask:
+                        batch["conditioning_pixel_values"], batch["masks"] = random_brush_mask_conditioning(
+                            batch["pixel_values"],
+                            batch["mask_canvas_sizes"],
+                            batch["mask_crops"],
+                            generator=mask_generator,
+                        )
+                    latents = vae.encode(batch["pixel_values"].to(dtype=weight_dtype)).latent_dist.sample()
+                    latents = (latents * vae.config.scaling_factor).float()
+
+                    conditioning_latents = vae.encode(
+                        batch["conditioning_pixel_values"].to(dtype=weight_dtype)
+                    ).latent_dist.sample()
+                    conditioning_latents = conditioning_latents * vae.config.scaling_factor
+
+                    masks = torch.nn.functional.interpolate(
+                        batch["masks"], size=(latents.shape[-2], latents.shape[-1])
+                    )
+                    conditioning_latents = torch.concat([conditioning_latents, masks.to(weight_dtype)], 1)
+
+                    prompt_embeds = text_encoder(batch["input_ids"], return_dict=False)[0]
+                bsz = latents.shape[0]
+
+                # 2. Sample a random timestep for each image t_n from the ODE solver timesteps without bias.
+                # For the DDIM solver, the timestep schedule is [T - 1, T - k - 1, T - 2 * k - 1, ...]
+                topk = noise_scheduler.config.num_train_timesteps // args.num_ddim_timesteps
+                index = torch.randint(0, args.num_ddim_timesteps, (bsz,), device=latents.device).long()
+                start_timesteps = solver.ddim_timesteps[index]
+                timesteps = start_timesteps - topk
+                timesteps = torch.where(timesteps < 0, torch.zeros_like(timesteps), timesteps)
+
+                # 3. Get boundary scalings for start_timesteps and (end) timesteps.
+                c_skip_start, c_out_start = scalings_for_boundary_conditions(
+                    start_timesteps, timestep_scaling=args.timestep_scaling_factor
+                )
+                c_skip_start, c_out_start = [append_dims(x, latents.ndim) for x in [c_skip_start, c_out_start]]
+                c_skip, c_out = scalings_for_boundary_conditions(
+                    timesteps, timestep_scaling=args.timestep_scaling_factor
+                )
+                c_skip, c_out = [append_dims(x, latents.ndim) for x in [c_skip, c_out]]
+
+                # 4. Sample noise from the prior and add it to the latents according to the noise magnitude at each
+                # timestep (this is the forward diffusion process) [z_{t_{n + k}} in Algorithm 1]
+                noise = torch.randn_like(latents)
+                noisy_model_input = noise_scheduler.add_noise(latents, noise, start_timesteps)
+
+                # 5. Sample a random guidance scale w from U[w_min, w_max]. The student is run without classifier free
+                # guidance, so w is only used by the teacher and needs no guidance scale embedding.
+                w = (args.w_max - args.w_min) * torch.rand((bsz,)) + args.w_min
+                w = w.reshape(bsz, 1, 1, 1)
+                w = w.to(device=latents.device, dtype=latents.dtype)
+
+                # 6. Get online LCM prediction on z_{t_{n + k}} (noisy_model_input), c, t_{n + k} (start_timesteps)
+                noise_pred = predict_noise(
+                    unet,
+                    brushnet,
+                    noisy_model_input,
+                    start_timesteps,
+                    prompt_embeds,
+                    conditioning_latents,
+                    unet_dtype,
+                    brushnet_dtype,
+                )
+                pred_x_0 = get_predicted_original_sample(
+                    noise_pred,
+                    start_timesteps,
+                    noisy_model_input,
+                    noise_scheduler.config.prediction_type,
+                    alpha_schedule,
+                    sigma_schedule,
+                )
+                model_pred = c_skip_start * noisy_model_input + c_out_start * pred_x_0
+
+                # 7. Compute the unconditional and conditional teacher predictions in one batch to get the CFG
+                # estimates of the predicted noise eps_0 and predicted original sample x_0, then run the ODE solver
+                # using these estimates to predict the data point in the augmented PF-ODE trajectory corresponding to
+                # the next ODE solver timestep. The BrushNet conditioning is the same for both halves.
+                with torch.no_grad():
+                    teacher_output = predict_noise(
+                        teacher_unet,
+                        teacher_brushnet,
+                        torch.cat([noisy_model_input] * 2),
+                        torch.cat([start_timesteps] * 2),
+                        torch.cat([uncond_prompt_embeds.expand(bsz, -1, -1), prompt_embeds]),
+                        torch.cat([conditioning_latents] * 2),
+                        weight_dtype,
+                        weight_dtype,
+                    ).float()
+                    teacher_pred_x0 = get_predicted_original_sample(
+                        teacher_output,
+                        torch.cat([start_timesteps] * 2),
+                        torch.cat([noisy_model_input] * 2),
+                        noise_scheduler.config.prediction_type,
+                        alpha_schedule,
+                        sigma_schedule,
+                    )
+                    teacher_pred_noise = get_predicted_noise(
+                        teacher_output,
+                        torch.cat([start_timesteps] * 2),
+                        torch.cat([noisy_model_input] * 2),
+                        noise_scheduler.config.prediction_type,
+                        alpha_schedule,
+                        sigma_schedule,
+                    )
+                    uncond_pred_x0, cond_pred_x0 = teacher_pred_x0.chunk(2)
+                    uncond_pred_noise, cond_pred_noise = teacher_pred_noise.chunk(2)
+
+                    # Note that this uses the LCM paper's CFG formulation rather than the Imagen CFG formulation
+                    pred_x0 = cond_pred_x0 + w * (cond_pred_x0 - uncond_pred_x0)
+                    pred_noise = cond_pred_noise + w * (cond_pred_noise - uncond_pred_noise)
+                    # Run one step of the ODE solver to estimate the next point x_prev on the augmented PF-ODE
+                    # trajectory (solving backward in time). The DDIM step depends on both x_0 and eps_0.
+                    x_prev = solver.ddim_step(pred_x0, pred_noise, index)
+
+                # 8. Get target LCM prediction on x_prev, c, t_n (timesteps). The LoRA is its own target network like
+                # in LCM-LoRA distillation, a student BrushNet uses its EMA copy.
+                with torch.no_grad():
+                    target_noise_pred = predict_noise(
+                        unet,
+                        target_brushnet,
+                        x_prev,
+                        timesteps,
+                        prompt_embeds,
+                        conditioning_latents,
+                        unet_dtype,
+                        target_brushnet_dtype,
+                    )
+                    pred_x_0 = get_predicted_original_sample(
+                        target_noise_pred,
+                        timesteps,
+                        x_prev,
+                        noise_scheduler.config.prediction_type,
+                        alpha_schedule,
+                        sigma_schedule,
+                    )
+                    target = c_skip * x_prev + c_out * pred_x_0
+
+                # 9. Calculate loss
+                if args.loss_type == "l2":
+                    loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
+                elif args.loss_type == "huber":
+                    loss = torch.mean(
+                        torch.sqrt((model_pred.float() - target.float()) ** 2 + args.huber_c**2) - args.huber_c
+                    )
+
+                # 10. Backpropagate on the online student
+                accelerator.backward(loss)
+                if accelerator.sync_gradients:
+                    accelerator.clip_grad_norm_(params_to_optimize, args.max_grad_norm)
+                optimizer.step()
+                lr_scheduler.step()
+                optimizer.zero_grad(set_to_none=args.set_grads_to_none)
+
+            # Checks if the accelerator has performed an optimization step behind the scenes
+            if accelerator.sync_gradients:
+                # 11. Make EMA update to the target student BrushNet parameters
+                if args.distill_target == "brushnet":
+                    update_ema(target_brushnet.parameters(), unwrap_model(brushnet).parameters(), args.ema_decay)
+                progress_bar.update(1)
+                global_step += 1
+
+                if accelerator.is_main_process:
+                    if global_step % args.checkpointing_steps == 0:
+                        # _before_ saving state, check if this save would set us over the `checkpoints_total_limit`
+                        if args.checkpoints_total_limit is not None:
+                            checkpoints = os.listdir(args.output_dir)
+                            checkpoints = [d for d in checkpoints if d.startswith("checkpoint")]
+                            checkpoints = sorted(checkpoints, key=lambda x: int(x.split("-")[1]))
+
+                            # before we save the new checkpoint, we need to have at _most_ `checkpoints_total_limit - 1` checkpoints
+                            if len(checkpoints) >= args.checkpoints_total_limit:
+                                num_to_remove = len(checkpoints) - args.checkpoints_total_limit + 1
+                                removing_checkpoints = checkpoints[0:num_to_remove]
+
+                                logger.info(
+                                    f"{len(checkpoints)} checkpoints already exist, removing {len(removing_checkpoints)} checkpoints"
+                                )
+                                logger.info(f"removing checkpoints: {', '.join(removing_checkpoints)}")
+
+                                for removing_checkpoint in removing_checkpoints:
+                                    removing_checkpoint = os.path.join(args.output_dir, removing_checkpoint)
+                                    shutil.rmtree(removing_checkpoint)
+
+                        save_path = os.path.join(args.output_dir, f"checkpoint-{global_step}")
+                        accelerator.save_state(save_path)
+                        logger.info(f"Saved state to {save_path}")
+
+                    if args.validation_prompt is not None and global_step % args.validation_steps == 0:
+                        log_validation(
+                            vae,
+                            text_encoder,
+                            tokenizer,
+                            unwrap_model(unet),
+                            unwrap_model(brushnet),
+                            args,
+                            accelerator,
+                            weight_dtype,
+                            global_step,
+                        )
+
+            logs = {"loss": loss.detach().item(), "lr": lr_scheduler.get_last_lr()[0]}
+            progress_bar.set_postfix(**logs)
+            accelerator.log(logs, step=global_step)
+
+            if global_step >= args.max_train_steps:
+                break
+
+    # Save the distilled LoRA or student BrushNet so that it can be used with `LCMScheduler`.
+    accelerator.wait_for_everyone()
+    if accelerator.is_main_process:
+        if args.distill_target == "lora":
+            unet_lora_state_dict = convert_state_dict_to_diffusers(get_peft_model_state_dict(unwrap_model(unet)))
+            StableDiffusionBrushNetPipeline.save_lora_weights(args.output_dir, unet_lora_layers=unet_lora_state_dict)
+        else:
+            unwrap_model(brushnet).save_pretrained(args.output_dir)
+            target_brushnet.save_pretrained(os.path.join(args.output_dir, "brushnet_target"))
+
+    accelerator.end_training()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
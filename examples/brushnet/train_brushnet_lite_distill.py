@@ -0,0 +1,894 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import argparse
+import json
+import logging
+import math
+import os
+import shutil
+from pathlib import Path
+
+import accelerate
+import torch
+import torch.nn.functional as F
+import torch.utils.checkpoint
+import transformers
+from accelerate import Accelerator
+from accelerate.data_loader import DataLoaderShard
+from accelerate.logging import get_logger
+from accelerate.utils import ProjectConfiguration, set_seed
+from packaging import version
+from random_masks import random_brush_mask_conditioning
+from tqdm.auto import tqdm
+from train_brushnet import MyWebDataset, import_model_class_from_model_name_or_path, log_validation
+from transformers import AutoTokenizer
+from webdataset_stream import WebDatasetStream, load_shard_index
+
+import diffusers
+from diffusers import (
+    AutoencoderKL,
+    BrushNetModel,
+    DDPMScheduler,
+    UNet2DConditionModel,
+)
+from diffusers.models.brushnet import load_matching_state_dict
+from diffusers.optimization import get_scheduler
+from diffusers.utils import check_min_version
+from diffusers.utils.import_utils import is_xformers_available
+from diffusers.utils.torch_utils import is_compiled_module
+
+
+# Will error if the minimal version of diffusers is not installed. Remove at your own risks.
+check_min_version("0.27.0.dev0")
+
+logger = get_logger(__name__)
+
+
+def parse_args(input_args=None):
+    parser = argparse.ArgumentParser(description="Simple example of a BrushNet-Lite feature distillation script.")
+    parser.add_argument(
+        "--pretrained_model_name_or_path",
+        type=str,
+        default=None,
+        required=True,
+        help="Path to pretrained model or model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--brushnet_model_name_or_path",
+        type=str,
+        default=None,
+        required=True,
+        help="Path to the trained teacher brushnet model or model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--revision",
+        type=str,
+        default=None,
+        required=False,
+        help="Revision of pretrained model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--variant",
+        type=str,
+        default=None,
+        help="Variant of the model files of the pretrained model identifier from huggingface.co/models, 'e.g.' fp16",
+    )
+    parser.add_argument(
+        "--tokenizer_name",
+        type=str,
+        default=None,
+        help="Pretrained tokenizer name or path if not the same as model_name",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default="brushnet-lite",
+        help="The output directory where the model predictions and checkpoints will be written.",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="A seed for reproducible training.")
+    parser.add_argument(
+        "--resolution",
+        type=int,
+        default=512,
+        help=(
+            "The resolution for input images, all the images in the train/validation dataset will be resized to this"
+            " resolution"
+        ),
+    )
+    parser.add_argument(
+        "--train_batch_size", type=int, default=4, help="Batch size (per device) for the training dataloader."
+    )
+    parser.add_argument("--num_train_epochs", type=int, default=10000)
+    parser.add_argument(
+        "--max_train_steps",
+        type=int,
+        default=None,
+        help="Total number of training steps to perform.  If provided, overrides num_train_epochs.",
+    )
+    parser.add_argument(
+        "--checkpointing_steps",
+        type=int,
+        default=500,
+        help=(
+            "Save a checkpoint of the training state every X updates. Checkpoints can be used for resuming training"
+            " via `--resume_from_checkpoint`."
+        ),
+    )
+    parser.add_argument(
+        "--checkpoints_total_limit",
+        type=int,
+        default=None,
+        help=("Max number of checkpoints to store."),
+    )
+    parser.add_argument(
+        "--resume_from_checkpoint",
+        type=str,
+        default=None,
+        help=(
+            "Whether training should be resumed from a previous checkpoint. Use a path saved by"
+            ' `--checkpointing_steps`, or `"latest"` to automatically select the last available checkpoint.'
+        ),
+    )
+    parser.add_argument(
+        "--gradient_accumulation_steps",
+        type=int,
+        default=1,
+        help="Number of updates steps to accumulate before performing a backward/update pass.",
+    )
+    parser.add_argument(
+        "--gradient_checkpointing",
+        action="store_true",
+        help="Whether or not to use gradient checkpointing to save memory at the expense of slower backward pass.",
+    )
+    parser.add_argument(
+        "--learning_rate",
+        type=float,
+        default=1e-4,
+        help="Initial learning rate (after the potential warmup period) to use.",
+    )
+    parser.add_argument(
+        "--scale_lr",
+        action="store_true",
+        default=False,
+        help="Scale the learning rate by the number of GPUs, gradient accumulation steps, and batch size.",
+    )
+    parser.add_argument(
+        "--lr_scheduler",
+        type=str,
+        default="constant",
+        help=(
+            'The scheduler type to use. Choose between ["linear", "cosine", "cosine_with_restarts", "polynomial",'
+            ' "constant", "constant_with_warmup"]'
+        ),
+    )
+    parser.add_argument(
+        "--lr_warmup_steps", type=int, default=500, help="Number of steps for the warmup in the lr scheduler."
+    )
+    parser.add_argument(
+        "--use_8bit_adam", action="store_true", help="Whether or not to use 8-bit Adam from bitsandbytes."
+    )
+    parser.add_argument(
+        "--shuffle_buffer_size",
+        type=int,
+        default=1000,
+        help=(
+            "The number of samples every process shuffles the training stream with. The shards are also shuffled every"
+            " epoch. 0 reads the shards and their samples in order."
+        ),
+    )
+    parser.add_argument(
+        "--dataloader_num_workers",
+        type=int,
+        default=0,
+        help=(
+            "Number of subprocesses to use for data loading. 0 means that the data will be loaded in the main process."
+        ),
+    )
+    parser.add_argument("--adam_beta1", type=float, default=0.9, help="The beta1 parameter for the Adam optimizer.")
+    parser.add_argument("--adam_beta2", type=float, default=0.999, help="The beta2 parameter for the Adam optimizer.")
+    parser.add_argument("--adam_weight_decay", type=float, default=1e-2, help="Weight decay to use.")
+    parser.add_argument("--adam_epsilon", type=float, default=1e-08, help="Epsilon value for the Adam optimizer")
+    parser.add_argument("--max_grad_norm", default=1.0, type=float, help="Max gradient norm.")
+    parser.add_argument(
+        "--logging_dir",
+        type=str,
+        default="logs",
+        help=(
+            "[TensorBoard](https://www.tensorflow.org/tensorboard) log directory. Will default to"
+            " *output_dir/runs/**CURRENT_DATETIME_HOSTNAME***."
+        ),
+    )
+    parser.add_argument(
+        "--allow_tf32",
+        action="store_true",
+        help=(
+            "Whether or not to allow TF32 on Ampere GPUs. Can be used to speed up training. For more information, see"
+            " https://pytorch.org/docs/stable/notes/cuda.html#tensorfloat-32-tf32-on-ampere-devices"
+        ),
+    )
+    parser.add_argument(
+        "--report_to",
+        type=str,
+        default="tensorboard",
+        help=(
+            'The integration to report the results and logs to. Supported platforms are `"tensorboard"`'
+            ' (default), `"wandb"` and `"comet_ml"`. Use `"all"` to report to all integrations.'
+        ),
+    )
+    parser.add_argument(
+        "--mixed_precision",
+        type=str,
+        default=None,
+        choices=["no", "fp16", "bf16"],
+        help=(
+            "Whether to use mixed precision. Choose between fp16 and bf16 (bfloat16). Bf16 requires PyTorch >="
+            " 1.10.and an Nvidia Ampere GPU.  Default to the value of accelerate config of the current system or the"
+            " flag passed with the `accelerate.launch` command. Use this argument to override the accelerate config."
+        ),
+    )
+    parser.add_argument(
+        "--enable_xformers_memory_efficient_attention", action="store_true", help="Whether or not to use xformers."
+    )
+    parser.add_argument(
+        "--set_grads_to_none",
+        action="store_true",
+        help=(
+            "Save more memory by using setting grads to None instead of zero. Be aware, that this changes certain"
+            " behaviors, so disable this argument if it causes any problems. More info:"
+            " https://pytorch.org/docs/stable/generated/torch.optim.Optimizer.zero_grad.html"
+        ),
+    )
+    parser.add_argument(
+        "--train_data_dir",
+        type=str,
+        default=None,
+        required=True,
+        help="A folder containing the training data as webdataset `.tar` shards in the format of BrushData.",
+    )
+    parser.add_argument(
+        "--proportion_empty_prompts",
+        type=float,
+        default=0,
+        help="Proportion of image prompts to be replaced with empty strings. Defaults to 0 (no prompt replacement).",
+    )
+    parser.add_argument(
+        "--random_mask",
+        action="store_true",
+        help=(
+            "Distill BrushNet with random mask"
+        ),
+    )
+    parser.add_argument(
+        "--device_random_mask",
+        action="store_true",
+        help=(
+            "With `--random_mask`, draw the random masks for the whole batch on the training device instead of in the"
+            " dataloader workers. Seeded with `--seed` on every process."
+        ),
+    )
+    parser.add_argument(
+        "--mask_cache_mb",
+        type=int,
+        default=0,
+        help=(
+            "Size in MB of the bit-packed LRU cache of decoded segmentation masks kept by every dataloader worker."
+            " Masks are keyed by sample and mask index, so they are only decoded once while they stay cached."
+            " Defaults to 0 (masks are decoded for every sample)."
+        ),
+    )
+    parser.add_argument(
+        "--full_resolution_decode",
+        action="store_true",
+        help=(
+            "Decode training images at their full source resolution. By default JPEGs are decoded at the largest DCT"
+            " scale-down (1/2, 1/4 or 1/8) whose short side still covers `--resolution`."
+        ),
+    )
+    # ----BrushNet-Lite----
+    parser.add_argument(
+        "--lite_block_out_channels",
+        type=int,
+        default=None,
+        nargs="+",
+        help=(
+            "The output channels of each block of the lite brushnet. Its zero convolutions project back to the UNet"
+            " widths. Defaults to the block widths of the UNet."
+        ),
+    )
+    parser.add_argument(
+        "--lite_layers_per_block",
+        type=int,
+        default=1,
+        help="The number of layers per block of the lite brushnet.",
+    )
+    parser.add_argument(
+        "--lite_no_up_blocks",
+        action="store_true",
+        help="Whether to drop the up-block branch of the lite brushnet.",
+    )
+    parser.add_argument(
+        "--feature_loss_weight",
+        type=float,
+        default=1.0,
+        help="The weight of the loss between the residuals of the lite brushnet and the teacher brushnet.",
+    )
+    parser.add_argument(
+        "--output_loss_weight",
+        type=float,
+        default=1.0,
+        help=(
+            "The weight of the loss between the UNet predictions conditioned by the lite brushnet and by the teacher"
+            " brushnet. It lets the lite brushnet make up for the residuals it does not produce, e.g. without up"
+            " blocks. Set it to 0 to skip the UNet passes."
+        ),
+    )
+    # ----Validation----
+    parser.add_argument(
+        "--validation_prompt",
+        type=str,
+        default=None,
+        nargs="+",
+        help="A set of prompts evaluated every `--validation_steps` and logged to `--report_to`.",
+    )
+    parser.add_argument(
+        "--validation_image",
+        type=str,
+        default=None,
+        nargs="+",
+        help="A set of paths to the images inpainted for the `--validation_prompt`s.",
+    )
+    parser.add_argument(
+        "--validation_mask",
+        type=str,
+        default=None,
+        nargs="+",
+        help="A set of paths to the masks of the `--validation_image`s.",
+    )
+    parser.add_argument(
+        "--num_validation_images",
+        type=int,
+        default=4,
+        help="Number of images to be generated for each `--validation_image`, `--validation_prompt` pair",
+    )
+    parser.add_argument(
+        "--validation_steps",
+        type=int,
+        default=100,
+        help="Run validation every X steps.",
+    )
+    parser.add_argument(
+        "--tracker_project_name",
+        type=str,
+        default="train_brushnet_lite_distill",
+        help=(
+            "The `project_name` argument passed to Accelerator.init_trackers for"
+            " more information see https://huggingface.co/docs/accelerate/v0.17.0/en/package_reference/accelerator#accelerate.Accelerator"
+        ),
+    )
+
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
+
+    if args.proportion_empty_prompts < 0 or args.proportion_empty_prompts > 1:
+        raise ValueError("`--proportion_empty_prompts` must be in the range [0, 1].")
+
+    if args.device_random_mask and not args.random_mask:
+        raise ValueError("`--device_random_mask` requires `--random_mask`.")
+
+    if args.feature_loss_weight == 0 and args.output_loss_weight == 0:
+        raise ValueError("At least one of `--feature_loss_weight` and `--output_loss_weight` must be positive.")
+
+    validation_args = [args.validation_prompt, args.validation_image, args.validation_mask]
+    if any(arg is not None for arg in validation_args):
+        if any(arg is None for arg in validation_args) or len({len(arg) for arg in validation_args}) != 1:
+            raise ValueError(
+                "`--validation_prompt`, `--validation_image` and `--validation_mask` must be set together and have"
+                " the same number of values."
+            )
+
+    if args.resolution % 8 != 0:
+        raise ValueError(
+            "`--resolution` must be divisible by 8 for consistently sized encoded images between the VAE and the brushnet encoder."
+        )
+
+    return args
+
+
+def main(args):
+    logging_dir = Path(args.output_dir, args.logging_dir)
+
+    accelerator_project_config = ProjectConfiguration(project_dir=args.output_dir, logging_dir=logging_dir)
+
+    accelerator = Accelerator(
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        mixed_precision=args.mixed_precision,
+        log_with=args.report_to,
+        project_config=accelerator_project_config,
+    )
+
+    # Make one log on every process with the configuration for debugging.
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    logger.info(accelerator.state, main_process_only=False)
+    if accelerator.is_local_main_process:
+        transformers.utils.logging.set_verbosity_warning()
+        diffusers.utils.logging.set_verbosity_info()
+    else:
+        transformers.utils.logging.set_verbosity_error()
+        diffusers.utils.logging.set_verbosity_error()
+
+    # If passed along, set the training seed now.
+    if args.seed is not None:
+        set_seed(args.seed)
+
+    if accelerator.is_main_process:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    # 1. Load the scheduler, tokenizer and models.
+    noise_scheduler = DDPMScheduler.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="scheduler", revision=args.revision
+    )
+    if args.tokenizer_name:
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name, revision=args.revision, use_fast=False)
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(
+            args.pretrained_model_name_or_path, subfolder="tokenizer", revision=args.revision, use_fast=False
+        )
+    text_encoder_cls = import_model_class_from_model_name_or_path(args.pretrained_model_name_or_path, args.revision)
+    text_encoder = text_encoder_cls.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="text_encoder", revision=args.revision, variant=args.variant
+    )
+    vae = AutoencoderKL.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="vae", revision=args.revision, variant=args.variant
+    )
+    unet = UNet2DConditionModel.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="unet", revision=args.revision, variant=args.variant
+    )
+    teacher_brushnet = BrushNetModel.from_pretrained(args.brushnet_model_name_or_path)
+
+    # 2. Create the lite student. It starts from the UNet weights like a new BrushNet, then takes every teacher layer
+    # that kept its shape.
+    logger.info("Initializing lite brushnet weights from unet and teacher brushnet")
+    brushnet = BrushNetModel.from_unet(
+        unet,
+        brushnet_conditioning_channel_order=teacher_brushnet.config.brushnet_conditioning_channel_order,
+        conditioning_channels=teacher_brushnet.config.conditioning_channels,
+        block_out_channels=args.lite_block_out_channels,
+        layers_per_block=args.lite_layers_per_block,
+        use_up_blocks=not args.lite_no_up_blocks,
+    )
+    missing_keys = load_matching_state_dict(brushnet, teacher_brushnet.state_dict())
+    logger.info(f"{len(missing_keys)} lite brushnet weights are not initialized from the teacher brushnet")
+
+    num_student_parameters = sum(param.numel() for param in brushnet.parameters())
+    num_teacher_parameters = sum(param.numel() for param in teacher_brushnet.parameters())
+    logger.info(
+        f"Lite brushnet parameters: {num_student_parameters} ({num_student_parameters / num_teacher_parameters:.1%}"
+        " of the teacher brushnet)"
+    )
+
+    # Taken from [Sayak Paul's Diffusers PR #6511](https://github.com/huggingface/diffusers/pull/6511/files)
+    def unwrap_model(model):
+        model = accelerator.unwrap_model(model)
+        model = model._orig_mod if is_compiled_module(model) else model
+        return model
+
+    # `accelerate` 0.16.0 will have better support for customized saving
+    if version.parse(accelerate.__version__) >= version.parse("0.16.0"):
+        # create custom saving & loading hooks so that `accelerator.save_state(...)` serializes in a nice format
+        def save_model_hook(models, weights, output_dir):
+            if accelerator.is_main_process:
+                i = len(weights) - 1
+
+                while len(weights) > 0:
+                    weights.pop()
+                    model = models[i]
+
+                    sub_dir = "brushnet"
+                    model.save_pretrained(os.path.join(output_dir, sub_dir))
+
+                    i -= 1
+
+                # the position of the training stream, the same on every process
+                with open(os.path.join(output_dir, "data_stream.json"), "w") as f:
+                    json.dump(train_stream.state_dict(), f)
+
+        def load_model_hook(models, input_dir):
+            while len(models) > 0:
+                # pop models so that they are not loaded again
+                model = models.pop()
+
+                # load diffusers style into model
+                load_model = BrushNetModel.from_pretrained(input_dir, subfolder="brushnet")
+                model.register_to_config(**load_model.config)
+
+                model.load_state_dict(load_model.state_dict())
+                del load_model
+
+        accelerator.register_save_state_pre_hook(save_model_hook)
+        accelerator.register_load_state_pre_hook(load_model_hook)
+
+    vae.requires_grad_(False)
+    unet.requires_grad_(False)
+    text_encoder.requires_grad_(False)
+    teacher_brushnet.requires_grad_(False)
+    brushnet.train()
+
+    if args.enable_xformers_memory_efficient_attention:
+        if is_xformers_available():
+            import xformers
+
+            xformers_version = version.parse(xformers.__version__)
+            if xformers_version == version.parse("0.0.16"):
+                logger.warn(
+                    "xFormers 0.0.16 cannot be used for training in some GPUs. If you observe problems during training, please update xFormers to at least 0.0.17. See https://huggingface.co/docs/diffusers/main/en/optimization/xformers for more details."
+                )
+            unet.enable_xformers_memory_efficient_attention()
+            teacher_brushnet.enable_xformers_memory_efficient_attention()
+            brushnet.enable_xformers_memory_efficient_attention()
+        else:
+            raise ValueError("xformers is not available. Make sure it is installed correctly")
+
+    if args.gradient_checkpointing:
+        brushnet.enable_gradient_checkpointing()
+
+    # Check that all trainable models are in full precision
+    low_precision_error_string = (
+        " Please make sure to always have all model weights in full float32 precision when starting training - even if"
+        " doing mixed precision training, copy of the weights should still be float32."
+    )
+
+    if unwrap_model(brushnet).dtype != torch.float32:
+        raise ValueError(
+            f"BrushNet loaded as datatype {unwrap_model(brushnet).dtype}. {low_precision_error_string}"
+        )
+
+    # Enable TF32 for faster training on Ampere GPUs,
+    # cf https://pytorch.org/docs/stable/notes/cuda.html#tensorfloat-32-tf32-on-ampere-devices
+    if args.allow_tf32:
+        torch.backends.cuda.matmul.allow_tf32 = True
+
+    if args.scale_lr:
+        args.learning_rate = (
+            args.learning_rate * args.gradient_accumulation_steps * args.train_batch_size * accelerator.num_processes
+        )
+
+    # Use 8-bit Adam for lower memory usage or to fine-tune the model in 16GB GPUs
+    if args.use_8bit_adam:
+        try:
+            import bitsandbytes as bnb
+        except ImportError:
+            raise ImportError(
+                "To use 8-bit Adam, please install the bitsandbytes library: `pip install bitsandbytes`."
+            )
+
+        optimizer_class = bnb.optim.AdamW8bit
+    else:
+        optimizer_class = torch.optim.AdamW
+
+    # 3. Optimizer creation
+    params_to_optimize = brushnet.parameters()
+    optimizer = optimizer_class(
+        params_to_optimize,
+        lr=args.learning_rate,
+        betas=(args.adam_beta1, args.adam_beta2),
+        weight_decay=args.adam_weight_decay,
+        eps=args.adam_epsilon,
+    )
+
+    # 4. Dataset creation and data processing, with the same masking as `train_brushnet.py`
+    shard_paths = sorted(
+        os.path.join(args.train_data_dir, shard) for shard in os.listdir(args.train_data_dir) if shard.endswith(".tar")
+    )
+    # the main process indexes the shards first, the others read its cached index
+    with accelerator.main_process_first():
+        shard_index = load_shard_index(shard_paths, cache_path=os.path.join(args.output_dir, "shard_index.json"))
+    # Every process streams its own samples, so the dataloader is not sharded by `accelerator.prepare`, which would
+    # read every batch on the main process and dispatch it.
+    train_stream = WebDatasetStream(
+        shard_paths,
+        shard_index,
+        batch_size=args.train_batch_size,
+        shuffle_buffer_size=args.shuffle_buffer_size,
+        seed=args.seed if args.seed is not None else 0,
+        rank=accelerator.process_index,
+        world_size=accelerator.num_processes,
+    )
+    train_dataset_len = train_stream.num_samples
+    train_dataloader = DataLoaderShard(
+        train_stream,
+        device=accelerator.device,
+        collate_fn=MyWebDataset(
+            resolution=args.resolution,
+            tokenizer=tokenizer,
+            random_mask=args.random_mask,
+            proportion_empty_prompts=args.proportion_empty_prompts,
+            full_resolution_decode=args.full_resolution_decode,
+            mask_cache_mb=args.mask_cache_mb,
+            device_random_mask=args.device_random_mask,
+        ),
+        batch_size=args.train_batch_size,
+        num_workers=args.dataloader_num_workers,
+    )
+    train_dataloader_len = train_stream.num_batches
+
+    # Scheduler and math around the number of training steps.
+    overrode_max_train_steps = False
+    num_update_steps_per_epoch = math.ceil(train_dataloader_len / args.gradient_accumulation_steps)
+    if args.max_train_steps is None:
+        args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
+        overrode_max_train_steps = True
+
+    lr_scheduler = get_scheduler(
+        args.lr_scheduler,
+        optimizer=optimizer,
+        num_warmup_steps=args.lr_warmup_steps * accelerator.num_processes,
+        num_training_steps=args.max_train_steps * accelerator.num_processes,
+    )
+
+    # Prepare everything with our `accelerator`.
+    brushnet, optimizer, lr_scheduler = accelerator.prepare(brushnet, optimizer, lr_scheduler)
+
+    # For mixed precision training we cast the text_encoder, vae, unet and teacher brushnet weights to half-precision
+    # as these models are only used for inference, keeping weights in full precision is not required.
+    weight_dtype = torch.float32
+    if accelerator.mixed_precision == "fp16":
+        weight_dtype = torch.float16
+    elif accelerator.mixed_precision == "bf16":
+        weight_dtype = torch.bfloat16
+
+    vae.to(accelerator.device, dtype=weight_dtype)
+    unet.to(accelerator.device, dtype=weight_dtype)
+    text_encoder.to(accelerator.device, dtype=weight_dtype)
+    teacher_brushnet.to(accelerator.device, dtype=weight_dtype)
+
+    # We need to recalculate our total training steps as the size of the training dataloader may have changed.
+    num_update_steps_per_epoch = math.ceil(train_dataloader_len / args.gradient_accumulation_steps)
+    if overrode_max_train_steps:
+        args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
+    # Afterwards we recalculate our number of training epochs
+    args.num_train_epochs = math.ceil(args.max_train_steps / num_update_steps_per_epoch)
+
+    # We need to initialize the trackers we use, and also store our configuration.
+    # The trackers initializes automatically on the main process.
+    if accelerator.is_main_process:
+        tracker_config = dict(vars(args))
+
+        # tensorboard cannot handle list types for config
+        tracker_config.pop("lite_block_out_channels")
+        tracker_config.pop("validation_prompt")
+        tracker_config.pop("validation_image")
+        tracker_config.pop("validation_mask")
+
+        accelerator.init_trackers(args.tracker_project_name, config=tracker_config)
+
+    # 5. Train!
+    total_batch_size = args.train_batch_size * accelerator.num_processes * args.gradient_accumulation_steps
+
+    logger.info("***** Running distillation *****")
+    logger.info(f"  Num examples = {train_dataset_len}")
+    logger.info(f"  Num batches each epoch = {train_dataloader_len}")
+    logger.info(f"  Num Epochs = {args.num_train_epochs}")
+    logger.info(f"  Instantaneous batch size per device = {args.train_batch_size}")
+    logger.info(f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}")
+    logger.info(f"  Gradient Accumulation steps = {args.gradient_accumulation_steps}")
+    logger.info(f"  Total optimization steps = {args.max_train_steps}")
+    global_step = 0
+    first_epoch = 0
+
+    # Potentially load in the weights and states from a previous save
+    if args.resume_from_checkpoint:
+        if args.resume_from_checkpoint != "latest":
+            path = os.path.basename(args.resume_from_checkpoint)
+        else:
+            # Get the most recent checkpoint
+            dirs = os.listdir(args.output_dir)
+            dirs = [d for d in dirs if d.startswith("checkpoint")]
+            dirs = sorted(dirs, key=lambda x: int(x.split("-")[1]))
+            path = dirs[-1] if len(dirs) > 0 else None
+
+        if path is None:
+            accelerator.print(
+                f"Checkpoint '{args.resume_from_checkpoint}' does not exist. Starting a new training run."
+            )
+            args.resume_from_checkpoint = None
+            initial_global_step = 0
+        else:
+            accelerator.print(f"Resuming from checkpoint {path}")
+            checkpoint_path = os.path.join(args.output_dir, path)
+            accelerator.load_state(checkpoint_path, map_location="cpu")
+            global_step = int(path.split("-")[1])
+
+            initial_global_step = global_step
+            first_epoch = global_step // num_update_steps_per_epoch
+            # checkpoints saved before the stream position was stored restart the stream
+            stream_state_path = os.path.join(checkpoint_path, "data_stream.json")
+            if os.path.isfile(stream_state_path):
+                with open(stream_state_path) as f:
+                    train_stream.load_state_dict(json.load(f))
+                # the stream continues after the last batch of the checkpoint
+                first_epoch = train_stream.epoch
+    else:
+        initial_global_step = 0
+
+    progress_bar = tqdm(
+        range(0, args.max_train_steps),
+        initial=initial_global_step,
+        desc="Steps",
+        # Only show the progress bar once on each machine.
+        disable=not accelerator.is_local_main_process,
+    )
+
+    # draws the `--device_random_mask` masks, seeded separately on every process
+    mask_generator = None
+    if args.device_random_mask and args.seed is not None:
+        mask_generator = torch.Generator(device=accelerator.device).manual_seed(args.seed + accelerator.process_index)
+
+    for epoch in range(first_epoch, args.num_train_epochs):
+        train_stream.set_epoch(epoch)
+        for step, batch in enumerate(train_dataloader):
+            train_stream.batches_consumed += 1
+            with accelerator.accumulate(brushnet):
+                # 1. Encode the images, the masked images and the masks like `train_brushnet.py`
+                with torch.no_grad():
+                    if args.device_random_mask:
+                        batch["conditioning_pixel_values"], batch["masks"] = random_brush_mask_conditioning(
+                            batch["pixel_values"],
+                            batch["mask_canvas_sizes"],
+                            batch["mask_crops"],
+                            generator=mask_generator,
+                        )
+                    latents = vae.encode(batch["pixel_values"].to(dtype=weight_dtype)).latent_dist.sample()
+                    latents = latents * vae.config.scaling_factor
+
+                    conditioning_latents = vae.encode(
+                        batch["conditioning_pixel_values"].to(dtype=weight_dtype)
+                    ).latent_dist.sample()
+                    conditioning_latents = conditioning_latents * vae.config.scaling_factor
+
+                    masks = torch.nn.functional.interpolate(
+                        batch["masks"], size=(latents.shape[-2], latents.shape[-1])
+                    )
+                    conditioning_latents = torch.concat([conditioning_latents, masks.to(weight_dtype)], 1)
+
+                    encoder_hidden_states = text_encoder(batch["input_ids"], return_dict=False)[0]
+                bsz = latents.shape[0]
+
+                # 2. Add noise to the latents for a random timestep of each image
+                noise = torch.randn_like(latents)
+                timesteps = torch.randint(0, noise_scheduler.config.num_train_timesteps, (bsz,), device=latents.device)
+                timesteps = timesteps.long()
+                noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
+
+                # 3. Get the teacher residuals, the targets of the lite brushnet
+                with torch.no_grad():
+                    teacher_down_samples, teacher_mid_sample, teacher_up_samples = teacher_brushnet(
+                        noisy_latents,
+                        timesteps,
+                        encoder_hidden_states=encoder_hidden_states,
+                        brushnet_cond=conditioning_latents,
+                        return_dict=False,
+                    )
+
+                down_block_res_samples, mid_block_res_sample, up_block_res_samples = brushnet(
+                    noisy_latents,
+                    timesteps,
+                    encoder_hidden_states=encoder_hidden_states,
+                    brushnet_cond=conditioning_latents,
+                    return_dict=False,
+                )
+
+                # 4. Match every residual the lite brushnet produces. They are projected to the UNet widths, so they
+                # line up one to one with the teacher residuals.
+                feature_pairs = list(zip(down_block_res_samples, teacher_down_samples))
+                feature_pairs.append((mid_block_res_sample, teacher_mid_sample))
+                feature_pairs += list(zip(up_block_res_samples, teacher_up_samples))
+                feature_loss = sum(
+                    F.mse_loss(sample.float(), teacher_sample.float(), reduction="mean")
+                    for sample, teacher_sample in feature_pairs
+                ) / len(feature_pairs)
+                loss = args.feature_loss_weight * feature_loss
+                logs = {"feature_loss": feature_loss.detach().item()}
+
+                # 5. Match the noise prediction of the UNet conditioned by either brushnet
+                if args.output_loss_weight > 0:
+                    with torch.no_grad():
+                        teacher_pred = unet(
+                            noisy_latents,
+                            timesteps,
+                            encoder_hidden_states=encoder_hidden_states,
+                            down_block_add_samples=list(teacher_down_samples),
+                            mid_block_add_sample=teacher_mid_sample,
+                            up_block_add_samples=list(teacher_up_samples),
+                            return_dict=False,
+                        )[0]
+                    model_pred = unet(
+                        noisy_latents,
+                        timesteps,
+                        encoder_hidden_states=encoder_hidden_states,
+                        down_block_add_samples=[sample.to(dtype=weight_dtype) for sample in down_block_res_samples],
+                        mid_block_add_sample=mid_block_res_sample.to(dtype=weight_dtype),
+                        up_block_add_samples=[sample.to(dtype=weight_dtype) for sample in up_block_res_samples],
+                        return_dict=False,
+                    )[0]
+                    output_loss = F.mse_loss(model_pred.float(), teacher_pred.float(), reduction="mean")
+                    loss = loss + args.output_loss_weight * output_loss
+                    logs["output_loss"] = output_loss.detach().item()
+
+                accelerator.backward(loss)
+                if accelerator.sync_gradients:
+                    params_to_clip = brushnet.parameters()
+                    accelerator.clip_grad_norm_(params_to_clip, args.max_grad_norm)
+                optimizer.step()
+                lr_scheduler.step()
+                optimizer.zero_grad(set_to_none=args.set_grads_to_none)
+
+            # Checks if the accelerator has performed an optimization step behind the scenes
+            if accelerator.sync_gradients:
+                progress_bar.update(1)
+                global_step += 1
+
+                if accelerator.is_main_process:
+                    if global_step % args.checkpointing_steps == 0:
+                        # _before_ saving state, check if this save would set us over the `checkpoints_total_limit`
+                        if args.checkpoints_total_limit is not None:
+                            checkpoints = os.listdir(args.output_dir)
+                            checkpoints = [d for d in checkpoints if d.startswith("checkpoint")]
+                            checkpoints = sorted(checkpoints, key=lambda x: int(x.split("-")[1]))
+
+                            # before we save the new checkpoint, we need to have at _most_ `checkpoints_total_limit - 1` checkpoints
+                            if len(checkpoints) >= args.checkpoints_total_limit:
+                                num_to_remove = len(checkpoints) - args.checkpoints_total_limit + 1
+                                removing_checkpoints = checkpoints[0:num_to_remove]
+
+                                logger.info(
+                                    f"{len(checkpoints)} checkpoints already exist, removing {len(removing_checkpoints)} checkpoints"
+                                )
+                                logger.info(f"removing checkpoints: {', '.join(removing_checkpoints)}")
+
+                                for removing_checkpoint in removing_checkpoints:
+                                    removing_checkpoint = os.path.join(args.output_dir, removing_checkpoint)
+                                    shutil.rmtree(removing_checkpoint)
+
+                        save_path = os.path.join(args.output_dir, f"checkpoint-{global_step}")
+                        accelerator.save_state(save_path)
+                        logger.info(f"Saved state to {save_path}")
+
+                    if args.validation_prompt is not None and global_step % args.validation_steps == 0:
+                        log_validation(
+                            vae,
+                            text_encoder,
+                            tokenizer,
+                            unet,
+                            brushnet,
+                            args,
+                            accelerator,
+                            weight_dtype,
+                            global_step,
+                        )
+
+            logs.update(loss=loss.detach().item(), lr=lr_scheduler.get_last_lr()[0])
+            progress_bar.set_postfix(**logs)
+            accelerator.log(logs, step=global_step)
+
+            if global_step >= args.max_train_steps:
+                break
+
+    # Save the lite brushnet, it is used like any other brushnet with `BrushNetModel.from_pretrained(output_dir)`.
+    accelerator.wait_for_everyone()
+    if accelerator.is_main_process:
+        brushnet = unwrap_model(brushnet)
+        brushnet.save_pretrained(args.output_dir)
+
+    accelerator.end_training()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -5,6 +5,7 @@ import argparse
 import contextlib
 import functools
 import gc
+import hashlib
 import logging
 import math
 import os
@@ -24,7 +25,13 @@ from torch.utils.data import Dataset
 import transformers
 from accelerate import Accelerator
 from accelerate.logging import get_logger
-from accelerate.utils import ProjectConfiguration, set_seed
+from accelerate.utils import ProjectConfiguration, gather_object, set_seed
+from async_checkpoint import (
+    AsyncCheckpointWriter,
+    collect_random_states,
+    is_async_checkpoint,
+    load_async_checkpoint,
+)
 from datasets import load_dataset
 from huggingface_hub import create_repo, upload_folder
 from packaging import version
@@ -32,6 +39,7 @@ from PIL import Image, ImageDraw, ImageOps
 from torchvision import transforms
 from tqdm.auto import tqdm
 from transformers import AutoTokenizer, PretrainedConfig
+from mask_rle import rle_decode
 
 import diffusers
 from diffusers import (
@@ -353,6 +361,15 @@ def parse_args(input_args=None):
         default=150,
         help=("Max number of checkpoints to store."),
     )
+    parser.add_argument(
+        "--async_checkpointing",
+        action="store_true",
+        help=(
+            "Write the checkpoints from a background thread. Only the BrushNet weights and the optimizer state are"
+            " copied to CPU memory in the training loop; they are written as safetensors while training continues, and"
+            " a checkpoint only appears under its name once it is complete."
+        ),
+    )
     parser.add_argument(
         "--resume_from_checkpoint",
         type=str,
@@ -533,6 +550,22 @@ def parse_args(input_args=None):
         default=0,
         help="Proportion of image prompts to be replaced with empty strings. Defaults to 0 (no prompt replacement).",
     )
+    parser.add_argument(
+        "--precomputed_embeddings_dir",
+        type=str,
+        default=None,
+        help=(
+            "A directory for the text embeddings of the whole dataset. If set, all captions are encoded once in"
+            " batches before training, the embeddings are written to memory-mapped shards in this directory and the"
+            " text encoders are freed. Existing embeddings are reused when the captions and text encoders match."
+        ),
+    )
+    parser.add_argument(
+        "--precompute_batch_size",
+        type=int,
+        default=64,
+        help="Batch size (per device) for encoding the captions when `--precomputed_embeddings_dir` is set.",
+    )
     parser.add_argument(
         "--validation_prompt",
         type=str,
@@ -801,6 +834,131 @@ def encode_prompt(prompt_batch, text_encoders, tokenizers, proportion_empty_prom
 #         "unet_added_conditions": {"text_embeds": add_text_embeds, "time_ids": add_time_ids},
 #     }
 
+class TextEmbeddingStore():
+    r"""
+    Reads the SDXL text embeddings written by `precompute_text_embeddings`. The shards are memory-mapped on first
+    access, so every DataLoader worker shares the page cache instead of unpickling its own copy.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "metadata.json")) as f:
+            metadata = json.load(f)
+        self.num_rows = metadata["num_rows"]
+        self.shard_size = metadata["shard_size"]
+        self._shards = None
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getstate__(self):
+        # send the paths to the DataLoader workers, not the mapped arrays
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        return state
+
+    def _open(self):
+        num_shards = math.ceil(self.num_rows / self.shard_size)
+        self._shards = [
+            (
+                np.load(os.path.join(self.path, f"prompt_embeds-{shard:05d}.npy"), mmap_mode="r"),
+                np.load(os.path.join(self.path, f"text_embeds-{shard:05d}.npy"), mmap_mode="r"),
+            )
+            for shard in range(num_shards)
+        ]
+        self._empty = (
+            np.load(os.path.join(self.path, "empty_prompt_embeds.npy"))[0],
+            np.load(os.path.join(self.path, "empty_text_embeds.npy"))[0],
+        )
+
+    def __getitem__(self, index):
+        if self._shards is None:
+            self._open()
+        prompt_embeds, text_embeds = self._shards[index // self.shard_size]
+        return prompt_embeds[index % self.shard_size], text_embeds[index % self.shard_size]
+
+    def empty_prompt(self):
+        if self._shards is None:
+            self._open()
+        return self._empty
+
+
+def precompute_text_embeddings(
+    captions, text_encoders, tokenizers, output_dir, accelerator, batch_size=64, shard_size=10000, fingerprint=None
+):
+    r"""
+    Encodes `captions` with both SDXL text encoders in batches of `batch_size` and writes the `prompt_embeds` and
+    pooled `text_embeds` to float16 `.npy` shards of `shard_size` rows in `output_dir`, together with the embeddings of
+    the empty prompt. The shards are split over the processes of `accelerator`. A caption given as a list is encoded
+    with its first entry. Returns a `TextEmbeddingStore` reading them back, and reuses the shards of a previous run
+    with the same `fingerprint`.
+    """
+    metadata_path = os.path.join(output_dir, "metadata.json")
+    if os.path.isfile(metadata_path):
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        if metadata["fingerprint"] == fingerprint and metadata["num_rows"] == len(captions):
+            logger.info(f"Reusing the text embeddings in {output_dir}")
+            return TextEmbeddingStore(output_dir)
+
+    accelerator.wait_for_everyone()
+    if accelerator.is_main_process:
+        os.makedirs(output_dir, exist_ok=True)
+        if os.path.isfile(metadata_path):
+            os.remove(metadata_path)
+        prompt_embeds, text_embeds = encode_prompt([""], text_encoders, tokenizers, 0, is_train=False)
+        np.save(os.path.join(output_dir, "empty_prompt_embeds.npy"), prompt_embeds.to(torch.float16).cpu().numpy())
+        np.save(os.path.join(output_dir, "empty_text_embeds.npy"), text_embeds.to(torch.float16).cpu().numpy())
+    accelerator.wait_for_everyone()
+
+    num_shards = math.ceil(len(captions) / shard_size)
+    shards = range(accelerator.process_index, num_shards, accelerator.num_processes)
+    progress_bar = tqdm(
+        total=sum(min(shard_size, len(captions) - shard * shard_size) for shard in shards),
+        desc="Encoding captions",
+        disable=not accelerator.is_local_main_process,
+    )
+    for shard in shards:
+        shard_start = shard * shard_size
+        shard_end = min(shard_start + shard_size, len(captions))
+        shard_prompt_embeds = shard_text_embeds = None
+        for start in range(shard_start, shard_end, batch_size):
+            end = min(start + batch_size, shard_end)
+            prompt_embeds, text_embeds = encode_prompt(
+                captions[start:end], text_encoders, tokenizers, 0, is_train=False
+            )
+            if shard_prompt_embeds is None:
+                # write straight into the mapped shard instead of holding it in memory
+                shard_prompt_embeds = np.lib.format.open_memmap(
+                    os.path.join(output_dir, f"prompt_embeds-{shard:05d}.npy"),
+                    mode="w+",
+                    dtype=np.float16,
+                    shape=(shard_end - shard_start, *prompt_embeds.shape[1:]),
+                )
+                shard_text_embeds = np.lib.format.open_memmap(
+                    os.path.join(output_dir, f"text_embeds-{shard:05d}.npy"),
+                    mode="w+",
+                    dtype=np.float16,
+                    shape=(shard_end - shard_start, *text_embeds.shape[1:]),
+                )
+            shard_prompt_embeds[start - shard_start : end - shard_start] = prompt_embeds.to(torch.float16).cpu().numpy()
+            shard_text_embeds[start - shard_start : end - shard_start] = text_embeds.to(torch.float16).cpu().numpy()
+            progress_bar.update(end - start)
+        shard_prompt_embeds.flush()
+        shard_text_embeds.flush()
+        del shard_prompt_embeds, shard_text_embeds
+    progress_bar.close()
+
+    # the metadata is written last, so an interrupted run is never mistaken for a complete one
+    accelerator.wait_for_everyone()
+    if accelerator.is_main_process:
+        with open(metadata_path, "w") as f:
+            json.dump({"num_rows": len(captions), "shard_size": shard_size, "fingerprint": fingerprint}, f)
+    accelerator.wait_for_everyone()
+
+    return TextEmbeddingStore(output_dir)
+
+
 def tokenize_captions(caption, original_size, crops_coords_top_left, target_size, text_encoders, tokenizers, is_train=True):
     prompt_embeds, pooled_prompt_embeds = encode_prompt(
         [caption], text_encoders, tokenizers, args.proportion_empty_prompts, is_train
@@ -814,11 +972,13 @@ def tokenize_captions(caption, original_size, crops_coords_top_left, target_size
 
 
 class MyWebDataset():
-    def __init__(self,resolution,text_encoders, tokenizers, random_mask):
+    def __init__(self,resolution,text_encoders, tokenizers, random_mask, text_embedding_store=None, proportion_empty_prompts=0):
         self.resolution = resolution
         self.text_encoders = text_encoders
         self.tokenizers = tokenizers
         self.random_mask = random_mask
+        self.text_embedding_store = text_embedding_store
+        self.proportion_empty_prompts = proportion_empty_prompts
 
     def random_brush_gen(
         self,
@@ -885,14 +1045,7 @@ class MyWebDataset():
 
     def rle2mask(self, mask_rle, shape):# height width
         # Decode rle encoded mask.
-        mask_rle=np.array(mask_rle)
-        starts, lengths = [np.asarray(x, dtype=int) for x in (mask_rle[0:][::2], mask_rle[1:][::2])]
-        starts -= 1
-        ends = starts + lengths
-        img = np.zeros(shape[0] * shape[1], dtype=np.uint8)
-        for lo, hi in zip(starts, ends):
-            img[lo:hi] = 1
-        return img.reshape(shape, order='F')
+        return rle_decode(mask_rle, shape)
 
     def tokenize_captions(self, caption, original_size, crops_coords_top_left, target_size, is_train=True):
         prompt_embeds, pooled_prompt_embeds = encode_prompt(
@@ -1005,6 +1158,35 @@ class MyWebDataset():
         conditioning_pixel_values = conditioning_pixel_values.to(memory_format=torch.contiguous_format).float()
         masks = torch.stack(masks)
         masks = masks.to(memory_format=torch.contiguous_format).float()
+
+        if self.text_embedding_store is not None:
+            # the text embeddings are read from the memory-mapped store, only the time ids depend on the crop
+            prompt_embeds = []
+            text_embeds = []
+            for example in examples:
+                if random.random() < self.proportion_empty_prompts:
+                    example_prompt_embeds, example_text_embeds = self.text_embedding_store.empty_prompt()
+                else:
+                    example_prompt_embeds, example_text_embeds = self.text_embedding_store[example["row_index"]]
+                prompt_embeds.append(example_prompt_embeds)
+                text_embeds.append(example_text_embeds)
+            time_ids = [
+                list(original_size + crops_coords_top_left + target_size)
+                for original_size, crops_coords_top_left, target_size in zip(
+                    original_size_list, crops_coords_top_left_list, target_size_list
+                )
+            ]
+            return {
+                "pixel_values": pixel_values,
+                "conditioning_pixel_values": conditioning_pixel_values,
+                "masks": masks,
+                "prompt_embeds": torch.from_numpy(np.stack(prompt_embeds)),
+                "unet_added_conditions": {
+                    "text_embeds": torch.from_numpy(np.stack(text_embeds)),
+                    "time_ids": torch.tensor(time_ids),
+                },
+            }
+
         # prompt_embeds = torch.stack(prompt_embeds)
         # prompt_embeds = prompt_embeds.to(memory_format=torch.contiguous_format).float()
         # text_embeds = torch.stack(text_embeds)
@@ -1270,6 +1452,36 @@ def main(args):
         cache_dir=args.cache_dir,
         num_proc=16
     )
+
+    text_embedding_store = None
+    if args.precomputed_embeddings_dir is not None:
+        # Encode every caption once, in large batches, instead of one example at a time in the training loop. The
+        # rows of the store follow the unshuffled dataset, the `row_index` column keeps track of them.
+        captions = train_dataset["train"][args.caption_column]
+        fingerprint = hashlib.sha256(
+            json.dumps(
+                [args.pretrained_model_name_or_path, args.revision, args.variant, captions], default=str
+            ).encode()
+        ).hexdigest()
+        text_embedding_store = precompute_text_embeddings(
+            captions,
+            text_encoders,
+            tokenizers,
+            args.precomputed_embeddings_dir,
+            accelerator,
+            batch_size=args.precompute_batch_size,
+            fingerprint=fingerprint,
+        )
+        train_dataset["train"] = train_dataset["train"].add_column(
+            "row_index", np.arange(len(train_dataset["train"]))
+        )
+
+        # the text encoders are not needed anymore, validation loads its own
+        del text_encoder_one, text_encoder_two, captions
+        text_encoders = None
+        gc.collect()
+        torch.cuda.empty_cache()
+
     with accelerator.main_process_first():
         train_dataset = train_dataset["train"].shuffle(seed=args.seed)
         if args.max_train_samples is not None:
@@ -1278,7 +1490,14 @@ def main(args):
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset,
         shuffle=False,
-        collate_fn=MyWebDataset(resolution = args.resolution, text_encoders = text_encoders, tokenizers = tokenizers, random_mask=args.random_mask),
+        collate_fn=MyWebDataset(
+            resolution=args.resolution,
+            text_encoders=text_encoders,
+            tokenizers=tokenizers,
+            random_mask=args.random_mask,
+            text_embedding_store=text_embedding_store,
+            proportion_empty_prompts=args.proportion_empty_prompts,
+        ),
         batch_size=args.train_batch_size,
         num_workers=args.dataloader_num_workers,
     )
@@ -1393,8 +1612,23 @@ def main(args):
             initial_global_step = 0
         else:
             accelerator.print(f"Resuming from checkpoint {path}")
-            accelerator.load_state(os.path.join(args.output_dir, path))
+            checkpoint_path = os.path.join(args.output_dir, path)
             global_step = int(path.split("-")[1])
+            if is_async_checkpoint(checkpoint_path):
+                restored_random_states = load_async_checkpoint(
+                    checkpoint_path,
+                    unwrap_model(brushnet),
+                    optimizer,
+                    lr_scheduler,
+                    scaler=accelerator.scaler,
+                    process_index=accelerator.process_index,
+                )
+                if not restored_random_states and args.seed is not None:
+                    # saved by fewer processes (`best_checkpoint` only holds those of the main process), this one is
+                    # seeded apart from the others and from the first run
+                    set_seed(args.seed + global_step, device_specific=True)
+            else:
+                accelerator.load_state(checkpoint_path)
 
             initial_global_step = global_step
             first_epoch = global_step // num_update_steps_per_epoch
@@ -1410,6 +1644,9 @@ def main(args):
     )
     min_loss = 0.0033905887976288795
     image_logs = None
+    checkpoint_writer = None
+    if args.async_checkpointing and accelerator.is_main_process:
+        checkpoint_writer = AsyncCheckpointWriter(args.output_dir, total_limit=args.checkpoints_total_limit)
     for epoch in range(first_epoch, args.num_train_epochs):
         for step, batch in enumerate(train_dataloader):
             with accelerator.accumulate(brushnet):
@@ -1454,26 +1691,30 @@ def main(args):
                 # Add noise to the latents according to the noise magnitude at each timestep
                 # (this is the forward diffusion process)
                 noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
-                prompt_embeds=[]
-                text_embeds=[]
-                time_ids=[]
-                for i in range(bsz):
-                    additional_embeds=tokenize_captions(batch["caption"][i] , batch["original_size"][i], batch["crops_coords_top_left"][i], batch["target_size"][i], text_encoders, tokenizers)
-                    prompt_embeds.append(additional_embeds["prompt_embeds"][0])
-                    text_embeds.append(additional_embeds["text_embeds"][0])
-                    time_ids.append(additional_embeds["time_ids"][0])
-                prompt_embeds = torch.stack(prompt_embeds)
-                prompt_embeds = prompt_embeds.to(memory_format=torch.contiguous_format).float()
-                text_embeds = torch.stack(text_embeds)
-                text_embeds = text_embeds.to(memory_format=torch.contiguous_format).float()
-                time_ids = torch.stack(time_ids)
-                time_ids = time_ids.to(memory_format=torch.contiguous_format).float()
-                 # "prompt_embeds": prompt_embeds,
-            # "unet_added_conditions": {
-            # "text_embeds": text_embeds, 
-            # "time_ids": time_ids,                        
-                batch["prompt_embeds"]=prompt_embeds.to(weight_dtype)
-                batch["unet_added_conditions"]={"text_embeds":text_embeds.to(weight_dtype),"time_ids":time_ids.to(weight_dtype).to('cuda')}
+                if text_embedding_store is not None:
+                    # precomputed by `precompute_text_embeddings` and collated by `MyWebDataset`
+                    batch["prompt_embeds"] = batch["prompt_embeds"].to(accelerator.device, dtype=weight_dtype)
+                    batch["unet_added_conditions"] = {
+                        key: value.to(accelerator.device, dtype=weight_dtype)
+                        for key, value in batch["unet_added_conditions"].items()
+                    }
+                else:
+                    prompt_embeds=[]
+                    text_embeds=[]
+                    time_ids=[]
+                    for i in range(bsz):
+                        additional_embeds=tokenize_captions(batch["caption"][i] , batch["original_size"][i], batch["crops_coords_top_left"][i], batch["target_size"][i], text_encoders, tokenizers)
+                        prompt_embeds.append(additional_embeds["prompt_embeds"][0])
+                        text_embeds.append(additional_embeds["text_embeds"][0])
+                        time_ids.append(additional_embeds["time_ids"][0])
+                    prompt_embeds = torch.stack(prompt_embeds)
+                    prompt_embeds = prompt_embeds.to(memory_format=torch.contiguous_format).float()
+                    text_embeds = torch.stack(text_embeds)
+                    text_embeds = text_embeds.to(memory_format=torch.contiguous_format).float()
+                    time_ids = torch.stack(time_ids)
+                    time_ids = time_ids.to(memory_format=torch.contiguous_format).float()
+                    batch["prompt_embeds"]=prompt_embeds.to(weight_dtype)
+                    batch["unet_added_conditions"]={"text_embeds":text_embeds.to(weight_dtype),"time_ids":time_ids.to(weight_dtype).to('cuda')}
 
                 down_block_res_samples, mid_block_res_sample, up_block_res_samples = brushnet(
                     noisy_latents,
@@ -1509,9 +1750,20 @@ def main(args):
                     raise ValueError(f"Unknown prediction type {noise_scheduler.config.prediction_type}")
                 loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
                 min_loss = min(min_loss, loss)
-                if min_loss >= loss:
-                    # save the model
-                    accelerator.save_state(os.path.join(args.output_dir, f"best_checkpoint"))
+                # a new best loss that comes while a checkpoint is still being written is skipped rather than stalling
+                # the step until it is on disk
+                if min_loss >= loss and not (checkpoint_writer is not None and checkpoint_writer.is_busy()):
+                    # save the model, with the random states of the main process only
+                    if checkpoint_writer is not None:
+                        checkpoint_writer.save(
+                            "best_checkpoint",
+                            unwrap_model(brushnet),
+                            optimizer,
+                            lr_scheduler,
+                            scaler=accelerator.scaler,
+                        )
+                    elif not args.async_checkpointing:
+                        accelerator.save_state(os.path.join(args.output_dir, f"best_checkpoint"))
                     logger.info(f"Saved state to {os.path.join(args.output_dir, f'best_checkpoint')}")
                     min_loss = loss     
                     # save step and loss in a txt
@@ -1530,8 +1782,24 @@ def main(args):
                 progress_bar.update(1)
                 global_step += 1
 
+                random_states = None
+                if args.async_checkpointing and global_step % args.checkpointing_steps == 0:
+                    # every process resumes from its own random states
+                    random_states = gather_object([collect_random_states()])
+
                 if accelerator.is_main_process:
-                    if global_step % args.checkpointing_steps == 0:
+                    if global_step % args.checkpointing_steps == 0 and checkpoint_writer is not None:
+                        save_path = os.path.join(args.output_dir, f"checkpoint-{global_step}")
+                        checkpoint_writer.save(
+                            f"checkpoint-{global_step}",
+                            unwrap_model(brushnet),
+                            optimizer,
+                            lr_scheduler,
+                            scaler=accelerator.scaler,
+                            random_states=random_states,
+                        )
+                        logger.info(f"Writing state to {save_path} in the background")
+                    elif global_step % args.checkpointing_steps == 0:
                         # _before_ saving state, check if this save would set us over the `checkpoints_total_limit`
                         if args.checkpoints_total_limit is not None:
                             checkpoints = os.listdir(args.output_dir)
@@ -1574,6 +1842,9 @@ def main(args):
             if global_step >= args.max_train_steps:
                 break
 
+    if checkpoint_writer is not None:
+        checkpoint_writer.wait()
+
     # Create the pipeline using using the trained modules and save it.
     accelerator.wait_for_everyone()
     if accelerator.is_main_process:
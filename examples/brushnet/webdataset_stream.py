@@ -0,0 +1,245 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Distributed, resumable streaming of WebDataset `.tar` shards.
+
+Every shard is indexed once with the byte range of each of its samples, a sample being the consecutive tar members that
+share a key. The index gives the exact number of samples, and lets every process and data loader worker seek straight
+to the samples assigned to it instead of reading the shards from their start.
+"""
+
+import io
+import json
+import os
+import tarfile
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset
+
+
+def index_shard(path):
+    """
+    Returns the byte offsets of the samples of the tar shard at `path`, as an `int64` array of length `num_samples + 1`
+    whose consecutive entries delimit every sample.
+    """
+    offsets = []
+    key = None
+    end = 0
+    with tarfile.open(path, "r:") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_key = os.path.basename(member.name).split(".", 1)[0]
+            if member_key != key:
+                # the header offset includes the extended headers of long names
+                offsets.append(member.offset)
+                key = member_key
+            end = member.offset_data + -(-member.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    offsets.append(end)
+    return np.asarray(offsets, dtype=np.int64)
+
+
+def load_shard_index(shard_paths, cache_path=None):
+    """
+    Indexes `shard_paths` with `index_shard`, reusing the offsets cached in `cache_path` for shards whose size and
+    modification time didn't change, and returns the list of offset arrays.
+    """
+    cached = {}
+    if cache_path is not None and os.path.isfile(cache_path):
+        with open(cache_path) as f:
+            cached = json.load(f)
+
+    index, entries, updated = [], {}, False
+    for path in shard_paths:
+        stat = os.stat(path)
+        entry = cached.get(os.path.abspath(path))
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime, "offsets": index_shard(path).tolist()}
+            updated = True
+        entries[os.path.abspath(path)] = entry
+        index.append(np.asarray(entry["offsets"], dtype=np.int64))
+
+    if cache_path is not None and updated:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        with open(cache_path + ".tmp", "w") as f:
+            json.dump(entries, f)
+        os.replace(cache_path + ".tmp", cache_path)
+    return index
+
+
+def read_sample(f, start, end, url=None):
+    """
+    Reads the sample stored at bytes `[start, end)` of the open shard `f` as a dict of its raw member bytes keyed by
+    extension, together with its `__key__` and `__url__`.
+    """
+    f.seek(start)
+    sample = {"__url__": url}
+    with tarfile.open(fileobj=io.BytesIO(f.read(end - start)), mode="r:") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            key, extension = os.path.basename(member.name).split(".", 1)
+            sample["__key__"] = os.path.join(os.path.dirname(member.name), key)
+            sample[extension] = tar.extractfile(member).read()
+    return sample
+
+
+def shuffle_buffer_order(length, buffer_size, rng):
+    """
+    Returns the order in which a shuffle buffer of `buffer_size` samples emits a stream of `length` samples: every
+    incoming sample replaces a random sample of the full buffer, which is emitted.
+    """
+    if buffer_size <= 1:
+        return np.arange(length)
+    order = np.empty(length, dtype=np.int64)
+    buffer = list(range(min(buffer_size, length)))
+    picks = rng.random(length)
+    for position in range(length):
+        slot = int(picks[position] * len(buffer))
+        order[position] = buffer[slot]
+        incoming = position + len(buffer)
+        if incoming < length:
+            buffer[slot] = incoming
+        else:
+            buffer[slot] = buffer[-1]
+            buffer.pop()
+    return order
+
+
+class WebDatasetStream(IterableDataset):
+    r"""
+    Streams the samples of WebDataset shards, split over distributed processes and data loader workers.
+
+    Every epoch the shards are shuffled, concatenated and cut into `world_size` contiguous runs of the same number of
+    samples, so every process reads its own shards (only the shards at the boundaries are shared, never their samples).
+    The samples of a process pass through a shuffle buffer and are grouped into batches of `batch_size`, which the data
+    loader workers take in turn. The last incomplete batch is dropped, so every process sees the same number of
+    batches.
+
+    The stream is resumed from `batches_consumed`, which the training loop increments for every batch it takes and
+    saves with `state_dict`. Because the workers take the remaining batches in turn, the batches come out in the same
+    order whatever the number of workers and the batches already consumed.
+
+    Args:
+        shard_paths (`List[str]`):
+            The paths of the `.tar` shards.
+        shard_index (`List[np.ndarray]`, *optional*):
+            The sample offsets of every shard, as returned by `load_shard_index`. Indexed on creation if not passed.
+        batch_size (`int`, defaults to 1):
+            The batch size of the data loader reading the stream.
+        shuffle_buffer_size (`int`, defaults to 0):
+            The number of samples the shuffle buffer holds. With 0 the shards and their samples are read in order.
+        seed (`int`, defaults to 0):
+            The seed of the shard and buffer shuffling, which also depends on the epoch.
+        rank (`int`, defaults to 0):
+            The index of this process.
+        world_size (`int`, defaults to 1):
+            The number of processes.
+    """
+
+    max_open_files = 8
+
+    def __init__(
+        self, shard_paths, shard_index=None, batch_size=1, shuffle_buffer_size=0, seed=0, rank=0, world_size=1
+    ):
+        self.shard_paths = list(shard_paths)
+        self.shard_index = shard_index if shard_index is not None else load_shard_index(self.shard_paths)
+        self.batch_size = batch_size
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.shard_lengths = np.asarray([len(offsets) - 1 for offsets in self.shard_index], dtype=np.int64)
+        self.num_samples = int(self.shard_lengths.sum())
+        self.num_batches = self.num_samples // world_size // batch_size
+        self.epoch = 0
+        self.batches_consumed = 0
+
+    def __len__(self):
+        return self.num_batches * self.batch_size
+
+    def set_epoch(self, epoch):
+        """
+        Moves the stream to `epoch`, from its start unless the stream was resumed into `epoch`.
+        """
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.batches_consumed = 0
+
+    def state_dict(self):
+        return {
+            "epoch": self.epoch,
+            "batches_consumed": self.batches_consumed,
+            "batch_size": self.batch_size,
+            "world_size": self.world_size,
+            "num_samples": self.num_samples,
+        }
+
+    def load_state_dict(self, state_dict):
+        if (state_dict["world_size"], state_dict["num_samples"]) != (self.world_size, self.num_samples):
+            raise ValueError(
+                f"The stream position was saved for {state_dict['num_samples']} samples on"
+                f" {state_dict['world_size']} processes, it can't be resumed for {self.num_samples} samples on"
+                f" {self.world_size} processes."
+            )
+        self.epoch = state_dict["epoch"]
+        # a resume with a different batch size skips the rest of a partly consumed batch rather than repeating it
+        self.batches_consumed = -(-state_dict["batches_consumed"] * state_dict["batch_size"] // self.batch_size)
+
+    def epoch_samples(self, epoch):
+        """
+        Returns the `(shard, sample)` indices of the samples of this process in `epoch`, in the order they are batched.
+        """
+        shuffle = self.shuffle_buffer_size > 0
+        shard_order = np.arange(len(self.shard_paths))
+        if shuffle:
+            shard_order = np.random.default_rng([self.seed, epoch]).permutation(shard_order)
+        shards = np.repeat(shard_order, self.shard_lengths[shard_order])
+        samples = np.concatenate([np.arange(length) for length in self.shard_lengths[shard_order]] + [[]])
+        samples = samples.astype(np.int64)
+
+        samples_per_rank = self.num_samples // self.world_size
+        selected = slice(self.rank * samples_per_rank, (self.rank + 1) * samples_per_rank)
+        shards, samples = shards[selected], samples[selected]
+        if shuffle:
+            order = shuffle_buffer_order(
+                samples_per_rank, self.shuffle_buffer_size, np.random.default_rng([self.seed, epoch, self.rank])
+            )
+            shards, samples = shards[order], samples[order]
+        length = self.num_batches * self.batch_size
+        return shards[:length], samples[:length]
+
+    def __iter__(self):
+        shards, samples = self.epoch_samples(self.epoch)
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+
+        files = {}
+        try:
+            batches = range(self.batches_consumed + worker_id, self.num_batches, num_workers)
+            for batch in batches:
+                for position in range(batch * self.batch_size, (batch + 1) * self.batch_size):
+                    shard, sample = shards[position], samples[position]
+                    if shard not in files:
+                        # the shuffle buffer only mixes neighboring shards, so a few open files are enough
+                        if len(files) == self.max_open_files:
+                            files.pop(next(iter(files))).close()
+                        files[shard] = open(self.shard_paths[shard], "rb")
+                    offsets = self.shard_index[shard]
+                    yield read_sample(files[shard], offsets[sample], offsets[sample + 1], url=self.shard_paths[shard])
+        finally:
+            for f in files.values():
+                f.close()
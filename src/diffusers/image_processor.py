@@ -620,7 +620,11 @@ class VaeImageProcessor(ConfigMixin):
         overlay the inpaint output to the original image
         """
 
-        width, height = image.width, image.height
+        if crop_coords is None:
+            width, height = image.width, image.height
+        else:
+            # the crop is pasted back into the full-resolution original
+            width, height = init_image.width, init_image.height
 
         init_image = self.resize(init_image, width=width, height=height)
         mask = self.resize(mask, width=width, height=height)
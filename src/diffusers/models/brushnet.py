@@ -130,6 +130,17 @@ class BrushNetModel(ModelMixin, ConfigMixin):
             TODO(Patrick) - unused parameter.
         addition_embed_type_num_heads (`int`, defaults to 64):
             The number of heads to use for the `TextTimeEmbedding` layer.
+        unet_block_out_channels (`tuple[int]`, *optional*, defaults to `None`):
+            The output channels of each block of the UNet the BrushNet residuals are added to. The zero convolutions
+            project the BrushNet features from `block_out_channels` to these widths, so a BrushNet narrower than the
+            UNet can be used. Defaults to `block_out_channels`.
+        unet_layers_per_block (`int`, *optional*, defaults to `None`):
+            The number of layers per block of the UNet the BrushNet residuals are added to. Must not be smaller than
+            `layers_per_block`. When the BrushNet has fewer layers, each of its layers feeds a contiguous run of UNet
+            layers through separate zero convolutions. Defaults to `layers_per_block`.
+        use_up_blocks (`bool`, defaults to `True`):
+            Whether to build the up-block branch. Without it, the BrushNet only returns down and mid block residuals
+            and the UNet decoder runs unconditioned.
     """
 
     _supports_gradient_checkpointing = True
@@ -180,6 +191,9 @@ class BrushNetModel(ModelMixin, ConfigMixin):
         conditioning_embedding_out_channels: Optional[Tuple[int, ...]] = (16, 32, 96, 256),
         global_pool_conditions: bool = False,
         addition_embed_type_num_heads: int = 64,
+        unet_block_out_channels: Optional[Tuple[int, ...]] = None,
+        unet_layers_per_block: Optional[int] = None,
+        use_up_blocks: bool = True,
     ):
         super().__init__()
 
@@ -212,6 +226,19 @@ class BrushNetModel(ModelMixin, ConfigMixin):
                 f"Must provide the same number of `num_attention_heads` as `down_block_types`. `num_attention_heads`: {num_attention_heads}. `down_block_types`: {down_block_types}."
             )
 
+        unet_block_out_channels = unet_block_out_channels or block_out_channels
+        unet_layers_per_block = unet_layers_per_block or layers_per_block
+
+        if len(unet_block_out_channels) != len(block_out_channels):
+            raise ValueError(
+                f"Must provide the same number of `unet_block_out_channels` as `block_out_channels`. `unet_block_out_channels`: {unet_block_out_channels}. `block_out_channels`: {block_out_channels}."
+            )
+
+        if unet_layers_per_block < layers_per_block:
+            raise ValueError(
+                f"`layers_per_block` must not be larger than `unet_layers_per_block`. `layers_per_block`: {layers_per_block}. `unet_layers_per_block`: {unet_layers_per_block}."
+            )
+
         if isinstance(transformer_layers_per_block, int):
             transformer_layers_per_block = [transformer_layers_per_block] * len(down_block_types)
 
@@ -319,10 +346,14 @@ class BrushNetModel(ModelMixin, ConfigMixin):
         if isinstance(num_attention_heads, int):
             num_attention_heads = (num_attention_heads,) * len(down_block_types)
 
+        # index of the BrushNet feature each zero convolution reads, one zero convolution per UNet residual
+        self.brushnet_down_block_indices = [0]
+        self.brushnet_up_block_indices = []
+
         # down
         output_channel = block_out_channels[0]
 
-        brushnet_block = nn.Conv2d(output_channel, output_channel, kernel_size=1)
+        brushnet_block = nn.Conv2d(output_channel, unet_block_out_channels[0], kernel_size=1)
         brushnet_block = zero_module(brushnet_block)
         self.brushnet_down_blocks.append(brushnet_block)
 
@@ -353,20 +384,23 @@ class BrushNetModel(ModelMixin, ConfigMixin):
             )
             self.down_blocks.append(down_block)
 
-            for _ in range(layers_per_block):
-                brushnet_block = nn.Conv2d(output_channel, output_channel, kernel_size=1)
+            block_start = self.brushnet_down_block_indices[-1] + 1 if i > 0 else 1
+            for j in range(unet_layers_per_block):
+                brushnet_block = nn.Conv2d(output_channel, unet_block_out_channels[i], kernel_size=1)
                 brushnet_block = zero_module(brushnet_block)
                 self.brushnet_down_blocks.append(brushnet_block)
+                self.brushnet_down_block_indices.append(block_start + j * layers_per_block // unet_layers_per_block)
 
             if not is_final_block:
-                brushnet_block = nn.Conv2d(output_channel, output_channel, kernel_size=1)
+                brushnet_block = nn.Conv2d(output_channel, unet_block_out_channels[i], kernel_size=1)
                 brushnet_block = zero_module(brushnet_block)
                 self.brushnet_down_blocks.append(brushnet_block)
+                self.brushnet_down_block_indices.append(block_start + layers_per_block)
 
         # mid
         mid_block_channel = block_out_channels[-1]
 
-        brushnet_block = nn.Conv2d(mid_block_channel, mid_block_channel, kernel_size=1)
+        brushnet_block = nn.Conv2d(mid_block_channel, unet_block_out_channels[-1], kernel_size=1)
         brushnet_block = zero_module(brushnet_block)
         self.brushnet_mid_block = brushnet_block
 
@@ -391,6 +425,7 @@ class BrushNetModel(ModelMixin, ConfigMixin):
 
         # up
         reversed_block_out_channels = list(reversed(block_out_channels))
+        reversed_unet_block_out_channels = list(reversed(unet_block_out_channels))
         reversed_num_attention_heads = list(reversed(num_attention_heads))
         reversed_transformer_layers_per_block = (list(reversed(transformer_layers_per_block)))
         only_cross_attention = list(reversed(only_cross_attention))
@@ -400,7 +435,7 @@ class BrushNetModel(ModelMixin, ConfigMixin):
         self.up_blocks = nn.ModuleList([])
         self.brushnet_up_blocks = nn.ModuleList([])
 
-        for i, up_block_type in enumerate(up_block_types):
+        for i, up_block_type in enumerate(up_block_types if use_up_blocks else ()):
             is_final_block = i == len(block_out_channels) - 1
 
             prev_output_channel = output_channel
@@ -437,16 +472,19 @@ class BrushNetModel(ModelMixin, ConfigMixin):
             )
             self.up_blocks.append(up_block)
             prev_output_channel = output_channel
-            
-            for _ in range(layers_per_block+1):
-                brushnet_block = nn.Conv2d(output_channel, output_channel, kernel_size=1)
+
+            block_start = self.brushnet_up_block_indices[-1] + 1 if i > 0 else 0
+            for j in range(unet_layers_per_block+1):
+                brushnet_block = nn.Conv2d(output_channel, reversed_unet_block_out_channels[i], kernel_size=1)
                 brushnet_block = zero_module(brushnet_block)
                 self.brushnet_up_blocks.append(brushnet_block)
+                self.brushnet_up_block_indices.append(block_start + j * (layers_per_block+1) // (unet_layers_per_block+1))
 
             if not is_final_block:
-                brushnet_block = nn.Conv2d(output_channel, output_channel, kernel_size=1)
+                brushnet_block = nn.Conv2d(output_channel, reversed_unet_block_out_channels[i], kernel_size=1)
                 brushnet_block = zero_module(brushnet_block)
                 self.brushnet_up_blocks.append(brushnet_block)
+                self.brushnet_up_block_indices.append(block_start + layers_per_block+1)
 
 
     @classmethod
@@ -457,6 +495,9 @@ class BrushNetModel(ModelMixin, ConfigMixin):
         conditioning_embedding_out_channels: Optional[Tuple[int, ...]] = (16, 32, 96, 256),
         load_weights_from_unet: bool = True,
         conditioning_channels: int = 5,
+        block_out_channels: Optional[Tuple[int, ...]] = None,
+        layers_per_block: Optional[int] = None,
+        use_up_blocks: bool = True,
     ):
         r"""
         Instantiate a [`BrushNetModel`] from [`UNet2DConditionModel`].
@@ -465,6 +506,16 @@ class BrushNetModel(ModelMixin, ConfigMixin):
             unet (`UNet2DConditionModel`):
                 The UNet model weights to copy to the [`BrushNetModel`]. All configuration options are also copied
                 where applicable.
+            block_out_channels (`tuple[int]`, *optional*, defaults to `None`):
+                Narrower output channels for a lite BrushNet. Its zero convolutions project back to the UNet widths.
+                Defaults to the block widths of `unet`.
+            layers_per_block (`int`, *optional*, defaults to `None`):
+                Fewer layers per block for a lite BrushNet. Defaults to the number of layers per block of `unet`.
+            use_up_blocks (`bool`, defaults to `True`):
+                Whether to build the up-block branch.
+
+        Weights are only copied from `unet` into the layers whose shapes match, so the layers of a lite BrushNet
+        with narrower channels keep their random initialization.
         """
         transformer_layers_per_block = (
             unet.config.transformer_layers_per_block if "transformer_layers_per_block" in unet.config else 1
@@ -485,8 +536,8 @@ class BrushNetModel(ModelMixin, ConfigMixin):
             mid_block_type='MidBlock2D',
             up_block_types=["UpBlock2D" for block_name in unet.config.down_block_types],
             only_cross_attention=unet.config.only_cross_attention,
-            block_out_channels=unet.config.block_out_channels,
-            layers_per_block=unet.config.layers_per_block,
+            block_out_channels=block_out_channels or unet.config.block_out_channels,
+            layers_per_block=layers_per_block or unet.config.layers_per_block,
             downsample_padding=unet.config.downsample_padding,
             mid_block_scale_factor=unet.config.mid_block_scale_factor,
             act_fn=unet.config.act_fn,
@@ -508,27 +559,42 @@ class BrushNetModel(ModelMixin, ConfigMixin):
             projection_class_embeddings_input_dim=unet.config.projection_class_embeddings_input_dim,
             brushnet_conditioning_channel_order=brushnet_conditioning_channel_order,
             conditioning_embedding_out_channels=conditioning_embedding_out_channels,
+            unet_block_out_channels=unet.config.block_out_channels,
+            unet_layers_per_block=unet.config.layers_per_block,
+            use_up_blocks=use_up_blocks,
         )
 
         if load_weights_from_unet:
-            conv_in_condition_weight=torch.zeros_like(brushnet.conv_in_condition.weight)
-            conv_in_condition_weight[:,:4,...]=unet.conv_in.weight
-            conv_in_condition_weight[:,4:8,...]=unet.conv_in.weight
-            brushnet.conv_in_condition.weight=torch.nn.Parameter(conv_in_condition_weight)
-            brushnet.conv_in_condition.bias=unet.conv_in.bias
+            if brushnet.conv_in_condition.out_channels == unet.conv_in.out_channels:
+                conv_in_condition_weight=torch.zeros_like(brushnet.conv_in_condition.weight)
+                conv_in_condition_weight[:,:4,...]=unet.conv_in.weight
+                conv_in_condition_weight[:,4:8,...]=unet.conv_in.weight
+                brushnet.conv_in_condition.weight=torch.nn.Parameter(conv_in_condition_weight)
+                brushnet.conv_in_condition.bias=unet.conv_in.bias
 
             brushnet.time_proj.load_state_dict(unet.time_proj.state_dict())
-            brushnet.time_embedding.load_state_dict(unet.time_embedding.state_dict())
+            load_matching_state_dict(brushnet.time_embedding, unet.time_embedding.state_dict())
 
             if brushnet.class_embedding:
-                brushnet.class_embedding.load_state_dict(unet.class_embedding.state_dict())
+                load_matching_state_dict(brushnet.class_embedding, unet.class_embedding.state_dict())
 
-            brushnet.down_blocks.load_state_dict(unet.down_blocks.state_dict(),strict=False)
-            brushnet.mid_block.load_state_dict(unet.mid_block.state_dict(),strict=False)
-            brushnet.up_blocks.load_state_dict(unet.up_blocks.state_dict(),strict=False)
+            load_matching_state_dict(brushnet.down_blocks, unet.down_blocks.state_dict())
+            load_matching_state_dict(brushnet.mid_block, unet.mid_block.state_dict())
+            load_matching_state_dict(brushnet.up_blocks, unet.up_blocks.state_dict())
 
         return brushnet
 
+    @property
+    def is_text_independent(self) -> bool:
+        r"""
+        Whether the BrushNet outputs ignore the text conditioning. This is the case when none of its blocks use
+        cross-attention on `encoder_hidden_states` and no text-derived embedding is added to the time embedding, so
+        the unconditional and conditional halves of a classifier-free guidance batch yield identical residuals.
+        """
+        blocks = [*self.down_blocks, self.mid_block, *self.up_blocks]
+        has_cross_attention = any(getattr(block, "has_cross_attention", False) for block in blocks)
+        return not has_cross_attention and self.config.addition_embed_type is None
+
     @property
     # Copied from diffusers.models.unets.unet_2d_condition.UNet2DConditionModel.attn_processors
     def attn_processors(self) -> Dict[str, AttentionProcessor]:
@@ -681,7 +747,7 @@ class BrushNetModel(ModelMixin, ConfigMixin):
         timestep: Union[torch.Tensor, float, int],
         encoder_hidden_states: torch.Tensor,
         brushnet_cond: torch.FloatTensor,
-        conditioning_scale: float = 1.0,
+        conditioning_scale: Union[float, torch.Tensor] = 1.0,
         class_labels: Optional[torch.Tensor] = None,
         timestep_cond: Optional[torch.Tensor] = None,
         attention_mask: Optional[torch.Tensor] = None,
@@ -702,8 +768,9 @@ class BrushNetModel(ModelMixin, ConfigMixin):
                 The encoder hidden states.
             brushnet_cond (`torch.FloatTensor`):
                 The conditional input tensor of shape `(batch_size, sequence_length, hidden_size)`.
-            conditioning_scale (`float`, defaults to `1.0`):
-                The scale factor for BrushNet outputs.
+            conditioning_scale (`float` or `torch.Tensor`, defaults to `1.0`):
+                The scale factor for BrushNet outputs. A 0-d tensor lets a compiled BrushNet change the scale between
+                calls without recompiling.
             class_labels (`torch.Tensor`, *optional*, defaults to `None`):
                 Optional class labels for conditioning. Their embeddings will be summed with the timestep embeddings.
             timestep_cond (`torch.Tensor`, *optional*, defaults to `None`):
@@ -829,8 +896,8 @@ class BrushNetModel(ModelMixin, ConfigMixin):
 
         # 4. PaintingNet down blocks
         brushnet_down_block_res_samples = ()
-        for down_block_res_sample, brushnet_down_block in zip(down_block_res_samples, self.brushnet_down_blocks):
-            down_block_res_sample = brushnet_down_block(down_block_res_sample)
+        for index, brushnet_down_block in zip(self.brushnet_down_block_indices, self.brushnet_down_blocks):
+            down_block_res_sample = brushnet_down_block(down_block_res_samples[index])
             brushnet_down_block_res_samples = brushnet_down_block_res_samples + (down_block_res_sample,)
 
 
@@ -888,8 +955,8 @@ class BrushNetModel(ModelMixin, ConfigMixin):
 
         # 8. BrushNet up blocks
         brushnet_up_block_res_samples = ()
-        for up_block_res_sample, brushnet_up_block in zip(up_block_res_samples, self.brushnet_up_blocks):
-            up_block_res_sample = brushnet_up_block(up_block_res_sample)
+        for index, brushnet_up_block in zip(self.brushnet_up_block_indices, self.brushnet_up_blocks):
+            up_block_res_sample = brushnet_up_block(up_block_res_samples[index])
             brushnet_up_block_res_samples = brushnet_up_block_res_samples + (up_block_res_sample,)
 
         # 6. scaling
@@ -925,6 +992,21 @@ class BrushNetModel(ModelMixin, ConfigMixin):
         )
 
 
+def load_matching_state_dict(module: nn.Module, state_dict: Dict[str, torch.Tensor]) -> List[str]:
+    r"""
+    Loads the entries of `state_dict` whose name and shape match a parameter or buffer of `module` and returns the
+    names of the entries of `module` that were not loaded.
+    """
+    module_state_dict = module.state_dict()
+    matching_state_dict = {
+        name: value
+        for name, value in state_dict.items()
+        if name in module_state_dict and module_state_dict[name].shape == value.shape
+    }
+    module.load_state_dict(matching_state_dict, strict=False)
+    return [name for name in module_state_dict if name not in matching_state_dict]
+
+
 def zero_module(module):
     for p in module.parameters():
         nn.init.zeros_(p)
@@ -40,6 +40,21 @@ from ..transformers.transformer_2d import Transformer2DModel
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
 
+def add_brushnet_sample(hidden_states: torch.FloatTensor, add_sample: torch.FloatTensor) -> torch.FloatTensor:
+    r"""
+    Adds a BrushNet residual to `hidden_states`.
+
+    The batch size of `add_sample` may be a divisor of the batch size of `hidden_states`. In that case the residual is
+    broadcast over every chunk of the batch without being copied, e.g. when a single BrushNet pass is shared by the
+    unconditional and conditional halves of a classifier-free guidance batch.
+    """
+    if add_sample.shape[0] == hidden_states.shape[0]:
+        return hidden_states + add_sample
+
+    hidden_states = hidden_states.unflatten(0, (-1, add_sample.shape[0])) + add_sample
+    return hidden_states.flatten(0, 1)
+
+
 def get_down_block(
     down_block_type: str,
     num_layers: int,
@@ -1386,7 +1401,7 @@ class CrossAttnDownBlock2D(nn.Module):
                 hidden_states = hidden_states + additional_residuals
 
             if down_block_add_samples is not None:
-                hidden_states = hidden_states + down_block_add_samples.pop(0) 
+                hidden_states = add_brushnet_sample(hidden_states, down_block_add_samples.pop(0)) 
 
             output_states = output_states + (hidden_states,)
 
@@ -1395,7 +1410,7 @@ class CrossAttnDownBlock2D(nn.Module):
                 hidden_states = downsampler(hidden_states, scale=lora_scale)
 
             if down_block_add_samples is not None:
-                hidden_states = hidden_states + down_block_add_samples.pop(0) # todo: add before or after
+                hidden_states = add_brushnet_sample(hidden_states, down_block_add_samples.pop(0)) # todo: add before or after
 
             output_states = output_states + (hidden_states,)
 
@@ -1481,7 +1496,7 @@ class DownBlock2D(nn.Module):
                 hidden_states = resnet(hidden_states, temb, scale=scale)
 
             if down_block_add_samples is not None:
-                hidden_states = hidden_states + down_block_add_samples.pop(0) 
+                hidden_states = add_brushnet_sample(hidden_states, down_block_add_samples.pop(0)) 
 
             output_states = output_states + (hidden_states,)
 
@@ -1490,7 +1505,7 @@ class DownBlock2D(nn.Module):
                 hidden_states = downsampler(hidden_states, scale=scale)
 
             if down_block_add_samples is not None:
-                hidden_states = hidden_states + down_block_add_samples.pop(0)  # todo: add before or after
+                hidden_states = add_brushnet_sample(hidden_states, down_block_add_samples.pop(0))  # todo: add before or after
 
             output_states = output_states + (hidden_states,)
 
@@ -2624,7 +2639,7 @@ class CrossAttnUpBlock2D(nn.Module):
             if return_res_samples:
                 output_states = output_states + (hidden_states,)
             if up_block_add_samples is not None:
-                hidden_states = hidden_states + up_block_add_samples.pop(0) 
+                hidden_states = add_brushnet_sample(hidden_states, up_block_add_samples.pop(0)) 
 
         if self.upsamplers is not None:
             for upsampler in self.upsamplers:
@@ -2632,7 +2647,7 @@ class CrossAttnUpBlock2D(nn.Module):
             if return_res_samples:
                 output_states = output_states + (hidden_states,)
             if up_block_add_samples is not None:
-                hidden_states = hidden_states + up_block_add_samples.pop(0) 
+                hidden_states = add_brushnet_sample(hidden_states, up_block_add_samples.pop(0)) 
             
         if return_res_samples:
             return hidden_states, output_states
@@ -2749,7 +2764,7 @@ class UpBlock2D(nn.Module):
             if return_res_samples:
                 output_states = output_states + (hidden_states,)
             if up_block_add_samples is not None:
-                hidden_states = hidden_states + up_block_add_samples.pop(0)  # todo: add before or after
+                hidden_states = add_brushnet_sample(hidden_states, up_block_add_samples.pop(0))  # todo: add before or after
 
         if self.upsamplers is not None:
             for upsampler in self.upsamplers:
@@ -2758,7 +2773,7 @@ class UpBlock2D(nn.Module):
             if return_res_samples:
                 output_states = output_states + (hidden_states,)
             if up_block_add_samples is not None:
-                hidden_states = hidden_states + up_block_add_samples.pop(0)  # todo: add before or after
+                hidden_states = add_brushnet_sample(hidden_states, up_block_add_samples.pop(0))  # todo: add before or after
             
 
         if return_res_samples:
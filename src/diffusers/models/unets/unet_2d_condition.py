@@ -44,6 +44,7 @@ from ..embeddings import (
 )
 from ..modeling_utils import ModelMixin
 from .unet_2d_blocks import (
+    add_brushnet_sample,
     get_down_block,
     get_mid_block,
     get_up_block,
@@ -61,9 +62,13 @@ class UNet2DConditionOutput(BaseOutput):
     Args:
         sample (`torch.FloatTensor` of shape `(batch_size, num_channels, height, width)`):
             The hidden states output conditioned on `encoder_hidden_states` input. Output of last layer of model.
+        deep_cache_features (`torch.FloatTensor`, *optional*):
+            The hidden states entering the shallowest `deep_cache_depth` up blocks, returned when `deep_cache_depth` is
+            passed to the forward method.
     """
 
     sample: torch.FloatTensor = None
+    deep_cache_features: Optional[torch.FloatTensor] = None
 
 
 class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin, PeftAdapterMixin):
@@ -1054,6 +1059,8 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin,
         down_block_add_samples: Optional[Tuple[torch.Tensor]] = None,
         mid_block_add_sample: Optional[Tuple[torch.Tensor]] = None,
         up_block_add_samples: Optional[Tuple[torch.Tensor]] = None,
+        deep_cache_depth: Optional[int] = None,
+        deep_cache_features: Optional[torch.Tensor] = None,
     ) -> Union[UNet2DConditionOutput, Tuple]:
         r"""
         The [`UNet2DConditionModel`] forward method.
@@ -1103,11 +1110,28 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin,
                 additional residual to be added to UNet mid block output, for example from ControlNet side model
             down_intrablock_additional_residuals (`tuple` of `torch.Tensor`, *optional*):
                 additional residuals to be added within UNet down blocks, for example from T2I-Adapter side model(s)
+            down_block_add_samples (`list` of `torch.Tensor`, *optional*):
+                BrushNet samples added to the hidden states after `conv_in` and after every resnet and downsampler of
+                the down blocks. The list is consumed.
+            mid_block_add_sample (`torch.Tensor`, *optional*):
+                BrushNet sample added to the mid block output.
+            up_block_add_samples (`list` of `torch.Tensor`, *optional*):
+                BrushNet samples added to the hidden states after every resnet and upsampler of the up blocks. The list
+                is consumed.
+            deep_cache_depth (`int`, *optional*):
+                Number of shallow down and up blocks that are recomputed when reusing `deep_cache_features` (DeepCache).
+                If passed, the hidden states entering the `deep_cache_depth` shallowest up blocks are returned as
+                `deep_cache_features`.
+            deep_cache_features (`torch.Tensor`, *optional*):
+                The `deep_cache_features` of a previous call with the same `deep_cache_depth`. Only the shallowest
+                `deep_cache_depth` down and up blocks are run, the deeper ones are replaced by these features. BrushNet
+                samples of the skipped blocks are ignored.
 
         Returns:
             [`~models.unets.unet_2d_condition.UNet2DConditionOutput`] or `tuple`:
                 If `return_dict` is True, an [`~models.unets.unet_2d_condition.UNet2DConditionOutput`] is returned, otherwise
-                a `tuple` is returned where the first element is the sample tensor.
+                a `tuple` is returned where the first element is the sample tensor and, if `deep_cache_depth` is
+                passed, the second element are the deep cache features.
         """
         # By default samples have to be AT least a multiple of the overall upsampling factor.
         # The overall upsampling factor is equal to 2 ** (# num of upsampling layers).
@@ -1215,9 +1239,11 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin,
         down_block_res_samples = (sample,)
 
         if is_brushnet:
-            sample = sample + down_block_add_samples.pop(0)
+            sample = add_brushnet_sample(sample, down_block_add_samples.pop(0))
 
-        for downsample_block in self.down_blocks:
+        reuse_deep_cache = deep_cache_depth is not None and deep_cache_features is not None
+        down_blocks = self.down_blocks[:deep_cache_depth] if reuse_deep_cache else self.down_blocks
+        for downsample_block in down_blocks:
             if hasattr(downsample_block, "has_cross_attention") and downsample_block.has_cross_attention:
                 # For t2i-adapter CrossAttnDownBlock2D
                 additional_residuals = {}
@@ -1260,8 +1286,12 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin,
 
             down_block_res_samples = new_down_block_res_samples
 
+        if reuse_deep_cache and down_blocks[-1].downsamplers is not None:
+            # the downsampled output of the last recomputed block only feeds the skipped deep blocks
+            down_block_res_samples = down_block_res_samples[:-1]
+
         # 4. mid
-        if self.mid_block is not None:
+        if self.mid_block is not None and not reuse_deep_cache:
             if hasattr(self.mid_block, "has_cross_attention") and self.mid_block.has_cross_attention:
                 sample = self.mid_block(
                     sample,
@@ -1285,13 +1315,25 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin,
         if is_controlnet:
             sample = sample + mid_block_additional_residual
 
-        if is_brushnet:
-            sample = sample + mid_block_add_sample
+        if is_brushnet and not reuse_deep_cache:
+            sample = add_brushnet_sample(sample, mid_block_add_sample)
 
         # 5. up
+        num_deep_up_blocks = len(self.up_blocks) - deep_cache_depth if deep_cache_depth is not None else None
         for i, upsample_block in enumerate(self.up_blocks):
             is_final_block = i == len(self.up_blocks) - 1
 
+            if i == num_deep_up_blocks:
+                if reuse_deep_cache:
+                    sample = deep_cache_features
+                else:
+                    deep_cache_features = sample
+            if reuse_deep_cache and i < num_deep_up_blocks:
+                # skip the deep block together with the BrushNet samples it would have consumed
+                if is_brushnet:
+                    del up_block_add_samples[: len(upsample_block.resnets) + (upsample_block.upsamplers is not None)]
+                continue
+
             res_samples = down_block_res_samples[-len(upsample_block.resnets) :]
             down_block_res_samples = down_block_res_samples[: -len(upsample_block.resnets)]
 
@@ -1343,6 +1385,6 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin,
             unscale_lora_layers(self, lora_scale)
 
         if not return_dict:
-            return (sample,)
+            return (sample,) if deep_cache_depth is None else (sample, deep_cache_features)
 
-        return UNet2DConditionOutput(sample=sample)
+        return UNet2DConditionOutput(sample=sample, deep_cache_features=deep_cache_features)
@@ -11,7 +11,7 @@ from ...image_processor import PipelineImageInput, VaeImageProcessor
 from ...loaders import FromSingleFileMixin, IPAdapterMixin, LoraLoaderMixin, TextualInversionLoaderMixin
 from ...models import AutoencoderKL, BrushNetModel, ImageProjection, UNet2DConditionModel
 from ...models.lora import adjust_lora_scale_text_encoder
-from ...schedulers import KarrasDiffusionSchedulers
+from ...schedulers import KarrasDiffusionSchedulers, LCMScheduler, TCDScheduler
 from ...utils import (
     USE_PEFT_BACKEND,
     deprecate,
@@ -571,7 +571,36 @@ class StableDiffusionBrushNetPipeline(
         control_guidance_start=0.0,
         control_guidance_end=1.0,
         callback_on_step_end_tensor_inputs=None,
+        padding_mask_crop=None,
+        output_type=None,
+        strength=1.0,
+        brushnet_cache_interval=1,
+        brushnet_cache_start=0.0,
+        unet_cache_interval=1,
+        unet_cache_depth=1,
     ):
+        if strength < 0 or strength > 1:
+            raise ValueError(f"The value of strength should in [0.0, 1.0] but is {strength}")
+
+        if not isinstance(brushnet_cache_interval, int) or brushnet_cache_interval < 1:
+            raise ValueError(
+                f"`brushnet_cache_interval` has to be a positive integer but is {brushnet_cache_interval} of type"
+                f" {type(brushnet_cache_interval)}."
+            )
+        if brushnet_cache_start < 0 or brushnet_cache_start > 1:
+            raise ValueError(f"The value of brushnet_cache_start should in [0.0, 1.0] but is {brushnet_cache_start}")
+
+        if not isinstance(unet_cache_interval, int) or unet_cache_interval < 1:
+            raise ValueError(
+                f"`unet_cache_interval` has to be a positive integer but is {unet_cache_interval} of type"
+                f" {type(unet_cache_interval)}."
+            )
+        if unet_cache_depth < 1 or unet_cache_depth > len(self.unet.down_blocks):
+            raise ValueError(
+                f"`unet_cache_depth` has to be between 1 and the number of down blocks ({len(self.unet.down_blocks)})"
+                f" but is {unet_cache_depth}."
+            )
+
         if callback_steps is not None and (not isinstance(callback_steps, int) or callback_steps <= 0):
             raise ValueError(
                 f"`callback_steps` has to be a positive integer but is {callback_steps} of type"
@@ -611,6 +640,18 @@ class StableDiffusionBrushNetPipeline(
                     f" {negative_prompt_embeds.shape}."
                 )
 
+        if padding_mask_crop is not None:
+            if not isinstance(image, PIL.Image.Image):
+                raise ValueError(
+                    f"The image should be a PIL image when inpainting mask crop, but is of type {type(image)}."
+                )
+            if not isinstance(mask, PIL.Image.Image):
+                raise ValueError(
+                    f"The mask image should be a PIL image when inpainting mask crop, but is of type {type(mask)}."
+                )
+            if output_type != "pil":
+                raise ValueError(f"The output type should be PIL when inpainting mask crop, but is {output_type}.")
+
         # Check `image`
         is_compiled = hasattr(F, "scaled_dot_product_attention") and isinstance(
             self.brushnet, torch._dynamo.eval_frame.OptimizedModule
@@ -757,8 +798,278 @@ class StableDiffusionBrushNetPipeline(
 
         return image
 
-    # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.StableDiffusionPipeline.prepare_latents
-    def prepare_latents(self, batch_size, num_channels_latents, height, width, dtype, device, generator, latents=None):
+    def prepare_conditioning_latents(
+        self,
+        image,
+        mask,
+        width,
+        height,
+        batch_size,
+        num_images_per_prompt,
+        device,
+        dtype,
+        do_classifier_free_guidance=False,
+        guess_mode=False,
+        crops_coords=None,
+        resize_mode="default",
+        return_image_latents=False,
+        generator=None,
+    ):
+        r"""
+        Encodes the masked image and the mask into the BrushNet conditioning latents.
+
+        Every distinct image/mask pair is normalized and VAE-encoded once. The resulting latents are then expanded to
+        the batch size (and doubled for classifier-free guidance), as views whenever a single pair is shared by the
+        whole batch. With `return_image_latents`, the latents of the unmasked image are encoded in the same VAE pass
+        and returned as well, so that partial denoising can start from them.
+
+        The latents are sampled from the VAE posterior with `generator`. With a list of generators, every sample draws
+        its latents from its own generator, so that it is conditioned the same way in a batch as on its own.
+        """
+        image = self.image_processor.preprocess(
+            image, height=height, width=width, crops_coords=crops_coords, resize_mode=resize_mode
+        ).to(dtype=torch.float32)
+        mask = self.image_processor.preprocess(
+            mask, height=height, width=width, crops_coords=crops_coords, resize_mode=resize_mode
+        ).to(dtype=torch.float32)
+        mask = (mask.sum(1)[:, None, :, :] < 0).to(mask.dtype)
+
+        num_pairs = max(image.shape[0], mask.shape[0])
+        pairs = torch.cat([image.expand(num_pairs, -1, -1, -1), mask.expand(num_pairs, -1, -1, -1)], dim=1)
+        pairs, pair_index = torch.unique(pairs, dim=0, return_inverse=True)
+        image, mask = pairs[:, :-1], pairs[:, -1:]
+
+        # BrushNet only sees the known region, with the area to inpaint blacked out as during training
+        masked_image = (image + 1) * mask - 1
+        if return_image_latents:
+            masked_image = torch.cat([masked_image, image])
+
+        masked_image = masked_image.to(device=device, dtype=dtype)
+        posterior = self.vae.encode(masked_image).latent_dist
+        mask = torch.nn.functional.interpolate(mask, size=posterior.mean.shape[-2:]).to(device=device, dtype=dtype)
+        repeat_by = 2 if do_classifier_free_guidance and not guess_mode else 1
+
+        if isinstance(generator, list):
+            if len(generator) != batch_size:
+                raise ValueError(
+                    f"You have passed a list of generators of length {len(generator)}, but requested an effective"
+                    f" batch size of {batch_size}. Make sure the batch size matches the length of the generators."
+                )
+            if pair_index.shape[0] == 1:
+                pair_index = pair_index.expand(batch_size)
+            else:
+                pair_index = pair_index.repeat_interleave(num_images_per_prompt)
+            pair_index = pair_index.to(device)
+            # the posterior rows of every sample, followed by those of its unmasked image
+            num_latents = 2 if return_image_latents else 1
+            index = torch.stack([pair_index + i * pairs.shape[0] for i in range(num_latents)], dim=1).flatten()
+            shape = (num_latents, *posterior.mean.shape[1:])
+            noise = torch.cat(
+                [randn_tensor(shape, generator=g, device=device, dtype=posterior.mean.dtype) for g in generator]
+            )
+            latents = (posterior.mean[index] + posterior.std[index] * noise) * self.vae.config.scaling_factor
+            latents = latents.unflatten(0, (batch_size, num_latents))
+            conditioning_latents = torch.cat([latents[:, 0], mask[pair_index]], dim=1).repeat(repeat_by, 1, 1, 1)
+            if return_image_latents:
+                return conditioning_latents, latents[:, 1]
+            return conditioning_latents
+
+        conditioning_latents = posterior.sample(generator=generator) * self.vae.config.scaling_factor
+        image_latents = None
+        if return_image_latents:
+            conditioning_latents, image_latents = conditioning_latents.chunk(2)
+        conditioning_latents = torch.cat([conditioning_latents, mask], dim=1)
+
+        if conditioning_latents.shape[0] == 1:
+            conditioning_latents = conditioning_latents.expand(batch_size * repeat_by, -1, -1, -1)
+            if return_image_latents:
+                image_latents = image_latents.expand(batch_size, -1, -1, -1)
+        else:
+            # image batch size is the same as prompt batch size
+            pair_index = pair_index.repeat_interleave(num_images_per_prompt).to(device)
+            conditioning_latents = conditioning_latents[pair_index.repeat(repeat_by)]
+            if return_image_latents:
+                image_latents = image_latents[pair_index]
+
+        if return_image_latents:
+            return conditioning_latents, image_latents
+        return conditioning_latents
+
+    def decode_masked_region(
+        self,
+        latents,
+        image,
+        mask,
+        height,
+        width,
+        crops_coords=None,
+        resize_mode="default",
+        blur_kernel_size=21,
+        generator=None,
+        halo=4,
+    ):
+        r"""
+        Decodes the latents only around the area to inpaint and blends the result into the original `image`.
+
+        The decoded window covers the blurred mask plus `halo` latents on every side, so the convolutions of the VAE
+        decoder see the latents around the blended pixels. Everything outside the window is taken from `image`. Inside
+        it, the decoded pixels are blended in with the blurred mask, as in the blended mode of `examples/brushnet`.
+        The attention in the middle block of the decoder only sees the window, so the blended pixels can differ
+        slightly from those of a full decode.
+        """
+        image = self.image_processor.preprocess(
+            image, height=height, width=width, crops_coords=crops_coords, resize_mode=resize_mode
+        )
+        mask = self.image_processor.preprocess(
+            mask, height=height, width=width, crops_coords=crops_coords, resize_mode=resize_mode
+        )
+        mask = (mask.sum(1)[:, None, :, :] >= 0).to(torch.float32)
+
+        # blur the mask with the kernel cv2.GaussianBlur uses for `sigma=0`
+        sigma = 0.3 * ((blur_kernel_size - 1) * 0.5 - 1) + 0.8
+        kernel = torch.arange(blur_kernel_size, dtype=torch.float32) - (blur_kernel_size - 1) / 2
+        kernel = torch.exp(-(kernel**2) / (2 * sigma**2))
+        kernel = kernel / kernel.sum()
+        padding = blur_kernel_size // 2
+        mask_blurred = F.pad(mask, (padding, padding, padding, padding), mode="reflect")
+        mask_blurred = F.conv2d(mask_blurred, kernel.view(1, 1, 1, -1))
+        mask_blurred = F.conv2d(mask_blurred, kernel.view(1, 1, -1, 1))
+        mask = 1 - (1 - mask) * (1 - mask_blurred)
+
+        # image batch size is either 1 or the prompt batch size
+        repeat_by = latents.shape[0] // image.shape[0]
+        image = image.repeat_interleave(repeat_by, dim=0).to(device=latents.device)
+        mask = mask.repeat_interleave(latents.shape[0] // mask.shape[0], dim=0).to(device=latents.device)
+
+        rows = mask.amax(dim=(0, 1, 3)).nonzero()
+        cols = mask.amax(dim=(0, 1, 2)).nonzero()
+        if rows.numel() == 0:
+            return image
+
+        top = max(int(rows[0]) // self.vae_scale_factor - halo, 0)
+        left = max(int(cols[0]) // self.vae_scale_factor - halo, 0)
+        bottom = min(-(-(int(rows[-1]) + 1) // self.vae_scale_factor) + halo, latents.shape[-2])
+        right = min(-(-(int(cols[-1]) + 1) // self.vae_scale_factor) + halo, latents.shape[-1])
+
+        decoded = self.vae.decode(latents[:, :, top:bottom, left:right], return_dict=False, generator=generator)[0]
+
+        image = image.to(dtype=decoded.dtype)
+        window = (
+            slice(None),
+            slice(None),
+            slice(top * self.vae_scale_factor, bottom * self.vae_scale_factor),
+            slice(left * self.vae_scale_factor, right * self.vae_scale_factor),
+        )
+        mask = mask[window].to(dtype=decoded.dtype)
+        image[window] = image[window] * (1 - mask) + decoded * mask
+        return image
+
+    def extrapolate_brushnet_residuals(self, brushnet_cache, step):
+        r"""
+        Linearly extrapolates the BrushNet residuals of the last two recomputed steps in `brushnet_cache` to `step`.
+        While only one step has been computed, its residuals are reused as they are.
+        """
+        last_step, last_residuals = brushnet_cache[-1]
+        if len(brushnet_cache) < 2:
+            return last_residuals
+
+        previous_step, previous_residuals = brushnet_cache[-2]
+        weight = (step - previous_step) / (last_step - previous_step)
+        down_block_res_samples = [
+            torch.lerp(previous, last, weight) for previous, last in zip(previous_residuals[0], last_residuals[0])
+        ]
+        mid_block_res_sample = torch.lerp(previous_residuals[1], last_residuals[1], weight)
+        up_block_res_samples = [
+            torch.lerp(previous, last, weight) for previous, last in zip(previous_residuals[2], last_residuals[2])
+        ]
+        return down_block_res_samples, mid_block_res_sample, up_block_res_samples
+
+    def get_brushnet_window(self, conditioning_latents, padding):
+        r"""
+        Returns the latent window `(top, bottom, left, right)` around the area to inpaint of the whole batch, padded by
+        `padding` latent pixels and aligned to the downsampling factor of the BrushNet, or `None` if the window covers
+        the whole canvas.
+        """
+        brushnet = self.brushnet._orig_mod if is_compiled_module(self.brushnet) else self.brushnet
+        factor = 2 ** (len(brushnet.config.block_out_channels) - 1)
+        height, width = conditioning_latents.shape[-2:]
+
+        # the mask channel is 1 on the known region
+        inpaint_area = conditioning_latents[:, -1] < 0.5
+        rows = inpaint_area.any(dim=0).any(dim=1).nonzero()
+        cols = inpaint_area.any(dim=0).any(dim=0).nonzero()
+        if rows.numel() == 0:
+            return None
+
+        top = max(int(rows[0]) - padding, 0) // factor * factor
+        left = max(int(cols[0]) - padding, 0) // factor * factor
+        bottom = min(-(-(int(rows[-1]) + 1 + padding) // factor) * factor, height)
+        right = min(-(-(int(cols[-1]) + 1 + padding) // factor) * factor, width)
+        if (top, bottom, left, right) == (0, height, 0, width):
+            return None
+        return top, bottom, left, right
+
+    def pad_brushnet_residuals(self, brushnet_residuals, window, height, width):
+        r"""
+        Zero-fills the BrushNet residuals computed on the latent `window` to the `height` x `width` latent canvas.
+        """
+        top, bottom, left, right = window
+        down_block_res_samples, mid_block_res_sample, up_block_res_samples = brushnet_residuals
+
+        padded_samples = []
+        for sample in [*down_block_res_samples, mid_block_res_sample, *up_block_res_samples]:
+            scale = -(-(bottom - top) // sample.shape[-2])
+            padding = (
+                left // scale,
+                -(-width // scale) - left // scale - sample.shape[-1],
+                top // scale,
+                -(-height // scale) - top // scale - sample.shape[-2],
+            )
+            padded_samples.append(F.pad(sample, padding))
+
+        num_down_samples = len(down_block_res_samples)
+        return (
+            padded_samples[:num_down_samples],
+            padded_samples[num_down_samples],
+            padded_samples[num_down_samples + 1 :],
+        )
+
+    def pad_guess_mode_residuals(self, brushnet_residuals):
+        r"""
+        Prepends zeros for the unconditional batch to BrushNet residuals computed on the conditional batch only.
+        """
+        down_block_res_samples, mid_block_res_sample, up_block_res_samples = brushnet_residuals
+        return (
+            [F.pad(d, (0, 0, 0, 0, 0, 0, d.shape[0], 0)) for d in down_block_res_samples],
+            F.pad(mid_block_res_sample, (0, 0, 0, 0, 0, 0, mid_block_res_sample.shape[0], 0)),
+            [F.pad(d, (0, 0, 0, 0, 0, 0, d.shape[0], 0)) for d in up_block_res_samples],
+        )
+
+    # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_img2img.StableDiffusionImg2ImgPipeline.get_timesteps
+    def get_timesteps(self, num_inference_steps, strength, device):
+        # get the original timestep using init_timestep
+        init_timestep = min(int(num_inference_steps * strength), num_inference_steps)
+
+        t_start = max(num_inference_steps - init_timestep, 0)
+        timesteps = self.scheduler.timesteps[t_start * self.scheduler.order :]
+        if hasattr(self.scheduler, "set_begin_index"):
+            self.scheduler.set_begin_index(t_start * self.scheduler.order)
+
+        return timesteps, num_inference_steps - t_start
+
+    def prepare_latents(
+        self,
+        batch_size,
+        num_channels_latents,
+        height,
+        width,
+        dtype,
+        device,
+        generator,
+        latents=None,
+        image_latents=None,
+        timestep=None,
+    ):
         shape = (batch_size, num_channels_latents, height // self.vae_scale_factor, width // self.vae_scale_factor)
         if isinstance(generator, list) and len(generator) != batch_size:
             raise ValueError(
@@ -771,8 +1082,12 @@ class StableDiffusionBrushNetPipeline(
         else:
             noise = latents.to(device)
 
-        # scale the initial noise by the standard deviation required by the scheduler
-        latents = noise * self.scheduler.init_noise_sigma
+        if image_latents is None:
+            # scale the initial noise by the standard deviation required by the scheduler
+            latents = noise * self.scheduler.init_noise_sigma
+        else:
+            # partial denoising starts from the image latents noised to the first remaining timestep
+            latents = self.scheduler.add_noise(image_latents.to(device=device, dtype=dtype), noise, timestep)
         return latents, noise
 
     # Copied from diffusers.pipelines.latent_consistency_models.pipeline_latent_consistency_text2img.LatentConsistencyModelPipeline.get_guidance_scale_embedding
@@ -836,6 +1151,9 @@ class StableDiffusionBrushNetPipeline(
         mask: PipelineImageInput = None,
         height: Optional[int] = None,
         width: Optional[int] = None,
+        padding_mask_crop: Optional[int] = None,
+        strength: float = 1.0,
+        blended: bool = False,
         num_inference_steps: int = 50,
         timesteps: List[int] = None,
         guidance_scale: float = 7.5,
@@ -855,6 +1173,12 @@ class StableDiffusionBrushNetPipeline(
         guess_mode: bool = False,
         control_guidance_start: Union[float, List[float]] = 0.0,
         control_guidance_end: Union[float, List[float]] = 1.0,
+        brushnet_cache_interval: int = 1,
+        brushnet_cache_start: float = 0.0,
+        brushnet_cache_extrapolate: bool = False,
+        unet_cache_interval: int = 1,
+        unet_cache_depth: int = 1,
+        brushnet_window_padding: Optional[int] = None,
         clip_skip: Optional[int] = None,
         callback_on_step_end: Optional[Callable[[int, int, Dict], None]] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
@@ -890,9 +1214,24 @@ class StableDiffusionBrushNetPipeline(
                 The height in pixels of the generated image.
             width (`int`, *optional*, defaults to `self.unet.config.sample_size * self.vae_scale_factor`):
                 The width in pixels of the generated image.
+            padding_mask_crop (`int`, *optional*, defaults to `None`):
+                The size of margin in the crop to be applied to the image and masking. If `None`, the whole canvas is
+                denoised. Otherwise, the rectangular region that contains all masked area is expanded by
+                `padding_mask_crop` pixels of context and to the aspect ratio of `height` and `width`. Only this crop
+                is denoised at `height` x `width`, and the result is composited back into the full-resolution `image`.
+                This is useful when the masked area is small while the image is large.
+            strength (`float`, *optional*, defaults to 1.0):
+                Indicates extent to transform the reference `image`. Must be between 0 and 1. When `strength` is
+                below 1, the latents of `image` are noised to an intermediate timestep and only the remaining fraction
+                of the schedule is run, so `image` should then be passed without blacking out the area to inpaint
+                (BrushNet still only sees the known region). A value of 1 starts from pure noise and runs the full
+                number of iterations specified in `num_inference_steps`.
+            blended (`bool`, *optional*, defaults to `False`):
+                Whether to blend the generated area into `image` with a blurred mask. Only the latents around the mask
+                are decoded by the VAE, the rest of the output is taken from `image`.
             num_inference_steps (`int`, *optional*, defaults to 50):
                 The number of denoising steps. More denoising steps usually lead to a higher quality image at the
-                expense of slower inference.
+                expense of slower inference. This parameter is modulated by `strength`.
             timesteps (`List[int]`, *optional*):
                 Custom timesteps to use for the denoising process with schedulers which support a `timesteps` argument
                 in their `set_timesteps` method. If not defined, the default behavior when `num_inference_steps` is
@@ -900,6 +1239,9 @@ class StableDiffusionBrushNetPipeline(
             guidance_scale (`float`, *optional*, defaults to 7.5):
                 A higher guidance scale value encourages the model to generate images closely linked to the text
                 `prompt` at the expense of lower image quality. Guidance scale is enabled when `guidance_scale > 1`.
+                For few-step inference with a [`~schedulers.LCMScheduler`] or [`~schedulers.TCDScheduler`] and a
+                consistency distilled UNet (for example after loading an LCM-LoRA with `load_lora_weights`), use 4 to
+                8 steps and `guidance_scale=1.0` so that the batch is not doubled for classifier free guidance.
             negative_prompt (`str` or `List[str]`, *optional*):
                 The prompt or prompts to guide what to not include in image generation. If not defined, you need to
                 pass `negative_prompt_embeds` instead. Ignored when not using guidance (`guidance_scale < 1`).
@@ -907,7 +1249,8 @@ class StableDiffusionBrushNetPipeline(
                 The number of images to generate per prompt.
             eta (`float`, *optional*, defaults to 0.0):
                 Corresponds to parameter eta (η) from the [DDIM](https://arxiv.org/abs/2010.02502) paper. Only applies
-                to the [`~schedulers.DDIMScheduler`], and is ignored in other schedulers.
+                to the [`~schedulers.DDIMScheduler`] and, as the stochasticity `gamma`, to the
+                [`~schedulers.TCDScheduler`]. It is ignored in other schedulers.
             generator (`torch.Generator` or `List[torch.Generator]`, *optional*):
                 A [`torch.Generator`](https://pytorch.org/docs/stable/generated/torch.Generator.html) to make
                 generation deterministic.
@@ -951,7 +1294,29 @@ class StableDiffusionBrushNetPipeline(
             control_guidance_start (`float` or `List[float]`, *optional*, defaults to 0.0):
                 The percentage of total steps at which the BrushNet starts applying.
             control_guidance_end (`float` or `List[float]`, *optional*, defaults to 1.0):
-                The percentage of total steps at which the BrushNet stops applying.
+                The percentage of total steps at which the BrushNet stops applying. With a [`~schedulers.LCMScheduler`]
+                or [`~schedulers.TCDScheduler`], a step that is only partly inside the `control_guidance_start` to
+                `control_guidance_end` range scales the BrushNet by the part inside the range, so that few-step
+                inference does not round the range to whole steps.
+            brushnet_cache_interval (`int`, *optional*, defaults to 1):
+                The BrushNet residuals are only recomputed every `brushnet_cache_interval` steps and reused from the
+                last recomputed step in between. A value of 1 disables caching.
+            brushnet_cache_start (`float`, *optional*, defaults to 0.0):
+                The percentage of total steps during which the BrushNet residuals are recomputed on every step before
+                `brushnet_cache_interval` applies. Combined with a large interval, the BrushNet only runs on early steps.
+            brushnet_cache_extrapolate (`bool`, *optional*, defaults to `False`):
+                Whether skipped steps linearly extrapolate the residuals of the last two recomputed steps instead of
+                reusing the last ones.
+            unet_cache_interval (`int`, *optional*, defaults to 1):
+                The `unet` is only fully run every `unet_cache_interval` steps. In between, only its `unet_cache_depth`
+                shallowest down and up blocks are recomputed (with the BrushNet residuals of these blocks) and the
+                deeper features are reused from the last full step, as in DeepCache. A value of 1 disables caching.
+            unet_cache_depth (`int`, *optional*, defaults to 1):
+                The number of shallow down and up blocks of the `unet` that are recomputed on cached steps.
+            brushnet_window_padding (`int`, *optional*, defaults to `None`):
+                If not `None`, the BrushNet only runs on a latent window around the area to inpaint, padded by
+                `brushnet_window_padding` latent pixels of context and aligned to the BrushNet downsampling factor. Its
+                residuals are zero outside that window. If `None`, the BrushNet runs on the whole canvas.
             clip_skip (`int`, *optional*):
                 Number of layers to be skipped from CLIP while computing the prompt embeddings. A value of 1 means that
                 the output of the pre-final layer will be used for computing the prompt embeddings.
@@ -1019,12 +1384,26 @@ class StableDiffusionBrushNetPipeline(
             control_guidance_start,
             control_guidance_end,
             callback_on_step_end_tensor_inputs,
+            padding_mask_crop,
+            output_type,
+            strength,
+            brushnet_cache_interval,
+            brushnet_cache_start,
+            unet_cache_interval,
+            unet_cache_depth,
         )
 
         self._guidance_scale = guidance_scale
         self._clip_skip = clip_skip
         self._cross_attention_kwargs = cross_attention_kwargs
 
+        if isinstance(self.scheduler, (LCMScheduler, TCDScheduler)) and self.do_classifier_free_guidance:
+            logger.warning(
+                f"Few-step inference with {self.scheduler.__class__.__name__} is usually run without classifier free"
+                f" guidance, but `guidance_scale={guidance_scale}` doubles the batch of every step. Pass"
+                " `guidance_scale=1.0` to disable it."
+            )
+
         # 2. Define call parameters
         if prompt is not None and isinstance(prompt, str):
             batch_size = 1
@@ -1073,36 +1452,58 @@ class StableDiffusionBrushNetPipeline(
             )
 
         # 4. Prepare image
+        # A BrushNet that ignores the text conditioning gives identical residuals for both halves of a classifier-free
+        # guidance batch, so it only runs on the conditional half and its residuals are broadcast into the UNet batch.
+        share_brushnet_cfg_batch = self.do_classifier_free_guidance and not guess_mode and brushnet.is_text_independent
+
+        if padding_mask_crop is not None:
+            height = height or self.unet.config.sample_size * self.vae_scale_factor
+            width = width or self.unet.config.sample_size * self.vae_scale_factor
+            crops_coords = self.image_processor.get_crop_region(mask, width, height, pad=padding_mask_crop)
+            resize_mode = "fill"
+        else:
+            crops_coords = None
+            resize_mode = "default"
+
+        original_image, original_mask = image, mask
         if isinstance(brushnet, BrushNetModel):
-            image = self.prepare_image(
+            conditioning_latents = self.prepare_conditioning_latents(
                 image=image,
+                mask=mask,
                 width=width,
                 height=height,
                 batch_size=batch_size * num_images_per_prompt,
                 num_images_per_prompt=num_images_per_prompt,
                 device=device,
                 dtype=brushnet.dtype,
-                do_classifier_free_guidance=self.do_classifier_free_guidance,
+                do_classifier_free_guidance=self.do_classifier_free_guidance and not share_brushnet_cfg_batch,
                 guess_mode=guess_mode,
+                crops_coords=crops_coords,
+                resize_mode=resize_mode,
+                return_image_latents=strength < 1.0,
+                generator=generator,
             )
-            original_mask = self.prepare_image(
-                image=mask,
-                width=width,
-                height=height,
-                batch_size=batch_size * num_images_per_prompt,
-                num_images_per_prompt=num_images_per_prompt,
-                device=device,
-                dtype=brushnet.dtype,
-                do_classifier_free_guidance=self.do_classifier_free_guidance,
-                guess_mode=guess_mode,
-            )
-            original_mask=(original_mask.sum(1)[:,None,:,:] < 0).to(image.dtype)
-            height, width = image.shape[-2:]
+            if strength < 1.0:
+                conditioning_latents, image_latents = conditioning_latents
+            else:
+                image_latents = None
+            height, width = (size * self.vae_scale_factor for size in conditioning_latents.shape[-2:])
         else:
             assert False
 
         # 5. Prepare timesteps
         timesteps, num_inference_steps = retrieve_timesteps(self.scheduler, num_inference_steps, device, timesteps)
+        timesteps, num_inference_steps = self.get_timesteps(
+            num_inference_steps=num_inference_steps, strength=strength, device=device
+        )
+        # check that number of inference steps is not < 1 - as this doesn't make sense
+        if num_inference_steps < 1:
+            raise ValueError(
+                f"After adjusting the num_inference_steps by strength parameter: {strength}, the number of pipeline"
+                f"steps is {num_inference_steps} which is < 1 and not appropriate for this pipeline."
+            )
+        # at which timestep to set the initial noise (n.b. 50% if strength is 0.5)
+        latent_timestep = timesteps[:1].repeat(batch_size * num_images_per_prompt)
         self._num_timesteps = len(timesteps)
 
         # 6. Prepare latent variables
@@ -1116,20 +1517,10 @@ class StableDiffusionBrushNetPipeline(
             device,
             generator,
             latents,
+            image_latents=image_latents,
+            timestep=latent_timestep,
         )
 
-        # 6.1 prepare condition latents
-        conditioning_latents=self.vae.encode(image).latent_dist.sample() * self.vae.config.scaling_factor
-        mask = torch.nn.functional.interpolate(
-                    original_mask, 
-                    size=(
-                        conditioning_latents.shape[-2], 
-                        conditioning_latents.shape[-1]
-                    )
-                )
-        conditioning_latents = torch.concat([conditioning_latents,mask],1)
-
-
         # 6.5 Optionally get Guidance Scale Embedding
         timestep_cond = None
         if self.unet.config.time_cond_proj_dim is not None:
@@ -1149,14 +1540,52 @@ class StableDiffusionBrushNetPipeline(
         )
 
         # 7.2 Create tensor stating which brushnets to keep
+        few_step = isinstance(self.scheduler, (LCMScheduler, TCDScheduler))
         brushnet_keep = []
         for i in range(len(timesteps)):
-            keeps = [
-                1.0 - float(i / len(timesteps) < s or (i + 1) / len(timesteps) > e)
-                for s, e in zip(control_guidance_start, control_guidance_end)
-            ]
+            if few_step:
+                # the part of the step inside the range, as whole steps are too coarse for a few steps
+                keeps = [
+                    max(0.0, min(i + 1, e * len(timesteps)) - max(i, s * len(timesteps)))
+                    for s, e in zip(control_guidance_start, control_guidance_end)
+                ]
+            else:
+                keeps = [
+                    1.0 - float(i / len(timesteps) < s or (i + 1) / len(timesteps) > e)
+                    for s, e in zip(control_guidance_start, control_guidance_end)
+                ]
             brushnet_keep.append(keeps[0] if isinstance(brushnet, BrushNetModel) else keeps)
 
+        # Precompute the conditioning scale of every step. The Python values drive the cache bookkeeping, the device
+        # tensor is what BrushNet receives: indexing it neither syncs with the host nor changes the guards of a
+        # compiled BrushNet when the scale switches on or off
+        brushnet_cond_scales = []
+        for keep in brushnet_keep:
+            if isinstance(keep, list):
+                brushnet_cond_scales.append([c * s for c, s in zip(brushnet_conditioning_scale, keep)])
+            else:
+                brushnet_cond_scale = brushnet_conditioning_scale
+                if isinstance(brushnet_cond_scale, list):
+                    brushnet_cond_scale = brushnet_cond_scale[0]
+                brushnet_cond_scales.append(brushnet_cond_scale * keep)
+        brushnet_cond_scale_tensors = torch.tensor(brushnet_cond_scales, dtype=prompt_embeds.dtype, device=device)
+
+        # Create list stating on which steps the brushnet residuals are recomputed instead of reused from the cache
+        num_uncached_steps = int(brushnet_cache_start * len(timesteps))
+        brushnet_recompute = [
+            i < num_uncached_steps or (i - num_uncached_steps) % brushnet_cache_interval == 0
+            for i in range(len(timesteps))
+        ]
+        brushnet_cache, brushnet_cache_scale = [], None
+
+        brushnet_window = None
+        if brushnet_window_padding is not None and not global_pool_conditions:
+            brushnet_window = self.get_brushnet_window(conditioning_latents, brushnet_window_padding)
+        if brushnet_window is not None:
+            top, bottom, left, right = brushnet_window
+            conditioning_latents = conditioning_latents[:, :, top:bottom, left:right]
+        unet_cache_features = None
+
         # 8. Denoising loop
         num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
         is_unet_compiled = is_compiled_module(self.unet)
@@ -1173,7 +1602,7 @@ class StableDiffusionBrushNetPipeline(
                 latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
 
                 # brushnet(s) inference
-                if guess_mode and self.do_classifier_free_guidance:
+                if (guess_mode or share_brushnet_cfg_batch) and self.do_classifier_free_guidance:
                     # Infer BrushNet only for the conditional batch.
                     control_model_input = latents
                     control_model_input = self.scheduler.scale_model_input(control_model_input, t)
@@ -1182,31 +1611,42 @@ class StableDiffusionBrushNetPipeline(
                     control_model_input = latent_model_input
                     brushnet_prompt_embeds = prompt_embeds
 
-                if isinstance(brushnet_keep[i], list):
-                    cond_scale = [c * s for c, s in zip(brushnet_conditioning_scale, brushnet_keep[i])]
-                else:
-                    brushnet_cond_scale = brushnet_conditioning_scale
-                    if isinstance(brushnet_cond_scale, list):
-                        brushnet_cond_scale = brushnet_cond_scale[0]
-                    cond_scale = brushnet_cond_scale * brushnet_keep[i]
+                cond_scale = brushnet_cond_scales[i]
 
-                down_block_res_samples, mid_block_res_sample, up_block_res_samples = self.brushnet(
-                    control_model_input,
-                    t,
-                    encoder_hidden_states=brushnet_prompt_embeds,
-                    brushnet_cond=conditioning_latents,
-                    conditioning_scale=cond_scale,
-                    guess_mode=guess_mode,
-                    return_dict=False,
-                )
+                if brushnet_window is not None:
+                    control_model_input = control_model_input[:, :, top:bottom, left:right]
+
+                if brushnet_recompute[i] or cond_scale != brushnet_cache_scale:
+                    brushnet_residuals = self.brushnet(
+                        control_model_input,
+                        t,
+                        encoder_hidden_states=brushnet_prompt_embeds,
+                        brushnet_cond=conditioning_latents,
+                        conditioning_scale=brushnet_cond_scale_tensors[i],
+                        guess_mode=guess_mode,
+                        return_dict=False,
+                    )
+                    if brushnet_window is not None:
+                        brushnet_residuals = self.pad_brushnet_residuals(
+                            brushnet_residuals, brushnet_window, *latents.shape[-2:]
+                        )
+                    if guess_mode and self.do_classifier_free_guidance:
+                        # Infered BrushNet only for the conditional batch.
+                        # To apply the output of BrushNet to both the unconditional and conditional batches,
+                        # add 0 to the unconditional batch to keep it unchanged. This is done once per BrushNet
+                        # evaluation, so steps reusing the cached residuals do not rebuild the zero halves.
+                        brushnet_residuals = self.pad_guess_mode_residuals(brushnet_residuals)
+                    brushnet_cache = brushnet_cache[-1:] + [(i, brushnet_residuals)]
+                    brushnet_cache_scale = cond_scale
+                elif brushnet_cache_extrapolate:
+                    brushnet_residuals = self.extrapolate_brushnet_residuals(brushnet_cache, i)
+                else:
+                    brushnet_residuals = brushnet_cache[-1][1]
 
-                if guess_mode and self.do_classifier_free_guidance:
-                    # Infered BrushNet only for the conditional batch.
-                    # To apply the output of BrushNet to both the unconditional and conditional batches,
-                    # add 0 to the unconditional batch to keep it unchanged.
-                    down_block_res_samples = [torch.cat([torch.zeros_like(d), d]) for d in down_block_res_samples]
-                    mid_block_res_sample = torch.cat([torch.zeros_like(mid_block_res_sample), mid_block_res_sample])
-                    up_block_res_samples = [torch.cat([torch.zeros_like(d), d]) for d in up_block_res_samples]
+                # the unet pops the residuals it adds, so the cached lists are copied
+                down_block_res_samples, mid_block_res_sample, up_block_res_samples = brushnet_residuals
+                down_block_res_samples = list(down_block_res_samples)
+                up_block_res_samples = list(up_block_res_samples)
 
                 # predict the noise residual
                 noise_pred = self.unet(
@@ -1219,8 +1659,13 @@ class StableDiffusionBrushNetPipeline(
                     mid_block_add_sample=mid_block_res_sample,
                     up_block_add_samples=up_block_res_samples,
                     added_cond_kwargs=added_cond_kwargs,
+                    deep_cache_depth=unet_cache_depth if unet_cache_interval > 1 else None,
+                    deep_cache_features=unet_cache_features if i % unet_cache_interval else None,
                     return_dict=False,
-                )[0]
+                )
+                if unet_cache_interval > 1:
+                    unet_cache_features = noise_pred[1]
+                noise_pred = noise_pred[0]
 
                 # perform guidance
                 if self.do_classifier_free_guidance:
@@ -1255,9 +1700,21 @@ class StableDiffusionBrushNetPipeline(
             torch.cuda.empty_cache()
 
         if not output_type == "latent":
-            image = self.vae.decode(latents / self.vae.config.scaling_factor, return_dict=False, generator=generator)[
-                0
-            ]
+            if blended:
+                image = self.decode_masked_region(
+                    latents / self.vae.config.scaling_factor,
+                    original_image,
+                    original_mask,
+                    height,
+                    width,
+                    crops_coords,
+                    resize_mode,
+                    generator=generator,
+                )
+            else:
+                image = self.vae.decode(
+                    latents / self.vae.config.scaling_factor, return_dict=False, generator=generator
+                )[0]
             image, has_nsfw_concept = self.run_safety_checker(image, device, prompt_embeds.dtype)
         else:
             image = latents
@@ -1270,6 +1727,9 @@ class StableDiffusionBrushNetPipeline(
 
         image = self.image_processor.postprocess(image, output_type=output_type, do_denormalize=do_denormalize)
 
+        if padding_mask_crop is not None:
+            image = [self.image_processor.apply_overlay(original_mask, original_image, i, crops_coords) for i in image]
+
         # Offload all models
         self.maybe_free_model_hooks()
 
@@ -0,0 +1,585 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.overrides import TorchFunctionMode
+from transformers import CLIPTextConfig, CLIPTextModel
+
+from diffusers import (
+    AutoencoderKL,
+    BrushNetModel,
+    DDIMScheduler,
+    LCMScheduler,
+    StableDiffusionBrushNetPipeline,
+    TCDScheduler,
+    UNet2DConditionModel,
+    UniPCMultistepScheduler,
+)
+from diffusers.utils.testing_utils import enable_full_determinism, torch_device
+
+
+enable_full_determinism()
+
+
+class SyncPointRecorder(TorchFunctionMode):
+    # tensor methods that need the value of a device tensor on the host
+    sync_functions = {
+        torch.Tensor.item,
+        torch.Tensor.tolist,
+        torch.Tensor.numpy,
+        torch.Tensor.cpu,
+        torch.Tensor.nonzero,
+        torch.Tensor.__bool__,
+        torch.Tensor.__int__,
+        torch.Tensor.__float__,
+        torch.Tensor.__index__,
+        torch.nonzero,
+    }
+
+    def __init__(self):
+        super().__init__()
+        self.sync_points = []
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        if func in self.sync_functions:
+            self.sync_points.append(func.__name__)
+        return func(*args, **(kwargs or {}))
+
+
+class BrushNetPipelineFastTests(unittest.TestCase):
+    pipeline_class = StableDiffusionBrushNetPipeline
+
+    def get_dummy_components(self):
+        torch.manual_seed(0)
+        unet = UNet2DConditionModel(
+            block_out_channels=(32, 64),
+            layers_per_block=2,
+            sample_size=32,
+            in_channels=4,
+            out_channels=4,
+            down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+            up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+            cross_attention_dim=32,
+        )
+        torch.manual_seed(0)
+        brushnet = BrushNetModel.from_unet(unet)
+        # the zero-initialised output convs would make every residual vanish
+        for module in [*brushnet.brushnet_down_blocks, brushnet.brushnet_mid_block, *brushnet.brushnet_up_blocks]:
+            torch.nn.init.normal_(module.weight, std=0.02)
+        torch.manual_seed(0)
+        scheduler = DDIMScheduler(
+            beta_start=0.00085,
+            beta_end=0.012,
+            beta_schedule="scaled_linear",
+            clip_sample=False,
+            set_alpha_to_one=False,
+        )
+        torch.manual_seed(0)
+        vae = AutoencoderKL(
+            block_out_channels=[32, 64],
+            in_channels=3,
+            out_channels=3,
+            down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+            up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"],
+            latent_channels=4,
+        )
+        torch.manual_seed(0)
+        text_encoder_config = CLIPTextConfig(
+            bos_token_id=0,
+            eos_token_id=2,
+            hidden_size=32,
+            intermediate_size=37,
+            layer_norm_eps=1e-05,
+            num_attention_heads=4,
+            num_hidden_layers=5,
+            pad_token_id=1,
+            vocab_size=1000,
+        )
+        text_encoder = CLIPTextModel(text_encoder_config)
+
+        # prompts are passed as embeddings, so no tokenizer is needed
+        components = {
+            "unet": unet,
+            "brushnet": brushnet,
+            "scheduler": scheduler,
+            "vae": vae,
+            "text_encoder": text_encoder,
+            "tokenizer": None,
+            "safety_checker": None,
+            "feature_extractor": None,
+            "image_encoder": None,
+        }
+        return components
+
+    def get_dummy_inputs(self, device, seed=0):
+        generator = torch.Generator(device="cpu").manual_seed(seed)
+
+        prompt_embeds = torch.randn((1, 8, 32), generator=generator).to(device)
+        negative_prompt_embeds = torch.randn((1, 8, 32), generator=generator).to(device)
+
+        image = torch.randint(0, 256, (64, 64, 3), generator=generator, dtype=torch.uint8).numpy()
+        mask = np.zeros((64, 64, 3), dtype=np.uint8)
+        mask[16:40, 24:48] = 255
+        image = image * (mask == 0)
+
+        inputs = {
+            "prompt_embeds": prompt_embeds,
+            "negative_prompt_embeds": negative_prompt_embeds,
+            "image": Image.fromarray(image.astype(np.uint8)),
+            "mask": Image.fromarray(mask),
+            "generator": torch.Generator(device="cpu").manual_seed(seed),
+            "num_inference_steps": 2,
+            "guidance_scale": 6.0,
+            "output_type": "np",
+        }
+        return inputs
+
+    def get_pipeline(self):
+        pipe = self.pipeline_class(**self.get_dummy_components(), requires_safety_checker=False)
+        pipe = pipe.to(torch_device)
+        pipe.set_progress_bar_config(disable=None)
+        return pipe
+
+    def test_brushnet_inference(self):
+        pipe = self.get_pipeline()
+        image = pipe(**self.get_dummy_inputs(torch_device)).images
+
+        self.assertEqual(image.shape, (1, 64, 64, 3))
+        self.assertTrue(np.isfinite(image).all())
+
+    def test_brushnet_shares_cfg_batch(self):
+        pipe = self.get_pipeline()
+        self.assertTrue(pipe.brushnet.is_text_independent)
+
+        brushnet_batch_sizes = []
+        hook = pipe.brushnet.register_forward_pre_hook(
+            lambda module, args, kwargs: brushnet_batch_sizes.append(args[0].shape[0]), with_kwargs=True
+        )
+        shared = pipe(**self.get_dummy_inputs(torch_device)).images
+        hook.remove()
+
+        # the text-independent branch only runs on the conditional half of the guidance batch
+        self.assertEqual(brushnet_batch_sizes, [1, 1])
+
+        with mock.patch.object(
+            BrushNetModel, "is_text_independent", new_callable=mock.PropertyMock, return_value=False
+        ):
+            doubled = pipe(**self.get_dummy_inputs(torch_device)).images
+
+        self.assertLess(np.abs(shared - doubled).max(), 1e-4)
+
+    def test_brushnet_encodes_conditioning_once(self):
+        pipe = self.get_pipeline()
+
+        encoded_batch_sizes = []
+        hook = pipe.vae.encoder.register_forward_pre_hook(
+            lambda module, args: encoded_batch_sizes.append(args[0].shape[0])
+        )
+        inputs = self.get_dummy_inputs(torch_device)
+        inputs["num_images_per_prompt"] = 2
+        image = pipe(**inputs).images
+        hook.remove()
+
+        self.assertEqual(image.shape, (2, 64, 64, 3))
+        self.assertEqual(encoded_batch_sizes, [1])
+
+    def test_brushnet_batch_matches_single_samples(self):
+        pipe = self.get_pipeline()
+
+        generator = torch.Generator(device="cpu").manual_seed(1)
+        prompt_embeds = torch.randn((3, 8, 32), generator=generator).to(torch_device)
+        negative_prompt_embeds = torch.randn((3, 8, 32), generator=generator).to(torch_device)
+        images, masks = [], []
+        for i in range(3):
+            image = torch.randint(0, 256, (64, 64, 3), generator=generator, dtype=torch.uint8).numpy()
+            mask = np.zeros((64, 64, 3), dtype=np.uint8)
+            mask[8 * i : 8 * i + 24, 16:40] = 255
+            images.append(Image.fromarray(image * (mask == 0)))
+            masks.append(Image.fromarray(mask))
+
+        def generate(indices):
+            return pipe(
+                prompt_embeds=prompt_embeds[indices],
+                negative_prompt_embeds=negative_prompt_embeds[indices],
+                image=[images[i] for i in indices],
+                mask=[masks[i] for i in indices],
+                generator=[torch.Generator(device="cpu").manual_seed(1234) for _ in indices],
+                num_inference_steps=2,
+                output_type="np",
+            ).images
+
+        # every sample draws its noise and its conditioning latents from its own generator
+        batched = generate([0, 1, 2])
+        for i in range(3):
+            single = generate([i])
+            self.assertLess(np.abs(batched[i] - single[0]).max(), 1e-4)
+        # the conditioning latents no longer depend on the global RNG
+        np.testing.assert_array_equal(generate([2]), single)
+
+    def test_brushnet_padding_mask_crop(self):
+        pipe = self.get_pipeline()
+
+        inputs = self.get_dummy_inputs(torch_device)
+        image = np.array(inputs["image"].resize((128, 96)))
+        mask = np.zeros((96, 128, 3), dtype=np.uint8)
+        mask[40:56, 72:88] = 255
+        inputs["image"] = Image.fromarray(image * (mask == 0))
+        inputs["mask"] = Image.fromarray(mask)
+        inputs["height"] = inputs["width"] = 32
+        inputs["padding_mask_crop"] = 4
+        inputs["output_type"] = "pil"
+
+        latent_sizes = []
+        hook = pipe.unet.register_forward_pre_hook(lambda module, args: latent_sizes.append(args[0].shape[-2:]))
+        output = pipe(**inputs).images[0]
+        hook.remove()
+
+        # only the 32x32 crop around the mask is denoised, the composite keeps the input resolution
+        self.assertEqual(set(latent_sizes), {(16, 16)})
+        self.assertEqual(output.size, (128, 96))
+        # pixels far outside the crop come from the original image
+        np.testing.assert_array_equal(np.array(output)[:16, :32], np.array(inputs["image"])[:16, :32])
+
+    def test_brushnet_strength(self):
+        pipe = self.get_pipeline()
+
+        unet_timesteps = []
+        hook = pipe.unet.register_forward_pre_hook(lambda module, args: unet_timesteps.append(int(args[1])))
+        inputs = self.get_dummy_inputs(torch_device)
+        inputs["num_inference_steps"] = 4
+        inputs["strength"] = 0.5
+        image = pipe(**inputs).images
+        hook.remove()
+
+        self.assertEqual(image.shape, (1, 64, 64, 3))
+        # only the last half of the schedule is run
+        self.assertEqual(unet_timesteps, pipe.scheduler.timesteps[2:].tolist())
+
+        inputs["strength"] = 1.5
+        with self.assertRaises(ValueError):
+            pipe(**inputs)
+
+    def test_brushnet_blended_decodes_masked_region(self):
+        pipe = self.get_pipeline()
+
+        inputs = self.get_dummy_inputs(torch_device)
+        image = np.array(inputs["image"].resize((128, 128)))
+        mask = np.zeros((128, 128, 3), dtype=np.uint8)
+        mask[80:96, 80:96] = 255
+        inputs["image"] = Image.fromarray(image * (mask == 0))
+        inputs["mask"] = Image.fromarray(mask)
+        inputs["blended"] = True
+
+        decoded_sizes = []
+        hook = pipe.vae.decoder.register_forward_pre_hook(lambda module, args: decoded_sizes.append(args[0].shape[-2:]))
+        output = pipe(**inputs).images
+        hook.remove()
+
+        self.assertEqual(output.shape, (1, 128, 128, 3))
+        # only a window around the blurred mask is decoded
+        self.assertEqual(len(decoded_sizes), 1)
+        self.assertLess(decoded_sizes[0].numel(), 64 * 64)
+        # the known region away from the mask is copied from the input image
+        np.testing.assert_allclose(output[0, :48, :48], np.array(inputs["image"])[:48, :48] / 255, atol=1e-5)
+
+    def test_brushnet_residual_cache(self):
+        pipe = self.get_pipeline()
+
+        brushnet_timesteps = []
+        hook = pipe.brushnet.register_forward_pre_hook(lambda module, args: brushnet_timesteps.append(int(args[1])))
+        inputs = self.get_dummy_inputs(torch_device)
+        inputs["num_inference_steps"] = 5
+        inputs["brushnet_cache_interval"] = 2
+        cached = pipe(**inputs).images
+        hook.remove()
+
+        # the residuals are only recomputed every second step
+        self.assertEqual(brushnet_timesteps, pipe.scheduler.timesteps[::2].tolist())
+        self.assertEqual(cached.shape, (1, 64, 64, 3))
+
+        inputs = self.get_dummy_inputs(torch_device)
+        inputs["num_inference_steps"] = 5
+        inputs["brushnet_cache_interval"] = 2
+        inputs["brushnet_cache_extrapolate"] = True
+        extrapolated = pipe(**inputs).images
+        self.assertTrue(np.isfinite(extrapolated).all())
+        self.assertGreater(np.abs(extrapolated - cached).max(), 0)
+
+        inputs = self.get_dummy_inputs(torch_device)
+        inputs["brushnet_cache_interval"] = 0
+        with self.assertRaises(ValueError):
+            pipe(**inputs)
+
+    def test_brushnet_unet_deep_cache(self):
+        pipe = self.get_pipeline()
+
+        deep_block_calls = []
+        shallow_block_calls = []
+        deep_hook = pipe.unet.up_blocks[0].register_forward_pre_hook(lambda *args: deep_block_calls.append(1))
+        shallow_hook = pipe.unet.up_blocks[-1].register_forward_pre_hook(lambda *args: shallow_block_calls.append(1))
+        inputs = self.get_dummy_inputs(torch_device)
+        inputs["num_inference_steps"] = 4
+        inputs["unet_cache_interval"] = 2
+        image = pipe(**inputs).images
+        deep_hook.remove()
+        shallow_hook.remove()
+
+        self.assertEqual(image.shape, (1, 64, 64, 3))
+        self.assertTrue(np.isfinite(image).all())
+        # the deep blocks only run on every second step, the shallow ones on every step
+        self.assertEqual(len(deep_block_calls), 2)
+        self.assertEqual(len(shallow_block_calls), 4)
+
+    def test_unet_deep_cache_features(self):
+        components = self.get_dummy_components()
+        unet, brushnet = components["unet"], components["brushnet"]
+
+        sample = torch.randn(2, 4, 32, 32)
+        brushnet_cond = torch.randn(2, 5, 32, 32)
+        encoder_hidden_states = torch.randn(2, 8, 32)
+        with torch.no_grad():
+            down, mid, up = brushnet(
+                sample, 10, encoder_hidden_states=encoder_hidden_states, brushnet_cond=brushnet_cond, return_dict=False
+            )
+            expected = unet(
+                sample,
+                10,
+                encoder_hidden_states,
+                down_block_add_samples=list(down),
+                mid_block_add_sample=mid,
+                up_block_add_samples=list(up),
+            ).sample
+            for depth in range(1, len(unet.down_blocks) + 1):
+                output = unet(
+                    sample,
+                    10,
+                    encoder_hidden_states,
+                    down_block_add_samples=list(down),
+                    mid_block_add_sample=mid,
+                    up_block_add_samples=list(up),
+                    deep_cache_depth=depth,
+                )
+                cached = unet(
+                    sample,
+                    10,
+                    encoder_hidden_states,
+                    down_block_add_samples=list(down),
+                    mid_block_add_sample=mid,
+                    up_block_add_samples=list(up),
+                    deep_cache_depth=depth,
+                    deep_cache_features=output.deep_cache_features,
+                ).sample
+
+                # with unchanged inputs, reusing the deep features reproduces the full forward pass
+                self.assertLess((output.sample - expected).abs().max(), 1e-5)
+                self.assertLess((cached - expected).abs().max(), 1e-5)
+
+    def test_brushnet_window(self):
+        pipe = self.get_pipeline()
+
+        brushnet_sizes = []
+        hook = pipe.brushnet.register_forward_pre_hook(lambda module, args: brushnet_sizes.append(args[0].shape[-2:]))
+        inputs = self.get_dummy_inputs(torch_device)
+        inputs["brushnet_window_padding"] = 2
+        image = pipe(**inputs).images
+        hook.remove()
+
+        self.assertEqual(image.shape, (1, 64, 64, 3))
+        self.assertTrue(np.isfinite(image).all())
+        # the inpaint area covers latent rows 8-19 and columns 12-23, padded by 2 and aligned to the BrushNet factor 2
+        self.assertEqual(set(brushnet_sizes), {(16, 16)})
+
+    def test_pad_brushnet_residuals(self):
+        pipe = self.get_pipeline()
+
+        sample = torch.randn(1, 4, 32, 32)
+        brushnet_cond = torch.randn(1, 5, 32, 32)
+        encoder_hidden_states = torch.randn(1, 8, 32)
+        window = (8, 24, 4, 20)
+        with torch.no_grad():
+            full = pipe.brushnet(
+                sample, 10, encoder_hidden_states=encoder_hidden_states, brushnet_cond=brushnet_cond, return_dict=False
+            )
+            cropped = pipe.brushnet(
+                sample[:, :, 8:24, 4:20],
+                10,
+                encoder_hidden_states=encoder_hidden_states,
+                brushnet_cond=brushnet_cond[:, :, 8:24, 4:20],
+                return_dict=False,
+            )
+        padded = pipe.pad_brushnet_residuals(cropped, window, 32, 32)
+
+        full_samples = [*full[0], full[1], *full[2]]
+        padded_samples = [*padded[0], padded[1], *padded[2]]
+        self.assertEqual([s.shape for s in padded_samples], [s.shape for s in full_samples])
+        for sample in padded_samples:
+            scale = 32 // sample.shape[-1]
+            self.assertEqual(sample[:, :, : 8 // scale].abs().max(), 0)
+            self.assertEqual(sample[:, :, :, 20 // scale :].abs().max(), 0)
+
+    def test_brushnet_denoising_loop_has_no_sync_points(self):
+        pipe = self.get_pipeline()
+        pipe.scheduler = UniPCMultistepScheduler.from_config(pipe.scheduler.config)
+
+        # record everything between the end of the first step and the end of the last one
+        recorder = SyncPointRecorder()
+
+        def record_steps(pipe, step, timestep, callback_kwargs):
+            if step == 0:
+                recorder.__enter__()
+            if step == pipe.num_timesteps - 1:
+                recorder.__exit__(None, None, None)
+            return callback_kwargs
+
+        inputs = self.get_dummy_inputs(torch_device)
+        inputs["num_inference_steps"] = 4
+        inputs["control_guidance_end"] = 0.5
+        inputs["guess_mode"] = True
+        inputs["callback_on_step_end"] = record_steps
+        pipe(**inputs)
+
+        self.assertEqual(recorder.sync_points, [])
+
+    def test_brushnet_denoising_loop_compiles_fullgraph(self):
+        pipe = self.get_pipeline()
+        pipe.scheduler = UniPCMultistepScheduler.from_config(pipe.scheduler.config)
+
+        def get_inputs():
+            inputs = self.get_dummy_inputs(torch_device)
+            inputs["num_inference_steps"] = 4
+            inputs["control_guidance_end"] = 0.5
+            inputs["guess_mode"] = True
+            return inputs
+
+        image = pipe(**get_inputs()).images
+
+        torch._dynamo.reset()
+        pipe.unet = torch.compile(pipe.unet, fullgraph=True, backend="eager")
+        pipe.brushnet = torch.compile(pipe.brushnet, fullgraph=True, backend="eager")
+        # switching the BrushNet off half-way must not recompile it
+        with torch._dynamo.config.patch(error_on_recompile=True):
+            compiled_image = pipe(**get_inputs()).images
+        torch._dynamo.reset()
+
+        self.assertLess(np.abs(compiled_image - image).max(), 1e-4)
+
+    def test_brushnet_few_step_schedulers(self):
+        for scheduler_class in [LCMScheduler, TCDScheduler]:
+            pipe = self.get_pipeline()
+            pipe.scheduler = scheduler_class.from_config(pipe.scheduler.config)
+
+            brushnet_batch_sizes = []
+            pipe.brushnet.register_forward_pre_hook(lambda module, args: brushnet_batch_sizes.append(args[0].shape[0]))
+            inputs = self.get_dummy_inputs(torch_device)
+            inputs["num_inference_steps"] = 4
+            inputs["guidance_scale"] = 1.0
+            image = pipe(**inputs).images
+
+            self.assertEqual(image.shape, (1, 64, 64, 3))
+            self.assertTrue(np.isfinite(image).all())
+            # without classifier free guidance the batch is not doubled
+            self.assertEqual(brushnet_batch_sizes, [1, 1, 1, 1])
+
+    def test_brushnet_partial_guidance_steps(self):
+        pipe = self.get_pipeline()
+
+        conditioning_scales = []
+        pipe.brushnet.register_forward_pre_hook(
+            lambda module, args, kwargs: conditioning_scales.append(float(kwargs["conditioning_scale"])),
+            with_kwargs=True,
+        )
+        inputs = self.get_dummy_inputs(torch_device)
+        inputs["num_inference_steps"] = 4
+        inputs["control_guidance_end"] = 0.6
+        pipe(**inputs)
+
+        # the steps that are only partly inside the guidance range are dropped
+        self.assertEqual(conditioning_scales, [1.0, 1.0, 0.0, 0.0])
+
+        conditioning_scales.clear()
+        pipe.scheduler = LCMScheduler.from_config(pipe.scheduler.config)
+        inputs = self.get_dummy_inputs(torch_device)
+        inputs["num_inference_steps"] = 4
+        inputs["control_guidance_end"] = 0.6
+        inputs["guidance_scale"] = 1.0
+        pipe(**inputs)
+
+        # in few-step inference the third step is scaled by the 40% of it inside the guidance range
+        self.assertEqual(len(conditioning_scales), 4)
+        for scale, expected_scale in zip(conditioning_scales, [1.0, 1.0, 0.4, 0.0]):
+            self.assertAlmostEqual(scale, expected_scale, places=5)
+
+    def test_brushnet_lite(self):
+        components = self.get_dummy_components()
+        unet, brushnet = components["unet"], components["brushnet"]
+        torch.manual_seed(0)
+        lite_brushnet = BrushNetModel.from_unet(
+            unet, block_out_channels=(32, 32), layers_per_block=1, use_up_blocks=False
+        )
+        for module in [*lite_brushnet.brushnet_down_blocks, lite_brushnet.brushnet_mid_block]:
+            torch.nn.init.normal_(module.weight, std=0.02)
+
+        self.assertLess(
+            sum(p.numel() for p in lite_brushnet.parameters()), sum(p.numel() for p in brushnet.parameters()) / 2
+        )
+
+        # the lite residuals are projected back to the UNet widths, one per UNet layer
+        sample = torch.randn(1, 4, 16, 16)
+        brushnet_cond = torch.randn(1, 5, 16, 16)
+        encoder_hidden_states = torch.randn(1, 8, 32)
+        full = brushnet(sample, 10, encoder_hidden_states, brushnet_cond)
+        lite = lite_brushnet(sample, 10, encoder_hidden_states, brushnet_cond)
+        self.assertEqual(
+            [d.shape for d in lite.down_block_res_samples], [d.shape for d in full.down_block_res_samples]
+        )
+        self.assertEqual(lite.mid_block_res_sample.shape, full.mid_block_res_sample.shape)
+        self.assertEqual(len(lite.up_block_res_samples), 0)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            lite_brushnet.save_pretrained(tmpdir)
+            reloaded = BrushNetModel.from_pretrained(tmpdir)
+        self.assertEqual(reloaded.brushnet_down_block_indices, lite_brushnet.brushnet_down_block_indices)
+
+        components["brushnet"] = lite_brushnet
+        pipe = self.pipeline_class(**components, requires_safety_checker=False).to(torch_device)
+        pipe.set_progress_bar_config(disable=None)
+        image = pipe(**self.get_dummy_inputs(torch_device)).images
+
+        self.assertEqual(image.shape, (1, 64, 64, 3))
+        self.assertTrue(np.isfinite(image).all())
+
+    def test_brushnet_lite_shares_layers(self):
+        with self.assertRaises(ValueError):
+            BrushNetModel(block_out_channels=(32, 64), layers_per_block=2, unet_layers_per_block=1)
+
+        brushnet = BrushNetModel(
+            block_out_channels=(32, 32),
+            layers_per_block=1,
+            unet_block_out_channels=(32, 64),
+            unet_layers_per_block=2,
+            down_block_types=("DownBlock2D", "DownBlock2D"),
+            up_block_types=("UpBlock2D", "UpBlock2D"),
+            cross_attention_dim=32,
+        )
+        # every BrushNet layer feeds the UNet layers of its block, the downsamplers and upsamplers are kept apart
+        self.assertEqual(brushnet.brushnet_down_block_indices, [0, 1, 1, 2, 3, 3])
+        self.assertEqual(brushnet.brushnet_up_block_indices, [0, 0, 1, 2, 3, 3, 4])
+        self.assertEqual([m.out_channels for m in brushnet.brushnet_up_blocks], [64, 64, 64, 64, 32, 32, 32])
@@ -0,0 +1,359 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection
+
+from diffusers import (
+    AutoencoderKL,
+    BrushNetModel,
+    EulerDiscreteScheduler,
+    StableDiffusionXLBrushNetPipeline,
+    UNet2DConditionModel,
+)
+from diffusers.utils.testing_utils import enable_full_determinism, torch_device
+
+
+enable_full_determinism()
+
+
+class StableDiffusionXLBrushNetPipelineFastTests(unittest.TestCase):
+    pipeline_class = StableDiffusionXLBrushNetPipeline
+
+    def get_dummy_components(self, text_independent_brushnet=False):
+        torch.manual_seed(0)
+        unet = UNet2DConditionModel(
+            block_out_channels=(32, 64),
+            layers_per_block=2,
+            sample_size=32,
+            in_channels=4,
+            out_channels=4,
+            down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+            up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+            # SDXL-style micro-conditioning
+            attention_head_dim=(2, 4),
+            use_linear_projection=True,
+            addition_embed_type="text_time",
+            addition_time_embed_dim=8,
+            transformer_layers_per_block=(1, 2),
+            projection_class_embeddings_input_dim=80,  # 6 * 8 + 32
+            cross_attention_dim=64,
+        )
+        torch.manual_seed(0)
+        brushnet = BrushNetModel.from_unet(unet)
+        if text_independent_brushnet:
+            # without the pooled text embedding added to the time embedding, the BrushNet outputs ignore the prompt
+            brushnet = BrushNetModel.from_config({**brushnet.config, "addition_embed_type": None})
+        # the zero-initialised output convs would make every residual vanish
+        for module in [*brushnet.brushnet_down_blocks, brushnet.brushnet_mid_block, *brushnet.brushnet_up_blocks]:
+            torch.nn.init.normal_(module.weight, std=0.02)
+        torch.manual_seed(0)
+        scheduler = EulerDiscreteScheduler(
+            beta_start=0.00085,
+            beta_end=0.012,
+            steps_offset=1,
+            beta_schedule="scaled_linear",
+            timestep_spacing="leading",
+        )
+        torch.manual_seed(0)
+        vae = AutoencoderKL(
+            block_out_channels=[32, 64],
+            in_channels=3,
+            out_channels=3,
+            down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+            up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"],
+            latent_channels=4,
+        )
+        torch.manual_seed(0)
+        text_encoder_config = CLIPTextConfig(
+            bos_token_id=0,
+            eos_token_id=2,
+            hidden_size=32,
+            intermediate_size=37,
+            layer_norm_eps=1e-05,
+            num_attention_heads=4,
+            num_hidden_layers=5,
+            pad_token_id=1,
+            vocab_size=1000,
+            projection_dim=32,
+        )
+        text_encoder = CLIPTextModel(text_encoder_config)
+        text_encoder_2 = CLIPTextModelWithProjection(text_encoder_config)
+
+        # prompts are passed as embeddings, so no tokenizers are needed
+        components = {
+            "unet": unet,
+            "brushnet": brushnet,
+            "scheduler": scheduler,
+            "vae": vae,
+            "text_encoder": text_encoder,
+            "text_encoder_2": text_encoder_2,
+            "tokenizer": None,
+            "tokenizer_2": None,
+            "feature_extractor": None,
+            "image_encoder": None,
+        }
+        return components
+
+    def get_dummy_inputs(self, device, seed=0):
+        generator = torch.Generator(device="cpu").manual_seed(seed)
+
+        prompt_embeds = torch.randn((1, 8, 64), generator=generator).to(device)
+        negative_prompt_embeds = torch.randn((1, 8, 64), generator=generator).to(device)
+        pooled_prompt_embeds = torch.randn((1, 32), generator=generator).to(device)
+        negative_pooled_prompt_embeds = torch.randn((1, 32), generator=generator).to(device)
+
+        image = torch.randint(0, 256, (64, 64, 3), generator=generator, dtype=torch.uint8).numpy()
+        mask = np.zeros((64, 64, 3), dtype=np.uint8)
+        mask[16:40, 24:48] = 255
+        image = image * (mask == 0)
+
+        inputs = {
+            "prompt_embeds": prompt_embeds,
+            "negative_prompt_embeds": negative_prompt_embeds,
+            "pooled_prompt_embeds": pooled_prompt_embeds,
+            "negative_pooled_prompt_embeds": negative_pooled_prompt_embeds,
+            "image": Image.fromarray(image.astype(np.uint8)),
+            "mask": Image.fromarray(mask),
+            "generator": torch.Generator(device="cpu").manual_seed(seed),
+            "num_inference_steps": 2,
+            "guidance_scale": 6.0,
+            "output_type": "np",
+        }
+        return inputs
+
+    def get_pipeline(self, **kwargs):
+        pipe = self.pipeline_class(**self.get_dummy_components(**kwargs), add_watermarker=False)
+        pipe = pipe.to(torch_device)
+        pipe.set_progress_bar_config(disable=None)
+        return pipe
+
+    def test_brushnet_inference(self):
+        pipe = self.get_pipeline()
+        image = pipe(**self.get_dummy_inputs(torch_device)).images
+
+        self.assertEqual(image.shape, (1, 64, 64, 3))
+        self.assertTrue(np.isfinite(image).all())
+
+    def test_brushnet_list_inputs(self):
+        pipe = self.get_pipeline()
+
+        inputs = self.get_dummy_inputs(torch_device)
+        for name in ["prompt_embeds", "negative_prompt_embeds"]:
+            inputs[name] = inputs[name].repeat(2, 1, 1)
+        for name in ["pooled_prompt_embeds", "negative_pooled_prompt_embeds"]:
+            inputs[name] = inputs[name].repeat(2, 1)
+        inputs["image"] = [inputs["image"]] * 2
+        inputs["mask"] = [inputs["mask"]] * 2
+        image = pipe(**inputs).images
+
+        self.assertEqual(image.shape, (2, 64, 64, 3))
+        self.assertTrue(np.isfinite(image).all())
+
+    def test_brushnet_shares_cfg_batch(self):
+        self.assertFalse(self.get_pipeline().brushnet.is_text_independent)
+
+        pipe = self.get_pipeline(text_independent_brushnet=True)
+        self.assertTrue(pipe.brushnet.is_text_independent)
+
+        brushnet_batch_sizes = []
+        hook = pipe.brushnet.register_forward_pre_hook(
+            lambda module, args, kwargs: brushnet_batch_sizes.append(args[0].shape[0]), with_kwargs=True
+        )
+        shared = pipe(**self.get_dummy_inputs(torch_device)).images
+        hook.remove()
+
+        # the text-independent branch only runs on the conditional half of the guidance batch
+        self.assertEqual(brushnet_batch_sizes, [1, 1])
+
+        with mock.patch.object(
+            BrushNetModel, "is_text_independent", new_callable=mock.PropertyMock, return_value=False
+        ):
+            doubled = pipe(**self.get_dummy_inputs(torch_device)).images
+
+        self.assertLess(np.abs(shared - doubled).max(), 1e-4)
+
+    def test_brushnet_encodes_conditioning_once(self):
+        pipe = self.get_pipeline()
+
+        encoded_batch_sizes = []
+        hook = pipe.vae.encoder.register_forward_pre_hook(
+            lambda module, args: encoded_batch_sizes.append(args[0].shape[0])
+        )
+        inputs = self.get_dummy_inputs(torch_device)
+        inputs["num_images_per_prompt"] = 2
+        image = pipe(**inputs).images
+        hook.remove()
+
+        self.assertEqual(image.shape, (2, 64, 64, 3))
+        self.assertEqual(encoded_batch_sizes, [1])
+
+    def test_brushnet_padding_mask_crop(self):
+        pipe = self.get_pipeline()
+
+        inputs = self.get_dummy_inputs(torch_device)
+        image = np.array(inputs["image"].resize((128, 96)))
+        mask = np.zeros((96, 128, 3), dtype=np.uint8)
+        mask[40:56, 72:88] = 255
+        inputs["image"] = Image.fromarray(image * (mask == 0))
+        inputs["mask"] = Image.fromarray(mask)
+        inputs["height"] = inputs["width"] = 32
+        inputs["padding_mask_crop"] = 4
+        inputs["output_type"] = "pil"
+
+        latent_sizes = []
+        hook = pipe.unet.register_forward_pre_hook(lambda module, args: latent_sizes.append(args[0].shape[-2:]))
+        output = pipe(**inputs).images[0]
+        hook.remove()
+
+        # only the 32x32 crop around the mask is denoised, the composite keeps the input resolution
+        self.assertEqual(set(latent_sizes), {(16, 16)})
+        self.assertEqual(output.size, (128, 96))
+        # pixels far outside the crop come from the original image
+        np.testing.assert_array_equal(np.array(output)[:16, :32], np.array(inputs["image"])[:16, :32])
+
+    def test_brushnet_strength(self):
+        pipe = self.get_pipeline()
+
+        unet_timesteps = []
+        hook = pipe.unet.register_forward_pre_hook(lambda module, args: unet_timesteps.append(float(args[1])))
+        inputs = self.get_dummy_inputs(torch_device)
+        inputs["num_inference_steps"] = 4
+        inputs["strength"] = 0.5
+        image = pipe(**inputs).images
+        hook.remove()
+
+        self.assertEqual(image.shape, (1, 64, 64, 3))
+        # only the last half of the schedule is run
+        self.assertEqual(unet_timesteps, pipe.scheduler.timesteps[2:].tolist())
+
+        inputs["strength"] = 1.5
+        with self.assertRaises(ValueError):
+            pipe(**inputs)
+
+    def test_brushnet_blended_decodes_masked_region(self):
+        pipe = self.get_pipeline()
+
+        inputs = self.get_dummy_inputs(torch_device)
+        image = np.array(inputs["image"].resize((128, 128)))
+        mask = np.zeros((128, 128, 3), dtype=np.uint8)
+        mask[80:96, 80:96] = 255
+        inputs["image"] = Image.fromarray(image * (mask == 0))
+        inputs["mask"] = Image.fromarray(mask)
+        inputs["blended"] = True
+
+        decoded_sizes = []
+        hook = pipe.vae.decoder.register_forward_pre_hook(
+            lambda module, args: decoded_sizes.append(args[0].shape[-2:])
+        )
+        output = pipe(**inputs).images
+        hook.remove()
+
+        self.assertEqual(output.shape, (1, 128, 128, 3))
+        # only a window around the blurred mask is decoded
+        self.assertEqual(len(decoded_sizes), 1)
+        self.assertLess(decoded_sizes[0].numel(), 64 * 64)
+        # the known region away from the mask is copied from the input image
+        np.testing.assert_allclose(output[0, :48, :48], np.array(inputs["image"])[:48, :48] / 255, atol=1e-5)
+
+    def test_brushnet_residual_cache(self):
+        pipe = self.get_pipeline()
+
+        brushnet_calls = []
+        hook = pipe.brushnet.register_forward_pre_hook(lambda *args: brushnet_calls.append(1))
+        inputs = self.get_dummy_inputs(torch_device)
+        inputs["num_inference_steps"] = 5
+        inputs["brushnet_cache_interval"] = 2
+        image = pipe(**inputs).images
+        hook.remove()
+
+        # the residuals are only recomputed every second step
+        self.assertEqual(len(brushnet_calls), 3)
+        self.assertTrue(np.isfinite(image).all())
+
+    def test_brushnet_unet_deep_cache(self):
+        pipe = self.get_pipeline()
+
+        deep_block_calls = []
+        hook = pipe.unet.up_blocks[0].register_forward_pre_hook(lambda *args: deep_block_calls.append(1))
+        inputs = self.get_dummy_inputs(torch_device)
+        inputs["num_inference_steps"] = 4
+        inputs["unet_cache_interval"] = 2
+        image = pipe(**inputs).images
+        hook.remove()
+
+        self.assertTrue(np.isfinite(image).all())
+        # the deep blocks only run on every second step
+        self.assertEqual(len(deep_block_calls), 2)
+
+    def test_brushnet_window(self):
+        pipe = self.get_pipeline()
+
+        brushnet_sizes = []
+        hook = pipe.brushnet.register_forward_pre_hook(lambda module, args: brushnet_sizes.append(args[0].shape[-2:]))
+        inputs = self.get_dummy_inputs(torch_device)
+        inputs["brushnet_window_padding"] = 2
+        image = pipe(**inputs).images
+        hook.remove()
+
+        self.assertEqual(image.shape, (1, 64, 64, 3))
+        self.assertTrue(np.isfinite(image).all())
+        # the inpaint area covers latent rows 8-19 and columns 12-23, padded by 2 and aligned to the BrushNet factor 2
+        self.assertEqual(set(brushnet_sizes), {(16, 16)})
+
+    def test_brushnet_batch_matches_single_samples(self):
+        pipe = self.get_pipeline()
+
+        generator = torch.Generator(device="cpu").manual_seed(1)
+        embeds = {
+            "prompt_embeds": torch.randn((3, 8, 64), generator=generator),
+            "negative_prompt_embeds": torch.randn((3, 8, 64), generator=generator),
+            "pooled_prompt_embeds": torch.randn((3, 32), generator=generator),
+            "negative_pooled_prompt_embeds": torch.randn((3, 32), generator=generator),
+        }
+        images, masks = [], []
+        for i in range(3):
+            image = torch.randint(0, 256, (64, 64, 3), generator=generator, dtype=torch.uint8).numpy()
+            mask = np.zeros((64, 64, 3), dtype=np.uint8)
+            mask[8 * i : 8 * i + 24, 16:40] = 255
+            images.append(Image.fromarray(image * (mask == 0)))
+            masks.append(Image.fromarray(mask))
+
+        def generate(indices):
+            return pipe(
+                **{name: embed[indices].to(torch_device) for name, embed in embeds.items()},
+                image=[images[i] for i in indices],
+                mask=[masks[i] for i in indices],
+                generator=[torch.Generator(device="cpu").manual_seed(1234) for _ in indices],
+                num_inference_steps=2,
+                output_type="np",
+            ).images
+
+        # every sample draws its noise and its conditioning latents from its own generator
+        batched = generate([0, 1, 2])
+        for i in range(3):
+            single = generate([i])
+            self.assertLess(np.abs(batched[i] - single[0]).max(), 1e-4)
+        # the conditioning latents no longer depend on the global RNG
+        np.testing.assert_array_equal(generate([2]), single)
+
+
+if __name__ == "__main__":
+    unittest.main()